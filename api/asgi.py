@@ -0,0 +1,306 @@
+from quart import Quart, request, jsonify, Response
+from quart_cors import cors
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.utils import secure_filename
+import uuid
+import weakref
+import asyncio
+import time
+import logging
+from datetime import datetime
+
+from app import app as flask_app, allowed_file, image_key, thumbnail_key_for, response_cache, object_storage_config, QUEUE_RETRY_AFTER_SECONDS, IMAGE_PROMPT, chat_history_collection, chat_store, chat_system_prompt, retrieval_requested, MONGO_URI, BUCKET_NAME
+from titles import TITLE_PLACEHOLDER, schedule_title, generate_chat_title, generate_image_title
+from streaming import asse_stream, format_event, wait_for_saves, SSE_HEADERS
+from generations import start_generation
+from chat_store import AsyncChatStore
+from chat_context import build_context
+from images import IMAGE_PREPROCESS, preprocess_image, image_messages
+from response_cache import RESPONSE_CACHE_ENABLED, cache_key, areplay_response
+from llm_registry import text_llm, vision_llm
+from object_storage import client_config, NOT_FOUND_CODES
+from scheduler import scheduler, reserved, QueueFull
+from metrics import timed
+from uploads import BufferedUpload
+from startup import startup, DependencyUnavailable, STARTUP_RETRY_SECONDS
+
+# ASGI entry point. /chat and /image are served natively async so every open event
+# stream is a coroutine rather than a blocked worker thread; all other routes are
+# delegated to the existing Flask app unchanged.
+#
+#   uvicorn asgi:application --port 5001
+
+logger = logging.getLogger(__name__)
+
+ASYNC_PATHS = {'/chat', '/image'}
+SAVE_TIMEOUT_SECONDS = 5
+
+quart_app = cors(Quart(__name__), allow_origin="http://localhost:8080")
+# Generations can run for minutes; don't let Quart cut long streams off
+quart_app.config['RESPONSE_TIMEOUT'] = None
+quart_app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+# Async MongoDB connection, opened on first use so importing the entry point stays cheap
+motor_client = None
+async_chat_store = None
+
+s3_session = None
+_s3_clients = {}
+# Concurrent cold-cache requests would each enter a client; only one may build it
+_s3_clients_lock = asyncio.Lock()
+
+# Same dependencies as the Flask routes; the first request may wait for their setup
+ROUTE_DEPENDENCIES = {'/chat': ('mongo', 'llm'), '/image': ('mongo', 'llm', 'object_storage')}
+
+@quart_app.before_request
+async def require_dependencies():
+    dependencies = ROUTE_DEPENDENCIES.get(request.path)
+    if dependencies and request.method != 'OPTIONS' and not startup.is_ready(*dependencies):
+        await asyncio.to_thread(startup.ensure, *dependencies)
+
+@quart_app.errorhandler(DependencyUnavailable)
+async def dependency_unavailable(e):
+    response = jsonify({'error': str(e), 'dependency': e.name})
+    response.headers['Retry-After'] = str(int(STARTUP_RETRY_SECONDS))
+    return response, 503
+
+def get_async_chat_store():
+    global motor_client, async_chat_store
+    if async_chat_store is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        motor_client = AsyncIOMotorClient(MONGO_URI)
+        async_chat_store = AsyncChatStore(motor_client['ai_sandbox_db'])
+    return async_chat_store
+
+async def get_async_s3_client():
+    # Served from the shared config cache; only a miss (once per TTL or after a change) queries Mongo
+    config = object_storage_config()
+    if not config or not config.get("endpoint_url"):
+        raise ValueError("Object storage is not configured")
+    key = (config["endpoint_url"], config["access_key"], config["secret_key"])
+    if key not in _s3_clients:
+        async with _s3_clients_lock:
+            if key not in _s3_clients:
+                global s3_session
+                if s3_session is None:
+                    import aioboto3
+                    s3_session = aioboto3.Session()
+                _s3_clients[key] = await s3_session.client(
+                    's3',
+                    endpoint_url=config["endpoint_url"],
+                    aws_access_key_id=config["access_key"],
+                    aws_secret_access_key=config["secret_key"],
+                    config=client_config()
+                ).__aenter__()
+    return _s3_clients[key], config.get("bucket_name", BUCKET_NAME)
+
+@quart_app.after_serving
+async def close_clients():
+    # Lifespan shutdown runs after uvicorn has cancelled the streams still open; their
+    # partial answers are written through the clients closed below
+    await wait_for_saves(SAVE_TIMEOUT_SECONDS)
+    for client in _s3_clients.values():
+        await client.__aexit__(None, None, None)
+    _s3_clients.clear()
+    if motor_client is not None:
+        motor_client.close()
+
+def queue_full_response(e):
+    logger.warning(f"Rejecting request: {e}")
+    return jsonify({'error': str(e), 'model': e.model, 'queued': e.depth}), 429, {'Retry-After': str(QUEUE_RETRY_AFTER_SECONDS)}
+
+async def object_exists(s3, bucket_name, key):
+    from botocore.exceptions import ClientError
+    try:
+        with timed('s3_request_seconds', operation='head_object'):
+            await s3.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in NOT_FOUND_CODES:
+            raise
+        return False
+
+async def store_image(s3, bucket_name, key, upload, thumbnail_key=None, processed=None):
+    # Content-addressed keys: an existing object means this image is already stored. The
+    # thumbnail is checked on its own, like upload_in_background does.
+    # Releases the caller's reference on the upload when done.
+    try:
+        if await object_exists(s3, bucket_name, key):
+            logger.info(f"{key} already stored in bucket {bucket_name}, skipping upload")
+        else:
+            with upload.open() as body, timed('s3_request_seconds', operation='upload'):
+                await s3.put_object(Bucket=bucket_name, Key=key, Body=body, ContentLength=upload.size)
+            logger.info(f"Uploaded {key} to bucket {bucket_name}")
+        if thumbnail_key and not await object_exists(s3, bucket_name, thumbnail_key):
+            with timed('s3_request_seconds', operation='put_object'):
+                await s3.put_object(Bucket=bucket_name, Key=thumbnail_key, Body=processed.thumbnail, ContentType='image/jpeg')
+    finally:
+        upload.release()
+
+async def update_chat_history(chat_id, message, title=None):
+    try:
+        logger.debug(f"Updating chat history for chat_id: {chat_id}, message: {message}, title: {title}")
+        return await get_async_chat_store().append_message(chat_id, message, title or "Untitled")
+    except Exception as e:
+        logger.error(f"Error updating chat history: {e}")
+        raise
+
+async def save_ai_response(chat_id, text, truncated=False):
+    content = text.strip()
+    if not content:
+        return
+    message = {
+        'role': 'ai',
+        'content': content,
+        'timestamp': datetime.utcnow()
+    }
+    if truncated:
+        message['truncated'] = True
+    try:
+        await update_chat_history(chat_id, message)
+    except Exception as e:
+        logger.error(f"Error saving AI response: {e}")
+        yield format_event(f"Error saving AI response: {e}", event='error')
+
+async def stream_response(llm, messages, chat_id, endpoint, started, ticket, key=None, storage_upload=None, on_close=None):
+    # The cache's Mongo tier is synchronous; keep it off the event loop
+    cached = await asyncio.to_thread(response_cache.get, key) if key else None
+    generation_started = time.perf_counter()
+    deltas = areplay_response(cached) if cached is not None else await llm.astream_chat(messages)
+
+    async def on_complete(text, truncated):
+        if key and cached is None and text and not truncated:
+            await asyncio.to_thread(response_cache.put, key, text, llm.model, time.perf_counter() - generation_started)
+        async for frame in save_ai_response(chat_id, text, truncated):
+            yield frame
+        if storage_upload is not None:
+            try:
+                await storage_upload
+            except Exception as e:
+                logger.error(f"Error uploading to storage: {e}")
+                yield format_event(f"Error uploading image to storage: {e}", event='error')
+
+    if cached is not None:
+        # A replayed answer doesn't need a model slot
+        ticket.close()
+    generation = start_generation(chat_id, endpoint)
+    body = asse_stream(deltas, on_complete, endpoint, started, generation, ticket if cached is None else None)
+    if on_close is not None:
+        # Runs once the stream is finished or dropped (Quart has no call_on_close)
+        weakref.finalize(body, on_close)
+    return Response(
+        body,
+        mimetype='text/event-stream',
+        headers={**SSE_HEADERS, 'X-Generation-Id': generation.id}
+    )
+
+@quart_app.route('/chat', methods=['POST'])
+async def chat():
+    started = time.perf_counter()
+    form = await request.form
+    user_input = form.get('message')
+    chat_id = form.get('chat_id', str(uuid.uuid4()))
+    try:
+        ticket = scheduler.admit(text_llm().model)
+    except QueueFull as e:
+        return queue_full_response(e)
+
+    with reserved(ticket):
+        created = await update_chat_history(chat_id, {
+            'role': 'user',
+            'content': user_input,
+            'timestamp': datetime.utcnow()
+        }, TITLE_PLACEHOLDER)
+        if created:
+            schedule_title(chat_history_collection, chat_id, generate_chat_title, text_llm(), user_input)
+
+        system_prompt = await asyncio.to_thread(chat_system_prompt, user_input, retrieval_requested(form), chat_id)
+        messages = await asyncio.to_thread(build_context, chat_store, text_llm(), chat_id, system_prompt, user_input)
+        key = None
+        if RESPONSE_CACHE_ENABLED or form.get('cache', '').lower() == 'true':
+            conversation = "\n".join(f"{m.role.value}: {m.content}" for m in messages[1:])
+            key = cache_key(text_llm().model, system_prompt, conversation)
+        return await stream_response(text_llm(), messages, chat_id, 'chat', started, ticket, key)
+
+@quart_app.route('/image', methods=['POST'])
+async def upload_image():
+    started = time.perf_counter()
+    files = await request.files
+    form = await request.form
+    if 'file' not in files:
+        return jsonify({'error': 'No file part'}), 400
+    file = files['file']
+    if file.filename == '' or not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file'}), 400
+
+    try:
+        ticket = scheduler.admit(vision_llm().model)
+    except QueueFull as e:
+        return queue_full_response(e)
+
+    with reserved(ticket):
+        filename = secure_filename(file.filename)
+        # Read once, in chunks, like the WSGI route; large images spill to a temp file
+        upload = await asyncio.to_thread(BufferedUpload, file, flask_app.config['UPLOAD_FOLDER'])
+        upload.acquire()
+        content_hash = upload.sha256
+        chat_id = form.get('chat_id', str(uuid.uuid4()))
+
+        processed = None
+        if IMAGE_PREPROCESS:
+            try:
+                processed = await asyncio.to_thread(preprocess_image, upload.data if upload.data is not None else upload.path)
+            except Exception as e:
+                logger.warning(f"Could not preprocess {filename}, sending it unchanged: {e}")
+
+        try:
+            s3, bucket_name = await get_async_s3_client()
+            minio_key = image_key(chat_id, content_hash, filename)
+            thumbnail_key = thumbnail_key_for(minio_key) if processed and processed.thumbnail else None
+            # Upload alongside inference; the stream reports a failure before [DONE]
+            upload.acquire()
+            storage_upload = asyncio.create_task(store_image(s3, bucket_name, minio_key, upload, thumbnail_key, processed))
+        except Exception as e:
+            logger.error(f"Error uploading to storage: {e}")
+            upload.release()
+            ticket.abandon()
+            return jsonify({'error': f"Failed to upload to storage: {e}"}), 500
+
+        message_data = {
+            'role': 'user',
+            'content': f"Uploaded image: {filename}",
+            'minio_key': minio_key,
+            'content_hash': content_hash,
+            'timestamp': datetime.utcnow()
+        }
+        if thumbnail_key:
+            message_data['thumbnail_key'] = thumbnail_key
+        try:
+            created = await update_chat_history(chat_id, message_data, TITLE_PLACEHOLDER)
+            if created:
+                schedule_title(chat_history_collection, chat_id, generate_image_title, text_llm(), filename)
+
+            ollama_image_settings = vision_llm()
+            if processed:
+                messages = image_messages(IMAGE_PROMPT, processed.data)
+            else:
+                messages = image_messages(IMAGE_PROMPT, upload.data, upload.path)
+            key = None
+            if RESPONSE_CACHE_ENABLED or form.get('cache', '').lower() == 'true':
+                key = cache_key(ollama_image_settings.model, IMAGE_PROMPT, "", content_hash)
+            return await stream_response(ollama_image_settings, messages, chat_id, 'image', started, ticket, key, storage_upload, upload.release)
+        except BaseException:
+            upload.release()
+            raise
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan' or scope.get('path') in ASYNC_PATHS:
+        await quart_app(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, port=5001)
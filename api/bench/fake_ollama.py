@@ -0,0 +1,190 @@
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Stand-in for an Ollama server. It speaks the parts of the API the app uses (/api/chat
+# streamed and not, /api/generate for warm-up, /api/tags and /api/ps for the router's
+# health checks, /api/show, /api/embed) and answers with canned text at a fixed token
+# rate, so benchmark numbers measure the API rather than a GPU.
+#
+#   python -m bench.fake_ollama --port 11435 --tokens-per-second 40
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while benchmarks measure latency "
+    "throughput and memory of every request sent through the api server"
+).split()
+EMBED_DIMENSIONS = 768
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeOllama:
+    def __init__(self, host='127.0.0.1', port=11435, tokens_per_second=50.0, first_token_ms=200.0,
+                 response_tokens=64, models=('qwen2.5:7b', 'llama3.2-vision:latest', 'nomic-embed-text:latest')):
+        self.tokens_per_second = tokens_per_second
+        self.first_token_seconds = first_token_ms / 1000.0
+        self.response_tokens = response_tokens
+        self.models = list(models)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-ollama', daemon=True)
+        self._thread.start()
+        logger.info(f"Fake Ollama listening on {self.url} ({self.tokens_per_second:g} tokens/s)")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def tokens(self):
+        return [random.choice(WORDS) + ' ' for _ in range(self.response_tokens)]
+
+    def _model_entry(self, name):
+        return {
+            'name': name,
+            'model': name,
+            'modified_at': _now(),
+            'size': 0,
+            'digest': 'fake',
+            'details': {'format': 'gguf', 'family': 'fake', 'parameter_size': '0B', 'quantization_level': 'none'}
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _chunk(self, payload):
+                data = json.dumps(payload).encode() + b'\n'
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path == '/api/tags':
+                    return self._json({'models': [fake._model_entry(name) for name in fake.models]})
+                if self.path == '/api/ps':
+                    return self._json({'models': [fake._model_entry(name) for name in fake.models]})
+                if self.path == '/api/version':
+                    return self._json({'version': '0.0.0-fake'})
+                self._json({'error': 'not found'}, 404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                body = self._body()
+                with fake._lock:
+                    fake.requests += 1
+                if self.path == '/api/chat':
+                    return self.chat(body)
+                if self.path == '/api/generate':
+                    # Warm-up requests send an empty prompt
+                    return self._json({'model': body.get('model'), 'created_at': _now(), 'response': '', 'done': True})
+                if self.path == '/api/show':
+                    return self._json({'modelfile': '', 'parameters': '', 'template': '', 'details': {}, 'model_info': {'fake.context_length': 32768}})
+                if self.path in ('/api/embed', '/api/embeddings'):
+                    inputs = body.get('input', body.get('prompt', ''))
+                    count = len(inputs) if isinstance(inputs, list) else 1
+                    vectors = [[random.random() for _ in range(EMBED_DIMENSIONS)] for _ in range(count)]
+                    if self.path == '/api/embeddings':
+                        return self._json({'embedding': vectors[0]})
+                    return self._json({'model': body.get('model'), 'embeddings': vectors})
+                self._json({'error': 'not found'}, 404)
+
+            def chat(self, body):
+                model = body.get('model')
+                tokens = fake.tokens()
+                started = time.perf_counter()
+                time.sleep(fake.first_token_seconds)
+                interval = 1.0 / fake.tokens_per_second if fake.tokens_per_second > 0 else 0.0
+                final = {
+                    'model': model,
+                    'created_at': _now(),
+                    'message': {'role': 'assistant', 'content': ''},
+                    'done': True,
+                    'done_reason': 'stop',
+                    'prompt_eval_count': sum(len(str(m.get('content', '')).split()) for m in body.get('messages', [])),
+                    'eval_count': len(tokens)
+                }
+                if body.get('stream', True) is False:
+                    time.sleep(interval * len(tokens))
+                    final['message']['content'] = ''.join(tokens)
+                    final['total_duration'] = final['eval_duration'] = int((time.perf_counter() - started) * 1e9)
+                    return self._json(final)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    generation_started = time.perf_counter()
+                    for index, token in enumerate(tokens):
+                        if index:
+                            # Paced against the start so the rate holds under load
+                            time.sleep(max(0.0, generation_started + index * interval - time.perf_counter()))
+                        self._chunk({'model': model, 'created_at': _now(), 'message': {'role': 'assistant', 'content': token}, 'done': False})
+                    final['eval_duration'] = int((time.perf_counter() - generation_started) * 1e9)
+                    final['total_duration'] = int((time.perf_counter() - started) * 1e9)
+                    self._chunk(final)
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The API closed the stream (client gone or generation cancelled)
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Ollama API for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--first-token-ms', type=float, default=200.0)
+    parser.add_argument('--response-tokens', type=int, default=64)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeOllama(args.host, args.port, args.tokens_per_second, args.first_token_ms, args.response_tokens).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import socket
+import struct
+import signal
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from contextlib import nullcontext
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Histogram
+from bench.fake_ollama import FakeOllama
+
+logger = logging.getLogger(__name__)
+
+# Replays a JSONL corpus of /chat, /image and /history requests against the API at a
+# fixed concurrency and reports time to first token, total latency, throughput and
+# server memory. By default everything runs locally: a fake Ollama that streams tokens
+# at a set rate (fake_ollama.py), moto as S3 and the app served with mongomock
+# (serve.py). --mongo-uri runs the production gunicorn config against a real mongod,
+# --s3-endpoint uses a local MinIO and --target benchmarks an API that is already up.
+#
+#   cd api && python -m bench.run --concurrency 8 --rounds 3 --output results.json
+#   python -m bench.run --baseline results.json   # exits 1 on a regression
+#
+# Each line of the corpus is one request:
+#   {"endpoint": "chat", "message": "...", "chat_id": "session-1"}
+#   {"endpoint": "image", "file": "photo.jpg"}   (or "size": 256 for a generated PNG)
+#   {"endpoint": "history", "chat_id": "session-1"}   (without chat_id: the chat list)
+# Chat ids are scoped to the run; requests without one start a new chat. The corpus is
+# replayed once as warm-up (which also creates the chats history requests read), then
+# --rounds times measured.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_CORPUS = os.path.join(BENCH_DIR, 'corpus.jsonl')
+BENCH_BUCKET = 'ai-sandbox-bench'
+READY_TIMEOUT_SECONDS = 120
+MEMORY_SAMPLE_SECONDS = 0.25
+STREAMING_ENDPOINTS = ('chat', 'image')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sample_png(size):
+    # A gradient, so the image isn't trivially compressible
+    rows = b''.join(b'\x00' + b''.join(bytes((x * 255 // size, y * 255 // size, 128)) for x in range(size)) for y in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def load_corpus(path, run_id):
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    with open(path) as corpus:
+        for number, line in enumerate(corpus, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            entry = json.loads(line)
+            endpoint = entry.get('endpoint')
+            if endpoint not in STREAMING_ENDPOINTS + ('history',):
+                raise ValueError(f"{path}:{number}: unknown endpoint {endpoint!r}")
+            if entry.get('chat_id'):
+                entry['chat_id'] = f"bench-{run_id}-{entry['chat_id']}"
+            if endpoint == 'image':
+                if entry.get('file'):
+                    with open(os.path.join(base, entry['file']), 'rb') as image:
+                        entry['data'] = image.read()
+                    entry['filename'] = os.path.basename(entry['file'])
+                else:
+                    entry['data'] = sample_png(int(entry.get('size', 256)))
+                    entry['filename'] = 'bench.png'
+            entries.append(entry)
+    if not entries:
+        raise ValueError(f"{path} has no requests")
+    return entries
+
+
+class Client:
+    # One keep-alive connection per thread
+    def __init__(self, url, timeout=300):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    def request(self, method, path, body=None, headers=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            return connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # Stale keep-alive connection; retry once on a new one
+            connection.close()
+            self._local.connection = None
+            connection = self._connection()
+            connection.request(method, path, body=body, headers=headers or {})
+            return connection.getresponse()
+
+    def send(self, entry):
+        # Returns (status, seconds to first token or None, total seconds, bytes received, error)
+        endpoint = entry['endpoint']
+        started = time.perf_counter()
+        if endpoint == 'history':
+            query = {'chat_id': entry['chat_id']} if entry.get('chat_id') else {}
+            query.update(entry.get('params', {}))
+            response = self.request('GET', '/history' + (f'?{urlencode(query)}' if query else ''))
+            body = response.read()
+            error = None if response.status == 200 else body[:200].decode(errors='replace')
+            return response.status, None, time.perf_counter() - started, len(body), error
+
+        fields = {'chat_id': entry.get('chat_id') or f"bench-{uuid.uuid4()}"}
+        files = {}
+        if endpoint == 'chat':
+            fields['message'] = entry['message']
+            for option in ('rag', 'cache'):
+                if option in entry:
+                    fields[option] = str(entry[option]).lower()
+        else:
+            files['file'] = (entry['filename'], entry['data'])
+        body, content_type = _multipart(fields, files)
+        response = self.request('POST', f'/{endpoint}', body=body, headers={'Content-Type': content_type})
+        if response.status != 200:
+            body = response.read()
+            return response.status, None, time.perf_counter() - started, len(body), body[:200].decode(errors='replace')
+
+        first_token, received, event, error = None, 0, None, None
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            received += len(line)
+            line = line.decode().rstrip('\r\n')
+            if line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:'):
+                data = line[5:].strip()
+                if event == 'error':
+                    error = data
+                elif event is None and data != '[DONE]' and first_token is None:
+                    first_token = time.perf_counter() - started
+            elif not line:
+                event = None
+        return response.status, first_token, time.perf_counter() - started, received, error
+
+
+def _process_tree(pid):
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def rss_bytes(pid):
+    # Resident memory of the server and its workers (Linux only)
+    total = 0
+    for process in _process_tree(pid):
+        try:
+            with open(f'/proc/{process}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total or None
+
+
+class MemorySampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = rss_bytes(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(MEMORY_SAMPLE_SECONDS)
+
+    def __enter__(self):
+        if self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pid:
+            self._stop.set()
+            self._thread.join()
+        return False
+
+    def summary(self):
+        if not self.samples:
+            return None
+        mb = 1024 * 1024
+        return {'start_mb': round(self.samples[0] / mb, 1), 'peak_mb': round(max(self.samples) / mb, 1), 'end_mb': round(self.samples[-1] / mb, 1)}
+
+
+def replay(client, entries, concurrency, rounds):
+    results = []
+    lock = threading.Lock()
+
+    def run(entry):
+        try:
+            status, first_token, total, received, error = client.send(entry)
+        except Exception as e:
+            status, first_token, total, received, error = None, None, None, 0, str(e)
+        with lock:
+            results.append({'endpoint': entry['endpoint'], 'status': status, 'ttft': first_token, 'total': total, 'bytes': received, 'error': error})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench') as executor:
+        list(executor.map(run, [entry for _ in range(rounds) for entry in entries]))
+    return results, time.perf_counter() - started
+
+
+def _percentiles(values):
+    histogram = Histogram('bench', window=None)
+    for value in values:
+        histogram.observe(value)
+    if not histogram.count:
+        return None
+    return {f'p{pct}': round(histogram.percentile(pct) * 1000, 1) for pct in (50, 95, 99)}
+
+
+def summarize(results, elapsed, memory):
+    report = {'elapsed_seconds': round(elapsed, 2), 'requests': len(results), 'throughput_rps': round(len(results) / elapsed, 2), 'endpoints': {}, 'memory': memory}
+    for endpoint in sorted({result['endpoint'] for result in results}):
+        rows = [result for result in results if result['endpoint'] == endpoint]
+        ok = [row for row in rows if row['error'] is None and row['status'] == 200]
+        errors = {}
+        for row in rows:
+            if row not in ok:
+                errors[str(row['status'])] = errors.get(str(row['status']), 0) + 1
+        report['endpoints'][endpoint] = {
+            'requests': len(rows),
+            'errors': errors,
+            'throughput_rps': round(len(ok) / elapsed, 2),
+            'ttft_ms': _percentiles([row['ttft'] for row in ok if row['ttft'] is not None]),
+            'total_ms': _percentiles([row['total'] for row in ok]),
+            'bytes_per_request': round(sum(row['bytes'] for row in ok) / len(ok)) if ok else None
+        }
+        for row in rows:
+            if row not in ok:
+                logger.warning(f"/{endpoint} failed with {row['status']}: {row['error']}")
+                break
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['requests']} requests in {report['elapsed_seconds']}s ({report['throughput_rps']} req/s)")
+    print(f"{'endpoint':<10}{'ok':>6}{'errors':>8}{'req/s':>8}{'ttft p50/p95/p99 ms':>24}{'total p50/p95/p99 ms':>26}")
+    for endpoint, stats in report['endpoints'].items():
+        errors = sum(stats['errors'].values())
+        ttft = '/'.join(str(stats['ttft_ms'][p]) for p in ('p50', 'p95', 'p99')) if stats['ttft_ms'] else '-'
+        total = '/'.join(str(stats['total_ms'][p]) for p in ('p50', 'p95', 'p99')) if stats['total_ms'] else '-'
+        print(f"{endpoint:<10}{stats['requests'] - errors:>6}{errors:>8}{stats['throughput_rps']:>8}{ttft:>24}{total:>26}")
+    memory = report['memory']
+    if memory:
+        print(f"server memory: {memory['start_mb']} MB at start, {memory['peak_mb']} MB peak, {memory['end_mb']} MB at end")
+
+
+def compare(report, baseline, tolerance):
+    # Latency percentiles may grow and throughput may drop by `tolerance` (a fraction)
+    regressions = []
+    for endpoint, stats in report['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(endpoint)
+        if not previous:
+            continue
+        for metric in ('ttft_ms', 'total_ms'):
+            for pct in ('p50', 'p95', 'p99'):
+                if stats.get(metric) and previous.get(metric) and stats[metric][pct] > previous[metric][pct] * (1 + tolerance):
+                    regressions.append(f"/{endpoint} {metric} {pct}: {previous[metric][pct]} -> {stats[metric][pct]}")
+        if previous.get('throughput_rps') and stats['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"/{endpoint} throughput: {previous['throughput_rps']} -> {stats['throughput_rps']} req/s")
+        if sum(stats['errors'].values()) > sum(previous.get('errors', {}).values()):
+            regressions.append(f"/{endpoint} errors: {previous.get('errors', {})} -> {stats['errors']}")
+    if report.get('memory') and baseline.get('memory') and report['memory']['peak_mb'] > baseline['memory']['peak_mb'] * (1 + tolerance):
+        regressions.append(f"peak memory: {baseline['memory']['peak_mb']} -> {report['memory']['peak_mb']} MB")
+    return regressions
+
+
+class LocalStack:
+    # Fake Ollama, S3 and the API server, started and stopped together
+    def __init__(self, args):
+        self.args = args
+        self.fake_ollama = None
+        self.s3_server = None
+        self.server = None
+        self.url = None
+        self.log = None
+
+    def __enter__(self):
+        args = self.args
+        self.fake_ollama = FakeOllama(port=0, tokens_per_second=args.tokens_per_second, first_token_ms=args.first_token_ms,
+                                      response_tokens=args.response_tokens).start()
+        if args.s3_endpoint:
+            s3 = {'endpoint_url': args.s3_endpoint, 'access_key': args.s3_access_key, 'secret_key': args.s3_secret_key}
+        else:
+            from moto.server import ThreadedMotoServer
+            port = _free_port()
+            self.s3_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+            self.s3_server.start()
+            s3 = {'endpoint_url': f'http://127.0.0.1:{port}', 'access_key': 'bench', 'secret_key': 'bench'}
+
+        port = _free_port()
+        self.url = f'http://127.0.0.1:{port}'
+        env = {
+            **os.environ,
+            'OLLAMA_HOST': self.fake_ollama.url,
+            'OLLAMA_HOSTS': '',
+            'STARTUP_RETRY_SECONDS': '0.5',
+            # Settings saved below reach every worker quickly
+            'CONFIG_CACHE_TTL_SECONDS': '1',
+            'CONFIG_CACHE_WATCH': 'false'
+        }
+        if args.mongo_uri:
+            env.update({'MONGODB_URI': args.mongo_uri, 'API_BIND': f'127.0.0.1:{port}', 'API_SERVER': args.server, 'WEB_CONCURRENCY': str(args.workers)})
+            command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py']
+        else:
+            command = [sys.executable, '-m', 'bench.serve', '--port', str(port)]
+        self.log = tempfile.NamedTemporaryFile(prefix='bench-server-', suffix='.log', delete=False)
+        logger.info(f"Starting the API on {self.url} (log: {self.log.name})")
+        self.server = subprocess.Popen(command, cwd=API_DIR, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        try:
+            self._wait_until_up(s3)
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def _wait_until_up(self, s3):
+        client = Client(self.url, timeout=10)
+        deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+        configured, ready_streak = False, 0
+        while ready_streak < max(3, self.args.workers * 2):
+            if self.server.poll() is not None:
+                raise RuntimeError(f"API server exited with {self.server.returncode}, see {self.log.name}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"API server not ready after {READY_TIMEOUT_SECONDS}s, see {self.log.name}")
+            try:
+                if not configured:
+                    response = client.request('POST', '/object-storage', body=json.dumps({**s3, 'bucket_name': BENCH_BUCKET}),
+                                              headers={'Content-Type': 'application/json'})
+                    response.read()
+                    configured = response.status == 200
+                else:
+                    response = client.request('GET', '/health/ready')
+                    response.read()
+                    ready_streak = ready_streak + 1 if response.status == 200 else 0
+            except OSError:
+                pass
+            time.sleep(0.5)
+
+    def __exit__(self, *exc_info):
+        if self.server is not None and self.server.poll() is None:
+            self.server.send_signal(signal.SIGTERM)
+            try:
+                self.server.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+        if self.s3_server is not None:
+            self.s3_server.stop()
+        if self.fake_ollama is not None:
+            self.fake_ollama.stop()
+        if self.log is not None:
+            self.log.close()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a request corpus against the API and report latency percentiles')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3, help='Measured passes over the corpus')
+    parser.add_argument('--warmup-rounds', type=int, default=1)
+    parser.add_argument('--target', help='URL of a running API; no local stand-ins are started')
+    parser.add_argument('--pid', type=int, help='Server process to sample memory from (with --target)')
+    parser.add_argument('--mongo-uri', help='Use this MongoDB and serve with gunicorn instead of mongomock')
+    parser.add_argument('--server', choices=('asgi', 'wsgi'), default='asgi', help='gunicorn worker type (with --mongo-uri)')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers (with --mongo-uri)')
+    parser.add_argument('--s3-endpoint', help='Use this S3/MinIO endpoint instead of moto')
+    parser.add_argument('--s3-access-key', default='minioadmin')
+    parser.add_argument('--s3-secret-key', default='minioadmin')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--first-token-ms', type=float, default=200.0)
+    parser.add_argument('--response-tokens', type=int, default=64)
+    parser.add_argument('--output', help='Write the report as JSON')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression against the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    entries = load_corpus(args.corpus, uuid.uuid4().hex[:8])
+    with nullcontext() if args.target else LocalStack(args) as stack:
+        url = args.target or stack.url
+        pid = args.pid if args.target else stack.server.pid
+        client = Client(url)
+        if args.warmup_rounds:
+            logger.info(f"Warming up with {len(entries) * args.warmup_rounds} requests")
+            replay(client, entries, args.concurrency, args.warmup_rounds)
+        logger.info(f"Replaying {len(entries) * args.rounds} requests at concurrency {args.concurrency}")
+        with MemorySampler(pid) as memory:
+            results, elapsed = replay(client, entries, args.concurrency, args.rounds)
+
+    report = summarize(results, elapsed, memory.summary())
+    report['settings'] = {key: getattr(args, key) for key in ('concurrency', 'rounds', 'tokens_per_second', 'first_token_ms', 'response_tokens', 'server', 'workers')}
+    report['settings']['mongo'] = 'mongod' if args.mongo_uri else ('external' if args.target else 'mongomock')
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)
+        if baseline.get('settings') != report['settings']:
+            logger.warning(f"The baseline ran with different settings: {baseline.get('settings')}")
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
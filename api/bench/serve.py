@@ -0,0 +1,29 @@
+import logging
+import argparse
+import mongomock
+import pymongo
+
+# Serves the Flask app on a threaded WSGI server with an in-memory mongomock database
+# instead of MongoDB, for benchmarks on machines without a mongod. MongoClient has to be
+# swapped before the app is imported. Against a real mongod, run.py starts gunicorn with
+# the production config instead.
+#
+#   python -m bench.serve --port 5077
+pymongo.MongoClient = mongomock.MongoClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the API with an in-memory MongoDB')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5077)
+    args = parser.parse_args()
+
+    from werkzeug.serving import make_server
+    from app import app
+    # Request logs would dominate the benchmark's own output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+import io
+import os
+import time
+import uuid
+import shutil
+import socket
+import tarfile
+import logging
+import mimetypes
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+# Bulk export/import and archival of chat history.
+#
+# Chats are exported as NDJSON, one chat per line with its messages embedded, in BSON
+# extended JSON so timestamps survive the round trip. Export reads chats in cursor
+# batches and import writes one insert_many per batch, so neither holds more than a
+# batch in memory whatever the size of the collection.
+#
+# Chats without a new message for CHAT_ARCHIVE_AFTER_DAYS are moved out of Mongo and
+# into one gzipped tar per chat (archive/chats/{chat_id}.tar.gz in the bucket) along
+# with their images/{chat_id}/ objects, keeping the hot collection small. A restore
+# puts both back, and the restored chat isn't archived again for another
+# CHAT_ARCHIVE_AFTER_DAYS (`restored_at`). The archive is only deleted once the chat is
+# back in Mongo; a chat that exists again under the same id is left alone (ChatExists).
+# Uploaded documents stay where they are (and in the search index).
+# With CHAT_ARCHIVE_AFTER_DAYS set, every CHAT_ARCHIVE_INTERVAL_HOURS one worker, holding
+# a lease in the `jobs` collection, runs the archival. Cold chats are read one page at a
+# time (a fresh query per page, so no cursor can time out during a long run) and the
+# lease is renewed after every page; a run that loses its lease stops.
+CHAT_ARCHIVE_AFTER_DAYS = float(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '0'))  # 0 disables the scheduled job
+CHAT_ARCHIVE_INTERVAL = float(os.getenv('CHAT_ARCHIVE_INTERVAL_HOURS', '24')) * 3600
+CHAT_EXPORT_BATCH_SIZE = int(os.getenv('CHAT_EXPORT_BATCH_SIZE', '500'))
+ARCHIVE_PREFIX = 'archive/chats/'
+# Archives larger than this are spooled to disk while they're built or read
+ARCHIVE_SPOOL_BYTES = 16 * 1024 * 1024
+ARCHIVE_LEASE_SECONDS = 3600
+ARCHIVE_JOB = 'chat-archive'
+CHAT_ENTRY = 'chat.ndjson'
+
+
+class ChatExists(Exception):
+    def __init__(self, chat_id):
+        super().__init__(f"Chat {chat_id} already exists; its archive was kept")
+        self.chat_id = chat_id
+
+
+def to_ndjson(chats):
+    for chat in chats:
+        yield json_util.dumps(chat, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n'
+
+
+def from_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            chat = json_util.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {e}") from e
+        if not isinstance(chat, dict) or not chat.get('chat_id'):
+            raise ValueError(f"Line {number} is not a chat (no chat_id)")
+        yield chat
+
+
+def cold_chats_query(older_than_days):
+    # Timestamps are stored as naive UTC
+    return {'last_message_at': {'$lt': datetime.utcnow() - timedelta(days=older_than_days)}}
+
+
+def archivable_chats_query(older_than_days):
+    # Cold chats that weren't restored within the same period ($not also matches chats
+    # that were never restored)
+    query = cold_chats_query(older_than_days)
+    query['restored_at'] = {'$not': {'$gte': query['last_message_at']['$lt']}}
+    return query
+
+
+def archive_key(chat_id):
+    return f"{ARCHIVE_PREFIX}{chat_id}.tar.gz"
+
+
+def _add_entry(tar, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    tar.addfile(info, fileobj)
+
+
+class ChatArchiver:
+    def __init__(self, store, storage, bucket_source, jobs):
+        # `bucket_source()` returns the current bucket name; `jobs` holds the job lease
+        self.store = store
+        self.storage = storage
+        self.bucket_source = bucket_source
+        self.jobs = jobs
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._scheduler_started = False
+        self._lock = threading.Lock()
+
+    def export(self, query=None, batch_size=CHAT_EXPORT_BATCH_SIZE):
+        return to_ndjson(self.store.iter_chats(query, batch_size=batch_size))
+
+    def import_ndjson(self, lines, batch_size=CHAT_EXPORT_BATCH_SIZE):
+        return self.store.import_chats(from_ndjson(lines), batch_size=batch_size)
+
+    def archive_chat(self, chat, bucket_name):
+        # Returns the number of images archived, or None if the chat stays hot
+        chat_id = chat['chat_id']
+        key = archive_key(chat_id)
+        image_prefix = f"images/{chat_id}/"
+        images = 0
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES) as spool:
+            with tarfile.open(fileobj=spool, mode='w:gz') as tar:
+                data = ''.join(to_ndjson([chat])).encode('utf-8')
+                _add_entry(tar, CHAT_ENTRY, io.BytesIO(data), len(data))
+                for image_key, size in self.storage.list_objects(bucket_name, image_prefix):
+                    body = self.storage.open_object(bucket_name, image_key)
+                    try:
+                        _add_entry(tar, image_key, body, size)
+                    finally:
+                        body.close()
+                    images += 1
+            spool.seek(0)
+            self.storage.upload_fileobj(spool, bucket_name, key, content_type='application/gzip')
+
+        # The archive is stored before anything is deleted. A chat that got a message in
+        # the meantime isn't deleted and its archive is dropped again.
+        if not self.store.delete_chat(chat_id, chat.get('last_message_at')).deleted_count:
+            if self.store.chats.count_documents({'chat_id': chat_id}, limit=1):
+                self.storage.delete_object(bucket_name, key)
+                logger.info(f"Chat {chat_id} became active while it was archived; keeping it")
+            return None
+        if images:
+            self.storage.delete_prefix(bucket_name, image_prefix)
+        return images
+
+    def archive(self, older_than_days, batch_size=CHAT_EXPORT_BATCH_SIZE, dry_run=False, renew=None):
+        # `renew()` is called after every page and returns False once the run should stop
+        query = archivable_chats_query(older_than_days)
+        if dry_run:
+            return {'cold_chats': self.store.chats.count_documents(query)}
+        bucket_name = self.bucket_source()
+        stats = {'archived': 0, 'images': 0, 'kept': 0, 'failed': 0}
+        after = None
+        while True:
+            page = self.store.chat_page(query, after, batch_size)
+            for chat in page:
+                try:
+                    images = self.archive_chat(chat, bucket_name)
+                except Exception as e:
+                    logger.error(f"Error archiving chat {chat['chat_id']}: {e}")
+                    stats['failed'] += 1
+                    continue
+                if images is None:
+                    stats['kept'] += 1
+                else:
+                    stats['archived'] += 1
+                    stats['images'] += images
+            if len(page) < batch_size:
+                break
+            after = page[-1]['_id']
+            if renew is not None and not renew():
+                logger.warning("Lost the chat archive lease; stopping this run")
+                stats['stopped'] = True
+                break
+        logger.info(f"Archived {stats['archived']} chats older than {older_than_days:g} days ({stats['images']} images, {stats['failed']} failed)")
+        return stats
+
+    def restore(self, chat_id):
+        # Returns the import stats, or None if the chat has no archive. Raises ChatExists
+        # if the chat is in Mongo again.
+        bucket_name = self.bucket_source()
+        key = archive_key(chat_id)
+        if not self.storage.exists(bucket_name, key):
+            return None
+        if self.store.chats.count_documents({'chat_id': chat_id}, limit=1):
+            raise ChatExists(chat_id)
+        chats = []
+        images = 0
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES) as spool:
+            body = self.storage.open_object(bucket_name, key)
+            try:
+                shutil.copyfileobj(body, spool)
+            finally:
+                body.close()
+            spool.seek(0)
+            with tarfile.open(fileobj=spool, mode='r:gz') as tar:
+                for member in tar:
+                    if member.name == CHAT_ENTRY:
+                        chats = list(from_ndjson(tar.extractfile(member)))
+                    elif member.isfile() and member.name.startswith(f"images/{chat_id}/"):
+                        # Images go back first so the restored chat never points at a missing one
+                        self.storage.upload_fileobj(tar.extractfile(member), bucket_name, member.name,
+                                                    content_type=mimetypes.guess_type(member.name)[0])
+                        images += 1
+        restored_at = datetime.utcnow()
+        for chat in chats:
+            chat['restored_at'] = restored_at
+        stats = self.store.import_chats(chats)
+        if not stats['imported']:
+            # Created or restored elsewhere while the archive was read
+            raise ChatExists(chat_id)
+        stats['images'] = images
+        self.storage.delete_object(bucket_name, key)
+        logger.info(f"Restored chat {chat_id} from {key} ({images} images)")
+        return stats
+
+    def _acquire(self, scheduled):
+        # One run at a time across workers; scheduled runs also wait for their turn.
+        # Returns the lease id, or None if another run holds the lease.
+        now = datetime.utcnow()
+        # The job document is created once; its lease is then only ever taken by a
+        # conditional update, so at most one caller can match an expired lease
+        self.jobs.update_one({'_id': ARCHIVE_JOB}, {'$setOnInsert': {'created_at': now}}, upsert=True)
+        query = {'_id': ARCHIVE_JOB, '$or': [{'lease_until': {'$lt': now}}, {'lease_until': {'$exists': False}}]}
+        lease = str(uuid.uuid4())
+        update = {'lease_until': now + timedelta(seconds=ARCHIVE_LEASE_SECONDS), 'lease': lease, 'owner': self.owner}
+        if scheduled:
+            query = {'$and': [query, {'$or': [{'next_run_at': {'$lte': now}}, {'next_run_at': {'$exists': False}}]}]}
+            update['next_run_at'] = now + timedelta(seconds=CHAT_ARCHIVE_INTERVAL)
+        if not self.jobs.update_one(query, {'$set': update}).matched_count:
+            return None
+        return lease
+
+    def _renew(self, lease):
+        # Extends the lease only while this run still holds it
+        now = datetime.utcnow()
+        result = self.jobs.update_one(
+            {'_id': ARCHIVE_JOB, 'lease': lease, 'lease_until': {'$gt': now}},
+            {'$set': {'lease_until': now + timedelta(seconds=ARCHIVE_LEASE_SECONDS)}}
+        )
+        return result.matched_count == 1
+
+    def run(self, older_than_days, scheduled=False):
+        # Returns the run's stats, or None if another run holds the lease
+        lease = self._acquire(scheduled)
+        if lease is None:
+            return None
+        return self._run_leased(older_than_days, lease)
+
+    def run_in_background(self, older_than_days):
+        # Returns False if another run holds the lease
+        lease = self._acquire(False)
+        if lease is None:
+            return False
+        threading.Thread(target=self._run_leased, args=(older_than_days, lease), name='chat-archive-run', daemon=True).start()
+        return True
+
+    def _run_leased(self, older_than_days, lease):
+        started = datetime.utcnow()
+        stats = None
+        try:
+            stats = self.archive(older_than_days, renew=lambda: self._renew(lease))
+            return stats
+        finally:
+            # A run that lost its lease leaves the job document to the new holder
+            self.jobs.update_one({'_id': ARCHIVE_JOB, 'lease': lease}, {'$set': {
+                'lease_until': datetime.utcnow(),
+                'last_run': {
+                    'started_at': started,
+                    'finished_at': datetime.utcnow(),
+                    'older_than_days': older_than_days,
+                    'owner': self.owner,
+                    'stats': stats
+                }
+            }})
+
+    def status(self):
+        return self.jobs.find_one({'_id': ARCHIVE_JOB}, {'_id': 0}) or {}
+
+    def _schedule_loop(self, older_than_days):
+        while True:
+            try:
+                self.run(older_than_days, scheduled=True)
+            except Exception as e:
+                logger.error(f"Error running chat archival: {e}")
+            time.sleep(min(CHAT_ARCHIVE_INTERVAL, 600.0))
+
+    def start_scheduler(self, older_than_days=CHAT_ARCHIVE_AFTER_DAYS):
+        with self._lock:
+            if self._scheduler_started or older_than_days <= 0:
+                return
+            self._scheduler_started = True
+        threading.Thread(target=self._schedule_loop, args=(older_than_days,), name='chat-archive', daemon=True).start()
@@ -0,0 +1,130 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import scheduler, PRIORITY_SUMMARY
+
+logger = logging.getLogger(__name__)
+
+# Conversation context for /chat. Recent turns are loaded from the chat and fitted to a
+# token budget, newest first; turns that no longer fit are folded into a rolling summary
+# cached on the chat document (`summary`, covering messages before `summary_upto`). The
+# fold runs in the background after the turn and only ever summarizes the new turns
+# together with the previous summary. It waits until at least SUMMARY_MIN_FOLD_MESSAGES
+# have fallen out of the window, and only one fold per chat runs at a time; a turn that
+# arrives while its chat is being folded leaves the rest to the next turn. Turns past
+# the budget stay in the prompt until a fold has stored them in the summary, so nothing
+# is dropped while a fold is pending.
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CHAT_CONTEXT_TOKENS', '3000'))
+CONTEXT_MAX_MESSAGES = int(os.getenv('CHAT_CONTEXT_MESSAGES', '40'))
+SUMMARY_TOKEN_BUDGET = int(os.getenv('CHAT_SUMMARY_TOKENS', '400'))
+SUMMARY_MAX_FOLD_MESSAGES = 100
+SUMMARY_MIN_FOLD_MESSAGES = int(os.getenv('CHAT_SUMMARY_MIN_FOLD_MESSAGES', '6'))
+
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summary-worker')
+_folding = {}
+_folding_lock = threading.Lock()
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    # Loaded once; request threads racing on the first call wait for the same result
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding('cl100k_base')
+                except Exception as e:
+                    # tiktoken fetches its BPE file on first use; without it fall back to ~4 chars/token
+                    logger.warning(f"tiktoken unavailable, estimating token counts: {e}")
+                    _encoding = False
+    return _encoding
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if not text:
+        return 0
+    if encoding is False:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _to_chat_message(message):
+    from llama_index.core.llms import ChatMessage
+    role = 'assistant' if message['role'] == 'ai' else message['role']
+    return ChatMessage(role=role, content=message['content'])
+
+def _truncate_to_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * 4]
+
+def build_context(chat_store, llm, chat_id, system_prompt, user_input):
+    # The current user message is already stored as the newest message of the chat
+    chat, recent, offset = chat_store.load_window(chat_id, CONTEXT_MAX_MESSAGES + 1, extra_fields=('summary', 'summary_upto'))
+    history = recent[:-1] if recent else []
+    summary = _truncate_to_tokens(chat.get('summary') or '', SUMMARY_TOKEN_BUDGET) if chat else ''
+    summary_upto = (chat.get('summary_upto') or 0) if chat else 0
+
+    budget = CONTEXT_TOKEN_BUDGET - count_tokens(system_prompt) - count_tokens(user_input) - count_tokens(summary)
+    keep_from = offset + len(history)
+    for message in reversed(history):
+        cost = count_tokens(message['content']) + 4
+        # Older turns are already covered by the summary
+        if cost > budget or keep_from <= summary_upto:
+            break
+        budget -= cost
+        keep_from -= 1
+    # Turns past the budget that the summary doesn't cover yet stay until they are folded
+    kept = history[min(keep_from, max(offset, summary_upto)) - offset:]
+
+    from llama_index.core.llms import ChatMessage
+    messages = [ChatMessage(role="system", content=system_prompt)]
+    if summary:
+        messages.append(ChatMessage(role="system", content=f"Summary of the earlier conversation: {summary}"))
+    messages.extend(_to_chat_message(m) for m in kept if m.get('content'))
+    messages.append(ChatMessage(role="user", content=user_input))
+    logger.debug(f"Built context for chat_id {chat_id}: {len(kept)} recent messages, summary up to {summary_upto}, {CONTEXT_TOKEN_BUDGET - budget} tokens")
+
+    if keep_from - summary_upto >= SUMMARY_MIN_FOLD_MESSAGES:
+        schedule_summary(chat_store, llm, chat_id, summary, summary_upto, keep_from)
+    return messages
+
+def fold_summary(chat_store, llm, chat_id, summary, summary_upto, fold_to):
+    fold_to = min(fold_to, summary_upto + SUMMARY_MAX_FOLD_MESSAGES)
+    _, turns, _ = chat_store.load_window(chat_id, fold_to - summary_upto, before=fold_to)
+    if not turns:
+        return None
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+    from llama_index.core.llms import ChatMessage
+    prompt = [
+        ChatMessage(
+            role="system",
+            content=f"You maintain a running summary of a conversation. Update the summary with the new turns, keeping facts, decisions and open questions. Reply with the updated summary only, under {SUMMARY_TOKEN_BUDGET} tokens."
+        ),
+        ChatMessage(role="user", content=f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"),
+    ]
+    with scheduler.slot(llm.model, PRIORITY_SUMMARY):
+        response = llm.chat(prompt)
+    updated = _truncate_to_tokens(response.message.content.strip(), SUMMARY_TOKEN_BUDGET)
+    chat_store.update_summary(chat_id, updated, fold_to, summary_upto)
+    logger.debug(f"Folded messages {summary_upto}-{fold_to} into the summary for chat_id {chat_id}")
+    return updated
+
+def schedule_summary(chat_store, llm, chat_id, summary, summary_upto, fold_to):
+    def done(future):
+        with _folding_lock:
+            _folding.pop(chat_id, None)
+        if future.exception():
+            logger.error(f"Summary update failed for chat_id {chat_id}: {future.exception()}")
+
+    with _folding_lock:
+        if chat_id in _folding:
+            return _folding[chat_id]
+        future = _folding[chat_id] = summary_executor.submit(fold_summary, chat_store, llm, chat_id, summary, summary_upto, fold_to)
+    future.add_done_callback(done)
+    return future
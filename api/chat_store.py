@@ -0,0 +1,406 @@
+import os
+import logging
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Chat history storage.
+#
+# 'embedded' keeps every message in the chat document's `messages` array (the original
+# layout). 'bucketed' keeps only chat metadata in `chat_history` and appends messages to
+# fixed-size bucket documents in `chat_messages`, so a long chat never rewrites an
+# ever-growing document or approaches Mongo's 16 MB document limit.
+CHAT_STORAGE_LAYOUT = os.getenv('CHAT_STORAGE_LAYOUT', 'embedded')
+MESSAGE_BUCKET_SIZE = int(os.getenv('CHAT_MESSAGE_BUCKET_SIZE', '100'))
+LAYOUTS = ('embedded', 'bucketed')
+DUPLICATE_KEY = 11000
+
+
+def _created_at(chat):
+    # Stand-in last_message_at for a chat without messages: when its document was created
+    if isinstance(chat.get('_id'), ObjectId):
+        return chat['_id'].generation_time.replace(tzinfo=None)
+    return datetime.utcnow()
+
+
+class ChatStore:
+    def __init__(self, db, layout=CHAT_STORAGE_LAYOUT, bucket_size=MESSAGE_BUCKET_SIZE):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown chat storage layout: {layout}")
+        self.layout = layout
+        self.bucket_size = bucket_size
+        self.chats = db['chat_history']
+        self.buckets = db['chat_messages']
+
+    def ensure_indexes(self):
+        try:
+            self.chats.create_index([('chat_id', ASCENDING)], unique=True, name='chat_id_unique')
+        except OperationFailure as e:
+            # Older data can hold duplicate chats from the find-then-insert race
+            logger.error(f"Could not create unique chat_id index ({e}); run `flask --app app migrate-chat-storage` to merge duplicates")
+        self.chats.create_index([('last_message_at', DESCENDING), ('_id', DESCENDING)], name='last_message_at_id')
+        self.buckets.create_index([('chat_id', ASCENDING), ('bucket', ASCENDING)], unique=True, name='chat_bucket_unique')
+        logger.debug("Ensured chat history indexes")
+
+    def _bucket_for(self, position):
+        return position // self.bucket_size
+
+    def _bucket_filter(self, chat_id, position):
+        return {'chat_id': chat_id, 'bucket': self._bucket_for(position)}
+
+    def _bucket_push(self, message):
+        return {'$push': {'messages': message}, '$inc': {'count': 1}, '$max': {'last_at': message['timestamp']}}
+
+    def _append_update(self, message, title):
+        # $max: a message stamped earlier but written later (e.g. the user turn of a slow
+        # request) must not move the chat back in the listing
+        update = {
+            '$setOnInsert': {'title': title},
+            '$inc': {'message_count': 1},
+            '$max': {'last_message_at': message['timestamp']}
+        }
+        if self.layout == 'embedded':
+            update['$push'] = {'messages': message}
+        return update
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='append_message')
+    def append_message(self, chat_id, message, title='Untitled'):
+        # One upsert both creates the chat (if needed) and appends the message; the
+        # pre-update document tells the caller whether the chat is new. Two racing
+        # upserts of a new chat_id collide on the unique index, and the loser retries
+        # as a plain append.
+        try:
+            before = self.chats.find_one_and_update(
+                {'chat_id': chat_id},
+                self._append_update(message, title),
+                projection={'message_count': 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            before = self.chats.find_one_and_update(
+                {'chat_id': chat_id},
+                self._append_update(message, title),
+                projection={'message_count': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+        if self.layout == 'bucketed':
+            position = before.get('message_count', 0) if before else 0
+            self.buckets.update_one(self._bucket_filter(chat_id, position), self._bucket_push(message), upsert=True)
+        return before is None
+
+    def backfill_last_message_at(self):
+        # Server-side update for chats written before last_message_at was maintained (or
+        # stored as null), so every chat has a value list_chats can page on. Chats without
+        # messages get their creation time from the ObjectId.
+        result = self.chats.update_many(
+            {'last_message_at': None},
+            [{'$set': {
+                'last_message_at': {'$ifNull': [{'$last': '$messages.timestamp'}, {'$toDate': '$_id'}]},
+                'message_count': {'$ifNull': ['$message_count', {'$size': {'$ifNull': ['$messages', []]}}]}
+            }}]
+        )
+        if result.modified_count:
+            logger.info(f"Backfilled last_message_at on {result.modified_count} chats")
+        return result.modified_count
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='list_chats')
+    def list_chats(self, limit, before=None):
+        # Keyset pagination over (last_message_at, _id), newest first. Only the listing
+        # fields are projected, so message arrays never leave the server. Chats without
+        # last_message_at (not backfilled yet) sort last and are paged by _id alone.
+        query = {}
+        if before:
+            last_message_at, last_id = before
+            if last_message_at is None:
+                query = {'last_message_at': None, '_id': {'$lt': last_id}}
+            else:
+                query = {'$or': [
+                    {'last_message_at': {'$lt': last_message_at}},
+                    {'last_message_at': last_message_at, '_id': {'$lt': last_id}},
+                    {'last_message_at': None}
+                ]}
+        chats = list(
+            self.chats.find(query, {'chat_id': 1, 'title': 1, 'last_message_at': 1})
+            .sort([('last_message_at', DESCENDING), ('_id', DESCENDING)])
+            .limit(limit + 1)
+        )
+        next_before = None
+        if len(chats) > limit:
+            chats = chats[:limit]
+            next_before = (chats[-1].get('last_message_at'), chats[-1]['_id'])
+        return chats, next_before
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='load_messages')
+    def load_messages(self, chat):
+        # Chats written before a migration may still carry embedded messages
+        messages = list(chat.get('messages', []))
+        if self.layout == 'bucketed':
+            for bucket in self.buckets.find({'chat_id': chat['chat_id']}, {'messages': 1}).sort('bucket', ASCENDING):
+                messages.extend(bucket['messages'])
+        return messages
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='load_window')
+    def load_window(self, chat_id, limit, before=None, extra_fields=()):
+        # Returns (chat, messages, offset) for up to `limit` messages ending just before
+        # position `before` (or at the end of the chat), where offset is the position of
+        # the first returned message. Only the requested slice is read.
+        fields = {'chat_id': 1, 'title': 1, 'message_count': 1}
+        fields.update({field: 1 for field in extra_fields})
+        if self.layout == 'embedded':
+            if before is None:
+                window = {'$slice': -limit}
+            elif before == 0:
+                window = {'$slice': 0}
+            else:
+                start = max(0, before - limit)
+                window = {'$slice': [start, before - start]}
+            chat = self.chats.find_one({'chat_id': chat_id}, {**fields, 'messages': window})
+            if chat is None:
+                return None, [], 0
+            messages = chat.pop('messages', [])
+            if before is None:
+                return chat, messages, max(0, chat.get('message_count', len(messages)) - len(messages))
+            return chat, messages, max(0, before - limit)
+
+        chat = self.chats.find_one({'chat_id': chat_id}, {**fields, 'messages': 1})
+        if chat is None:
+            return None, [], 0
+        if chat.get('messages'):
+            # Not migrated yet; positions don't line up with buckets
+            messages = self.load_messages(chat)
+            chat.pop('messages')
+            end = len(messages) if before is None else min(before, len(messages))
+            start = max(0, end - limit)
+            return chat, messages[start:end], start
+        end = chat.get('message_count', 0) if before is None else min(before, chat.get('message_count', 0))
+        start = max(0, end - limit)
+        if end <= start:
+            return chat, [], start
+        messages = []
+        buckets = self.buckets.find(
+            {'chat_id': chat_id, 'bucket': {'$gte': self._bucket_for(start), '$lte': self._bucket_for(end - 1)}},
+            {'messages': 1}
+        ).sort('bucket', ASCENDING)
+        for bucket in buckets:
+            messages.extend(bucket['messages'])
+        first = self._bucket_for(start) * self.bucket_size
+        return chat, messages[start - first:end - first], start
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='load_since')
+    def load_since(self, chat_id, since):
+        # Returns (chat, messages, offset) for messages stored after `since`
+        fields = {'chat_id': 1, 'title': 1, 'message_count': 1}
+        if self.layout == 'embedded':
+            result = list(self.chats.aggregate([
+                {'$match': {'chat_id': chat_id}},
+                {'$project': {**fields, 'messages': {
+                    '$filter': {'input': '$messages', 'cond': {'$gt': ['$$this.timestamp', since]}}
+                }}}
+            ]))
+            if not result:
+                return None, [], 0
+            chat = result[0]
+            messages = chat.pop('messages', None) or []
+        else:
+            chat = self.chats.find_one({'chat_id': chat_id}, {**fields, 'messages': 1})
+            if chat is None:
+                return None, [], 0
+            messages = [m for m in chat.pop('messages', []) if m['timestamp'] > since]
+            buckets = self.buckets.find({'chat_id': chat_id, 'last_at': {'$gt': since}}, {'messages': 1}).sort('bucket', ASCENDING)
+            for bucket in buckets:
+                messages.extend(m for m in bucket['messages'] if m['timestamp'] > since)
+        count = chat.get('message_count', len(messages))
+        return chat, messages, max(0, count - len(messages))
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='update_summary')
+    def update_summary(self, chat_id, summary, summary_upto, previous_upto):
+        # Only moves the summary forward from the state it was built on, so a slower
+        # concurrent fold can't overwrite a newer one
+        return self.chats.update_one(
+            {'chat_id': chat_id, 'summary_upto': previous_upto or {'$in': [0, None]}},
+            {'$set': {'summary': summary, 'summary_upto': summary_upto}}
+        )
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='delete_chat')
+    def delete_chat(self, chat_id, last_message_at=None):
+        # With `last_message_at`, only deletes the chat if no message was added since
+        query = {'chat_id': chat_id}
+        if last_message_at is not None:
+            query['last_message_at'] = last_message_at
+        result = self.chats.delete_one(query)
+        if last_message_at is None or result.deleted_count:
+            self.buckets.delete_many({'chat_id': chat_id})
+        return result
+
+    def chat_page(self, query=None, after=None, limit=500):
+        # Up to `limit` whole chats (with `_id`) in _id order, starting after `after`.
+        # Every page is a fresh query, so no cursor is held open between pages.
+        if after is not None:
+            query = {'$and': [query or {}, {'_id': {'$gt': after}}]}
+        chats = list(self.chats.find(query or {}).sort('_id', ASCENDING).limit(limit))
+        for chat in chats:
+            if self.layout == 'bucketed':
+                chat['messages'] = self.load_messages(chat)
+            else:
+                chat.setdefault('messages', [])
+        return chats
+
+    def iter_chats(self, query=None, batch_size=500):
+        # Yields whole chats with their messages embedded, whatever the layout, one page
+        # of `batch_size` chats at a time so memory stays flat however many match
+        after = None
+        while True:
+            page = self.chat_page(query, after, batch_size)
+            for chat in page:
+                after = chat.pop('_id')
+                yield chat
+            if len(page) < batch_size:
+                return
+
+    def _import_batch(self, chats, stats):
+        docs = []
+        for chat in chats:
+            chat = {key: value for key, value in chat.items() if key != '_id'}
+            messages = chat.get('messages') or []
+            chat['message_count'] = len(messages)
+            chat['last_message_at'] = messages[-1]['timestamp'] if messages else chat.get('last_message_at') or datetime.utcnow()
+            chat.setdefault('title', 'Untitled')
+            docs.append(chat)
+
+        # Stored without messages first in the bucketed layout; their buckets follow
+        # once the chat itself is in
+        to_insert = docs if self.layout == 'embedded' else [{k: v for k, v in doc.items() if k != 'messages'} for doc in docs]
+        skipped = set()
+        try:
+            self.chats.insert_many(to_insert, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != DUPLICATE_KEY:
+                    raise
+                skipped.add(error['index'])
+        stats['imported'] += len(docs) - len(skipped)
+        stats['skipped'] += len(skipped)
+
+        if self.layout == 'bucketed':
+            buckets = [
+                {
+                    'chat_id': doc['chat_id'],
+                    'bucket': start // self.bucket_size,
+                    'messages': doc['messages'][start:start + self.bucket_size],
+                    'count': len(doc['messages'][start:start + self.bucket_size]),
+                    'last_at': doc['messages'][start:start + self.bucket_size][-1]['timestamp']
+                }
+                for index, doc in enumerate(docs) if index not in skipped
+                for start in range(0, len(doc.get('messages') or []), self.bucket_size)
+            ]
+            if buckets:
+                self.buckets.insert_many(buckets, ordered=False)
+
+    def import_chats(self, chats, batch_size=500):
+        # Inserts chats from any iterable (e.g. iter_chats() output) with one insert_many
+        # per batch. Chats whose chat_id already exists are skipped, so an interrupted
+        # import can simply be re-run.
+        stats = {'imported': 0, 'skipped': 0}
+        batch = []
+        for chat in chats:
+            batch.append(chat)
+            if len(batch) == batch_size:
+                self._import_batch(batch, stats)
+                batch = []
+        if batch:
+            self._import_batch(batch, stats)
+        return stats
+
+    def _merge_duplicates(self):
+        pipeline = [
+            {'$group': {'_id': '$chat_id', 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}}
+        ]
+        merged = 0
+        for group in self.chats.aggregate(pipeline, allowDiskUse=True):
+            docs = list(self.chats.find({'_id': {'$in': group['ids']}}))
+            keeper = docs[0]
+            messages = []
+            for doc in docs:
+                messages.extend(doc.get('messages', []))
+            messages.sort(key=lambda m: m['timestamp'])
+            title = next((d['title'] for d in docs if d.get('title') not in (None, 'Untitled')), keeper.get('title', 'Untitled'))
+            self.chats.update_one({'_id': keeper['_id']}, {'$set': {'messages': messages, 'title': title}})
+            self.chats.delete_many({'_id': {'$in': [d['_id'] for d in docs[1:]]}})
+            merged += 1
+        return merged
+
+    def migrate(self, batch_size=500):
+        # Merges duplicate chats, backfills message_count/last_message_at and moves every
+        # chat's messages into the configured layout. Safe to re-run.
+        stats = {'duplicates_merged': self._merge_duplicates(), 'chats_migrated': 0}
+
+        for chat in self.chats.find({}, batch_size=batch_size):
+            chat_id = chat['chat_id']
+            messages = list(chat.get('messages', []))
+            for bucket in self.buckets.find({'chat_id': chat_id}, {'messages': 1}).sort('bucket', ASCENDING):
+                messages.extend(bucket['messages'])
+
+            update = {
+                '$set': {
+                    'message_count': len(messages),
+                    'last_message_at': messages[-1]['timestamp'] if messages else chat.get('last_message_at') or _created_at(chat)
+                }
+            }
+            if self.layout == 'embedded':
+                update['$set']['messages'] = messages
+                self.chats.update_one({'_id': chat['_id']}, update)
+                self.buckets.delete_many({'chat_id': chat_id})
+            else:
+                self.buckets.delete_many({'chat_id': chat_id})
+                bulk = [
+                    UpdateOne(
+                        {'chat_id': chat_id, 'bucket': start // self.bucket_size},
+                        {'$set': {
+                            'messages': messages[start:start + self.bucket_size],
+                            'count': len(messages[start:start + self.bucket_size]),
+                            'last_at': messages[start:start + self.bucket_size][-1]['timestamp']
+                        }},
+                        upsert=True
+                    )
+                    for start in range(0, len(messages), self.bucket_size)
+                ]
+                if bulk:
+                    self.buckets.bulk_write(bulk, ordered=True)
+                update['$unset'] = {'messages': ''}
+                self.chats.update_one({'_id': chat['_id']}, update)
+            stats['chats_migrated'] += 1
+
+        self.ensure_indexes()
+        return stats
+
+
+class AsyncChatStore(ChatStore):
+    # Same layouts over a motor database, for the ASGI entry point
+
+    @timed('mongo_query_seconds', collection='chat_history', operation='append_message')
+    async def append_message(self, chat_id, message, title='Untitled'):
+        try:
+            before = await self.chats.find_one_and_update(
+                {'chat_id': chat_id},
+                self._append_update(message, title),
+                projection={'message_count': 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            before = await self.chats.find_one_and_update(
+                {'chat_id': chat_id},
+                self._append_update(message, title),
+                projection={'message_count': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+        if self.layout == 'bucketed':
+            position = before.get('message_count', 0) if before else 0
+            await self.buckets.update_one(self._bucket_filter(chat_id, position), self._bucket_push(message), upsert=True)
+        return before is None
@@ -0,0 +1,91 @@
+import os
+import time
+import logging
+import threading
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# In-process cache for the small configuration documents (object storage settings,
+# user settings, LLM services, profile) that request handlers used to re-read from Mongo
+# on every call. Write paths invalidate what they change. Entries also expire after
+# CONFIG_CACHE_TTL_SECONDS so several API replicas converge even without a change
+# stream; with CONFIG_CACHE_WATCH=true (needs a replica set) each replica instead
+# invalidates as soon as any replica writes.
+CONFIG_CACHE_TTL_SECONDS = float(os.getenv('CONFIG_CACHE_TTL_SECONDS', '300'))
+CONFIG_CACHE_WATCH = os.getenv('CONFIG_CACHE_WATCH', 'false').lower() == 'true'
+
+
+def _cache_key(collection, query):
+    return (collection.name, tuple(sorted(query.items())))
+
+
+class ConfigCache:
+    def __init__(self, ttl=CONFIG_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = {}
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, collection, query):
+        # Returns a shallow copy of the document (or None); missing documents are cached too
+        key = _cache_key(collection, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return dict(entry[0]) if entry[0] is not None else None
+            self.misses += 1
+            generation = self._generation
+        doc = collection.find_one(query)
+        with self._lock:
+            # Don't store a read that raced with an invalidation
+            if generation == self._generation:
+                self._entries[key] = (doc, time.monotonic() + self.ttl)
+        return dict(doc) if doc is not None else None
+
+    def invalidate(self, collection_name=None):
+        with self._lock:
+            self._generation += 1
+            if collection_name is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == collection_name]:
+                    del self._entries[key]
+            listeners = [cb for name, cbs in self._listeners.items() if collection_name in (None, name) for cb in cbs]
+        logger.debug(f"Invalidated config cache for {collection_name or 'all collections'}")
+        for callback in listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in config change listener: {e}")
+
+    def on_change(self, collection_name, callback):
+        # Runs after the collection's entries are invalidated, locally or by another replica
+        with self._lock:
+            self._listeners.setdefault(collection_name, []).append(callback)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _watch_loop(self, db, collection_names):
+        pipeline = [{'$match': {'ns.coll': {'$in': list(collection_names)}}}]
+        while True:
+            try:
+                with db.watch(pipeline) as stream:
+                    # Anything written while the stream was down is unknown; start clean
+                    self.invalidate()
+                    for change in stream:
+                        self.invalidate(change['ns']['coll'])
+            except PyMongoError as e:
+                logger.warning(f"Config change stream unavailable, relying on the {self.ttl:.0f}s TTL: {e}")
+                if 'replica set' in str(e).lower() or getattr(e, 'code', None) == 40573:
+                    return
+                time.sleep(min(self.ttl, 30.0))
+
+    def watch(self, db, collection_names):
+        threading.Thread(target=self._watch_loop, args=(db, collection_names), name='config-watch', daemon=True).start()
@@ -0,0 +1,230 @@
+import os
+import uuid
+import logging
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+logger = logging.getLogger(__name__)
+
+# Documents (PDF, text, Markdown) uploaded to a chat. The original is stored in object
+# storage next to the chat's images; parsing, chunking and embedding run in a pool of
+# DOCUMENT_WORKERS processes so large PDFs don't hold the GIL of the API process. Workers
+# report progress to the `document_jobs` collection (readable from any replica), and the
+# API process inserts the finished chunks into the shared DocumentIndex with the chat's
+# chat_id, so they are retrieved for that chat only (see retrieval.py).
+#
+# Workers are started with the spawn method: the API process runs threads and Mongo
+# clients that are not safe to fork. Each worker opens its own Mongo connection.
+DOCUMENT_EXTENSIONS = {'pdf', 'txt', 'md'}
+DOCUMENT_WORKERS = int(os.getenv('DOCUMENT_WORKERS', '2'))
+DOCUMENT_MAX_BYTES = int(os.getenv('DOCUMENT_MAX_MB', '50')) * 1024 * 1024
+DOCUMENT_CONTENT_TYPES = {'pdf': 'application/pdf', 'txt': 'text/plain', 'md': 'text/markdown'}
+
+JOB_QUEUED = 'queued'
+JOB_PARSING = 'parsing'
+JOB_EMBEDDING = 'embedding'
+JOB_INDEXED = 'indexed'
+JOB_FAILED = 'failed'
+
+
+def document_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def allowed_document(filename):
+    return document_extension(filename) in DOCUMENT_EXTENSIONS
+
+
+def document_key(chat_id, content_hash, filename):
+    return f"documents/{chat_id}/{content_hash}.{document_extension(filename)}"
+
+
+def document_source(chat_id, content_hash):
+    # Index source name; re-uploading the same file to a chat replaces its chunks
+    return f"chat/{chat_id}/{content_hash}"
+
+
+class DocumentJobs:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([('job_id', ASCENDING)], unique=True)
+        self.collection.create_index([('chat_id', ASCENDING), ('created_at', DESCENDING)])
+
+    def create(self, chat_id, filename, key, content_hash, size):
+        job = {
+            'job_id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'filename': filename,
+            'key': key,
+            'content_hash': content_hash,
+            'size': size,
+            'status': JOB_QUEUED,
+            'progress': 0.0,
+            'chunks': 0,
+            'error': None,
+            'created_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
+        }
+        self.collection.insert_one(dict(job))
+        return job
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = datetime.utcnow()
+        self.collection.update_one({'job_id': job_id}, {'$set': fields})
+
+    def get(self, job_id):
+        return self.collection.find_one({'job_id': job_id}, {'_id': 0})
+
+    def list_for_chat(self, chat_id):
+        return list(self.collection.find({'chat_id': chat_id}, {'_id': 0}).sort('created_at', DESCENDING))
+
+    def has_indexed(self, chat_id):
+        # Cheap per-chat check (uses the chat_id index); the search index isn't touched
+        return self.collection.find_one({'chat_id': chat_id, 'status': JOB_INDEXED}, {'_id': 1}) is not None
+
+    def has_any(self, chat_id):
+        return self.collection.find_one({'chat_id': chat_id}, {'_id': 1}) is not None
+
+    def delete_for_chat(self, chat_id):
+        return self.collection.delete_many({'chat_id': chat_id}).deleted_count
+
+
+# --- Worker process side ---
+
+_worker_jobs = None
+
+
+def _init_worker(mongo_uri, db_name, collection_name):
+    global _worker_jobs
+    logging.basicConfig(level=logging.INFO)
+    _worker_jobs = DocumentJobs(MongoClient(mongo_uri)[db_name][collection_name])
+
+
+def process_document(job_id, source, filename, data, path, metadata, embed_model_name, embed_base_url):
+    # Runs in a worker process; returns (doc_ids, nodes) with embeddings attached.
+    # Heavy imports stay here so the API process doesn't pay for them twice.
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.embeddings.ollama import OllamaEmbedding
+    from retrieval import make_splitter, prepare_documents, embed_nodes
+
+    tmp_path = None
+    try:
+        _worker_jobs.update(job_id, status=JOB_PARSING)
+        if data is not None:
+            # The reader picks its parser from the file extension
+            fd, tmp_path = tempfile.mkstemp(suffix=f".{document_extension(filename)}")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            path = tmp_path
+        documents = SimpleDirectoryReader(input_files=[path]).load_data()
+        for document in documents:
+            document.metadata['file_name'] = filename
+            document.metadata.pop('file_path', None)
+        doc_ids = prepare_documents(source, documents, metadata)
+        nodes = make_splitter().get_nodes_from_documents(documents)
+        _worker_jobs.update(job_id, status=JOB_EMBEDDING, pages=len(documents), chunks=len(nodes))
+
+        def on_progress(done, total):
+            _worker_jobs.update(job_id, progress=round(done / total, 3))
+
+        embed_model = OllamaEmbedding(model_name=embed_model_name, base_url=embed_base_url)
+        embed_nodes(nodes, embed_model, on_progress)
+        return doc_ids, nodes
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# --- API process side ---
+
+class DocumentPipeline:
+    def __init__(self, jobs, document_index, embed_model_factory, mongo_uri, workers=DOCUMENT_WORKERS):
+        self.jobs = jobs
+        self.document_index = document_index
+        self.embed_model_factory = embed_model_factory
+        self.mongo_uri = mongo_uri
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # Inserting into the index persists it; keep that off the pool's management thread
+        self._index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='document-index')
+
+    def _pool(self):
+        # Started on first use so processes that never see an upload don't spawn workers
+        with self._lock:
+            if self._executor is None:
+                collection = self.jobs.collection
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.mongo_uri, collection.database.name, collection.name)
+                )
+            return self._executor
+
+    def submit(self, job, upload):
+        # Holds a reference on the upload until the worker has read it
+        embed_model = self.embed_model_factory()
+        source = document_source(job['chat_id'], job['content_hash'])
+        metadata = {'scope': 'chat', 'chat_id': job['chat_id']}
+        upload.acquire()
+        try:
+            future = self._pool().submit(
+                process_document, job['job_id'], source, job['filename'], upload.data, upload.path,
+                metadata, embed_model.model_name, embed_model.base_url
+            )
+        except Exception:
+            upload.release()
+            raise
+
+        def on_done(future):
+            upload.release()
+            self._index_executor.submit(self._finish, job, source, future)
+
+        future.add_done_callback(on_done)
+        return future
+
+    def _finish(self, job, source, future):
+        # Runs on the index thread, after any _remove_chat submitted before it. A job
+        # whose chat was deleted while it was processed is gone by now; its chunks are
+        # dropped rather than indexed for a chat that no longer exists.
+        if self.jobs.get(job['job_id']) is None:
+            logger.info(f"Dropping {job['filename']}: chat {job['chat_id']} was deleted while it was processed")
+            return
+        try:
+            doc_ids, nodes = future.result()
+            chunks = self.document_index.add_nodes(source, job['content_hash'], nodes, doc_ids)
+            self.jobs.update(job['job_id'], status=JOB_INDEXED, progress=1.0, chunks=chunks, finished_at=datetime.utcnow())
+            logger.info(f"Indexed {job['filename']} for chat {job['chat_id']} ({chunks} chunks)")
+        except Exception as e:
+            logger.error(f"Error processing document {job['filename']} (job {job['job_id']}): {e}")
+            self.jobs.update(job['job_id'], status=JOB_FAILED, error=str(e), finished_at=datetime.utcnow())
+
+    def has_documents(self, chat_id):
+        return self.jobs.has_indexed(chat_id)
+
+    def _remove_chat(self, chat_id):
+        removed = self.document_index.remove_prefix(f"chat/{chat_id}/")
+        self.jobs.delete_for_chat(chat_id)
+        logger.info(f"Removed {removed} indexed documents of chat {chat_id}")
+        return removed
+
+    def remove_chat(self, chat_id):
+        # Returns right away (None if the chat never had documents). Runs on the index
+        # thread, after any of the chat's jobs that are still being indexed.
+        if not self.jobs.has_any(chat_id):
+            return None
+
+        def log_failure(future):
+            if future.exception():
+                logger.error(f"Error removing documents of chat {chat_id}: {future.exception()}")
+
+        future = self._index_executor.submit(self._remove_chat, chat_id)
+        future.add_done_callback(log_failure)
+        return future
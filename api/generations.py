@@ -0,0 +1,88 @@
+import uuid
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# In-flight generations of this process. Every /chat and /image stream registers one,
+# announces its id to the client as the first SSE event and can then be cancelled with
+# DELETE /generation/<id> (or by the client closing the connection).
+#
+# The registry is per process; with several server workers a DELETE can reach a worker
+# that doesn't own the stream and gets a 404 (the client then closes the connection).
+
+
+class Generation:
+    def __init__(self, chat_id, endpoint):
+        self.id = str(uuid.uuid4())
+        self.chat_id = chat_id
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.cancelled = threading.Event()
+        self._on_cancel = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error cancelling generation {self.id}: {e}")
+
+
+_active = {}
+_lock = threading.Lock()
+
+def start_generation(chat_id, endpoint):
+    generation = Generation(chat_id, endpoint)
+    with _lock:
+        _active[generation.id] = generation
+    return generation
+
+def finish_generation(generation):
+    with _lock:
+        _active.pop(generation.id, None)
+
+def cancel_generation(generation_id):
+    with _lock:
+        generation = _active.get(generation_id)
+    if generation is None:
+        return False
+    logger.info(f"Cancelling generation {generation_id} for chat_id {generation.chat_id}")
+    generation.cancel()
+    return True
+
+def active_generations():
+    with _lock:
+        return list(_active.values())
+
+_draining = threading.Event()
+
+def is_draining():
+    return _draining.is_set()
+
+def drain(timeout):
+    # On shutdown: lets in-flight generations finish for up to `timeout` seconds, then
+    # cancels the rest (their partial answers are saved). Returns the number cancelled.
+    _draining.set()
+    deadline = time.monotonic() + timeout
+    while active_generations() and time.monotonic() < deadline:
+        time.sleep(0.5)
+    remaining = active_generations()
+    for generation in remaining:
+        logger.info(f"Cancelling generation {generation.id} for chat_id {generation.chat_id} on shutdown")
+        generation.cancel()
+    return len(remaining)
@@ -0,0 +1,78 @@
+import os
+import signal
+import threading
+from uvicorn.workers import UvicornWorker
+
+# Production server for the API (the container's command):
+#
+#   gunicorn -c gunicorn.conf.py
+#
+# API_SERVER=asgi (default) serves asgi:application on uvicorn workers, so every open
+# /chat or /image stream is a coroutine; API_SERVER=wsgi serves the Flask app on threaded
+# workers. `python app.py` stays the development server.
+#
+# The app is imported in each worker after the fork (preload_app is off), so every worker
+# creates its own MongoClient, S3 and LLM clients and runs its own startup phase (see
+# startup.py). Per-process state stays per worker: OLLAMA_MAX_CONCURRENT and the queue
+# limits apply to each worker, and cached settings written through another worker are
+# picked up after CONFIG_CACHE_TTL_SECONDS, which defaults to 10s here.
+#
+# On SIGTERM a worker stops accepting connections and lets open event streams finish for
+# up to SSE_DRAIN_SECONDS. Streams still running after that are cancelled and their
+# partial answers saved: gthread workers send clients a `cancelled` event; uvicorn
+# workers (timeout_graceful_shutdown) cancel the response task, and the ASGI lifespan
+# shutdown waits for the saves before the worker exits.
+API_SERVER = os.getenv('API_SERVER', 'asgi')
+SSE_DRAIN_SECONDS = int(os.getenv('SSE_DRAIN_SECONDS', '30'))
+API_MAX_WORKERS = int(os.getenv('API_MAX_WORKERS', '8'))
+
+
+def _available_cpus():
+    # Honors the container's CPU set, unlike os.cpu_count()
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _start_drain():
+    from generations import drain
+    threading.Thread(target=drain, args=(SSE_DRAIN_SECONDS,), name='sse-drain', daemon=True).start()
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    # uvicorn waits this long for open responses after SIGTERM, then cancels them
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, 'timeout_graceful_shutdown': SSE_DRAIN_SECONDS}
+
+
+os.environ.setdefault('CONFIG_CACHE_TTL_SECONDS', '10')
+
+bind = os.getenv('API_BIND', '0.0.0.0:5001')
+# Generation runs in Ollama, so workers mostly wait on I/O; one per core is enough
+workers = int(os.getenv('WEB_CONCURRENCY', '0')) or min(_available_cpus(), API_MAX_WORKERS)
+if API_SERVER == 'wsgi':
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    # Each open event stream holds a thread
+    threads = int(os.getenv('API_THREADS', '32'))
+else:
+    wsgi_app = 'asgi:application'
+    worker_class = DrainingUvicornWorker
+# The arbiter kills workers after this; the margin covers saving cancelled streams
+graceful_timeout = SSE_DRAIN_SECONDS + 10
+timeout = 60
+keepalive = 5
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    # gthread workers finish in-flight requests for graceful_timeout after SIGTERM
+    if API_SERVER != 'wsgi':
+        return
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(sig, frame):
+        _start_drain()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, drain_and_exit)
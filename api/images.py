@@ -0,0 +1,81 @@
+import io
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Preprocessing applied before vision inference. The original upload is what gets
+# stored; the model gets a copy that is orientation-corrected, downscaled so its longest
+# side is at most IMAGE_MAX_SIDE and re-encoded. llama3.2-vision works on 560px tiles
+# (up to 2x2), so anything much larger is only extra encode and transfer time.
+IMAGE_PREPROCESS = os.getenv('IMAGE_PREPROCESS', 'true').lower() == 'true'
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1120'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+IMAGE_THUMBNAILS = os.getenv('IMAGE_THUMBNAILS', 'true').lower() == 'true'
+THUMBNAIL_SIDE = int(os.getenv('IMAGE_THUMBNAIL_SIDE', '256'))
+
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'GIF': 'image/gif'}
+
+
+class ProcessedImage:
+    def __init__(self, data, image_format, thumbnail=None):
+        self.data = data
+        self.format = image_format
+        self.thumbnail = thumbnail
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES.get(self.format, 'application/octet-stream')
+
+
+def _encode(img, image_format, quality):
+    from PIL import Image
+    if image_format == 'JPEG' and img.mode != 'RGB':
+        # JPEG has no alpha channel; flatten onto white rather than black
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format=image_format, quality=quality, optimize=True)
+    return out.getvalue()
+
+def preprocess_image(source, max_side=IMAGE_MAX_SIDE, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY, thumbnails=IMAGE_THUMBNAILS):
+    # `source` is raw bytes or a path to the spooled upload. Pillow is imported here so
+    # processes that never see an image (or run with IMAGE_PREPROCESS off) don't load it.
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        original_format = img.format
+        original_size = img.size
+        # For JPEG, let the decoder downscale by a power of two while decoding. draft()
+        # returns a truthy value for any JPEG, so compare sizes to see if it scaled.
+        img.draft(img.mode, (max_side, max_side))
+        drafted = img.size != original_size
+        rotated = img.getexif().get(0x0112, 1) != 1
+        processed = ImageOps.exif_transpose(img) if rotated else img
+        resized = max(processed.size) > max_side
+        if resized:
+            processed = processed.copy()
+            processed.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        thumbnail = None
+        if thumbnails:
+            thumb = processed.copy()
+            thumb.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.Resampling.LANCZOS)
+            thumbnail = _encode(thumb, 'JPEG', quality)
+
+        if not (drafted or rotated or resized) and original_format == image_format and isinstance(source, bytes):
+            # Already small enough, upright and in the target format; send it as is
+            return ProcessedImage(source, image_format, thumbnail)
+        data = _encode(processed, image_format, quality)
+        logger.debug(f"Preprocessed {original_format} image {original_size} -> {processed.size}, {len(data)} bytes as {image_format}")
+        return ProcessedImage(data, image_format, thumbnail)
+
+def image_messages(prompt, image=None, path=None):
+    # A single user turn with the prompt and the image, as bytes or a file path
+    from llama_index.core.llms import ChatMessage, TextBlock, ImageBlock
+    return [ChatMessage(role="user", blocks=[TextBlock(text=prompt), ImageBlock(image=image, path=path)])]
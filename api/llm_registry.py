@@ -0,0 +1,289 @@
+import os
+import time
+import socket
+import logging
+import threading
+from contextlib import closing, aclosing
+from llm_router import Router, OLLAMA_HOSTS, CONNECTION_ERRORS
+from metrics import StreamStats
+
+logger = logging.getLogger(__name__)
+
+# LLM client registry. Each (provider, model, options) combination is built once and
+# reused, so requests share the client's HTTP connection pool instead of building a
+# new Ollama instance (and mutating llama_index Settings) per request. text_llm() and
+# vision_llm() return routed clients that pick an Ollama backend per call (see
+# llm_router.py) and fail over to another one if a backend can't be reached before the
+# first token. llama_index is imported when the first client is built, not at startup.
+OLLAMA_HOST = os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+TEXT_MODEL = os.getenv('OLLAMA_TEXT_MODEL', 'qwen2.5:7b')
+VISION_MODEL = os.getenv('OLLAMA_VISION_MODEL', 'llama3.2-vision')
+EMBED_MODEL = os.getenv('OLLAMA_EMBED_MODEL', 'nomic-embed-text')
+IDLE_EVICT_SECONDS = float(os.getenv('LLM_CLIENT_IDLE_SECONDS', '1800'))
+
+_clients = {}
+_routed = {}
+_lock = threading.Lock()
+_evictor_started = False
+
+router = Router([host.strip() for host in OLLAMA_HOSTS.split(',') if host.strip()] or [OLLAMA_HOST])
+
+# The UpstreamStream being read on this thread, if any. Streams are consumed on their
+# own pump thread (see streaming.py), so the httpx hooks below can find the stream a
+# request belongs to without threading it through llama_index.
+_current = threading.local()
+
+
+class UpstreamStream:
+    # Iterator returned by RoutedLLM.stream_chat. close() can't interrupt a generator
+    # that is blocked on the backend, and closing the httpx response from another thread
+    # doesn't wake the read either; abort() shuts the socket down, which does, and Ollama
+    # stops generating once the connection drops.
+
+    def __init__(self, responses):
+        self._lock = threading.Lock()
+        self._socket = None
+        self.aborted = False
+        self._responses = responses(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._responses)
+
+    def close(self):
+        self._responses.close()
+
+    def attach(self, network_stream):
+        sock = network_stream.get_extra_info('socket') if network_stream is not None else None
+        with self._lock:
+            self._socket = sock
+            aborted = self.aborted
+        if aborted:
+            _shutdown(sock)
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            sock = self._socket
+        _shutdown(sock)
+
+
+def _shutdown(sock):
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def _trace(event, info):
+    # httpcore trace callback; a new connection reports its socket here, before any
+    # response headers arrive
+    stream = getattr(_current, 'stream', None)
+    if stream is not None and event == 'connection.connect_tcp.complete':
+        stream.attach(info['return_value'])
+
+def _on_request(request):
+    if getattr(_current, 'stream', None) is not None:
+        request.extensions['trace'] = _trace
+
+def _on_response(response):
+    # Covers requests sent on a reused connection
+    stream = getattr(_current, 'stream', None)
+    if stream is not None:
+        stream.attach(response.extensions.get('network_stream'))
+
+UPSTREAM_HOOKS = {'request': [_on_request], 'response': [_on_response]}
+
+def _client_key(provider, model, options):
+    return (provider, model, tuple(sorted(options.items())))
+
+def _build_client(provider, model, options):
+    if provider == 'ollama':
+        from ollama import Client
+        from llama_index.llms.ollama import Ollama
+        from llama_index.llms.ollama.base import DEFAULT_REQUEST_TIMEOUT
+        settings = {'base_url': OLLAMA_HOST, 'keep_alive': OLLAMA_KEEP_ALIVE}
+        settings.update(options)
+        # The client llama_index would build, plus the hooks UpstreamStream.abort needs
+        client = Client(host=settings['base_url'], timeout=settings.get('request_timeout', DEFAULT_REQUEST_TIMEOUT),
+                        event_hooks=UPSTREAM_HOOKS)
+        return Ollama(model=model, client=client, **settings)
+    if provider == 'ollama-embedding':
+        from llama_index.embeddings.ollama import OllamaEmbedding
+        settings = {'base_url': OLLAMA_HOST}
+        settings.update(options)
+        return OllamaEmbedding(model_name=model, **settings)
+    raise ValueError(f"Unsupported LLM provider: {provider}")
+
+def get_llm(provider, model, **options):
+    key = _client_key(provider, model, options)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None:
+            logger.info(f"Creating {provider} client for model {model} with options {options}")
+            entry = _clients[key] = {'llm': _build_client(provider, model, options), 'last_used': 0.0}
+        entry['last_used'] = time.monotonic()
+        return entry['llm']
+
+def _can_fail_over(error):
+    # Unreachable backend, or the model isn't installed there
+    from ollama import ResponseError
+    return isinstance(error, CONNECTION_ERRORS) or (isinstance(error, ResponseError) and error.status_code == 404)
+
+
+class RoutedLLM:
+    # Exposes the chat/stream_chat/astream_chat subset of the llama_index LLM interface
+    # used by the app; every call is served by a backend chosen by the router
+
+    def __init__(self, router, provider, model, **options):
+        self.router = router
+        self.provider = provider
+        self.model = model
+        self.options = options
+
+    def backend_llm(self, backend):
+        return get_llm(self.provider, self.model, base_url=backend.url, **self.options)
+
+    def _failed(self, backend, error):
+        if isinstance(error, CONNECTION_ERRORS):
+            self.router.mark_failed(backend, error)
+        else:
+            logger.warning(f"Model {self.model} is not available on {backend.url}, trying another backend")
+            self.router.mark_missing(backend, self.model)
+
+    def chat(self, messages, **kwargs):
+        tried = set()
+        while True:
+            backend = self.router.pick(self.model, exclude=tried)
+            tried.add(backend.url)
+            try:
+                return self.backend_llm(backend).chat(messages, **kwargs)
+            except Exception as e:
+                if not _can_fail_over(e):
+                    raise
+                self._failed(backend, e)
+            finally:
+                self.router.release(backend)
+
+    def stream_chat(self, messages, **kwargs):
+        # Lazy like llama_index's own stream: the backend is picked when iteration starts,
+        # i.e. once the scheduler grants the request a model slot
+        return UpstreamStream(lambda upstream: self._stream_chat(upstream, messages, **kwargs))
+
+    def _stream_chat(self, upstream, messages, **kwargs):
+        tried = set()
+        while True:
+            backend = self.router.pick(self.model, exclude=tried)
+            tried.add(backend.url)
+            streamed = False
+            stats = StreamStats(model=self.model)
+            _current.stream = upstream
+            try:
+                with closing(self.backend_llm(backend).stream_chat(messages, **kwargs)) as stream:
+                    for response in stream:
+                        streamed = True
+                        stats.token()
+                        yield response
+                stats.finish(response.raw if streamed else None)
+                return
+            except Exception as e:
+                # An aborted stream fails with a connection error; that's not the backend's fault
+                if streamed or upstream.aborted or not _can_fail_over(e):
+                    raise
+                self._failed(backend, e)
+            finally:
+                _current.stream = None
+                self.router.release(backend)
+
+    async def astream_chat(self, messages, **kwargs):
+        async def gen():
+            tried = set()
+            while True:
+                backend = self.router.pick(self.model, exclude=tried)
+                tried.add(backend.url)
+                streamed = False
+                stats = StreamStats(model=self.model)
+                try:
+                    async with aclosing(await self.backend_llm(backend).astream_chat(messages, **kwargs)) as stream:
+                        async for response in stream:
+                            streamed = True
+                            stats.token()
+                            yield response
+                    stats.finish(response.raw if streamed else None)
+                    return
+                except Exception as e:
+                    if streamed or not _can_fail_over(e):
+                        raise
+                    self._failed(backend, e)
+                finally:
+                    self.router.release(backend)
+
+        return gen()
+
+
+def routed_llm(provider, model, **options):
+    key = _client_key(provider, model, options)
+    with _lock:
+        if key not in _routed:
+            _routed[key] = RoutedLLM(router, provider, model, **options)
+        return _routed[key]
+
+def text_llm():
+    return routed_llm('ollama', TEXT_MODEL, request_timeout=60.0)
+
+def vision_llm():
+    return routed_llm('ollama', VISION_MODEL, request_timeout=120.0)
+
+def embedding_model():
+    # Embedding calls are short; pick a backend per lookup rather than per request
+    backend = router.pick(EMBED_MODEL)
+    router.release(backend)
+    return get_llm('ollama-embedding', EMBED_MODEL, base_url=backend.url)
+
+def evict_idle_clients(max_idle=IDLE_EVICT_SECONDS):
+    cutoff = time.monotonic() - max_idle
+    with _lock:
+        stale = [key for key, entry in _clients.items() if entry['last_used'] < cutoff]
+        for key in stale:
+            del _clients[key]
+    for provider, model, _ in stale:
+        logger.info(f"Evicted idle {provider} client for model {model}")
+    return len(stale)
+
+def _evict_loop():
+    while True:
+        time.sleep(min(60.0, IDLE_EVICT_SECONDS))
+        try:
+            evict_idle_clients()
+        except Exception as e:
+            logger.error(f"Error evicting idle LLM clients: {e}")
+
+def start_idle_evictor():
+    global _evictor_started
+    with _lock:
+        if _evictor_started:
+            return
+        _evictor_started = True
+    threading.Thread(target=_evict_loop, name='llm-evictor', daemon=True).start()
+
+def warm_up(llms):
+    # An empty generate request makes Ollama load the model and hold it for keep_alive,
+    # so the first real request doesn't pay the cold load. Each model is loaded on the
+    # backend the router picks for it, which is where its requests will then go.
+    def load():
+        for llm in llms:
+            backend = llm.router.pick(llm.model)
+            try:
+                started = time.perf_counter()
+                llm.backend_llm(backend).client.generate(model=llm.model, prompt='', keep_alive=OLLAMA_KEEP_ALIVE)
+                logger.info(f"Warmed up model {llm.model} on {backend.url} in {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                logger.warning(f"Could not warm up model {llm.model} on {backend.url}: {e}")
+            finally:
+                llm.router.release(backend)
+
+    threading.Thread(target=load, name='llm-warmup', daemon=True).start()
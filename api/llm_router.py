@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import threading
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Routing across several Ollama instances. Backends come from OLLAMA_HOSTS (comma
+# separated, falling back to OLLAMA_HOST) or from `llmServices.ollama.hosts` in
+# /settings. A background loop health-checks every backend and records which models it
+# has installed and which are currently loaded. With OLLAMA_ROUTING=affinity (default) a
+# request goes to a backend that already has its model loaded, so models aren't
+# reloaded back and forth, and spills over to the least busy backend once that one is
+# OLLAMA_AFFINITY_SLACK requests busier. OLLAMA_ROUTING=least_outstanding ignores loaded
+# models. A backend that refuses connections is taken out of rotation until it passes a
+# health check again.
+OLLAMA_HOSTS = os.getenv('OLLAMA_HOSTS', '')
+OLLAMA_ROUTING = os.getenv('OLLAMA_ROUTING', 'affinity')
+OLLAMA_AFFINITY_SLACK = int(os.getenv('OLLAMA_AFFINITY_SLACK', '2'))
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL_SECONDS', '15'))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv('OLLAMA_HEALTH_TIMEOUT_SECONDS', '3'))
+ROUTING_STRATEGIES = ('affinity', 'least_outstanding')
+
+# Errors that mean "this backend can't serve the request", as opposed to a bad request
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+def _canonical(model):
+    # Ollama reports untagged models as `name:latest`
+    return model if ':' in model else f"{model}:latest"
+
+
+def _model_names(response):
+    return {_canonical(m.get('model') or m.get('name')) for m in response.get('models', [])}
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = True
+        self.outstanding = 0
+        self.failures = 0
+        self.installed = set()
+        self.loaded = set()
+        self.last_checked = None
+        self.last_error = None
+
+    def status(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'failures': self.failures,
+            'installed': sorted(self.installed),
+            'loaded': sorted(self.loaded),
+            'last_checked': self.last_checked,
+            'last_error': self.last_error
+        }
+
+
+class Router:
+    def __init__(self, hosts, strategy=OLLAMA_ROUTING, affinity_slack=OLLAMA_AFFINITY_SLACK):
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.strategy = strategy
+        self.affinity_slack = affinity_slack
+        self.default_hosts = list(hosts)
+        # Optional callable returning configured hosts (or None to use the defaults)
+        self.config_source = None
+        self._backends = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._checker_started = False
+        self.configure(self.default_hosts)
+
+    def configure(self, hosts):
+        # Keeps counters of backends that stay configured; in-flight requests on removed
+        # backends finish on the objects they hold
+        urls = [url.rstrip('/') for url in hosts if url] or self.default_hosts
+        with self._lock:
+            added = [url for url in urls if url not in self._backends]
+            removed = [url for url in self._backends if url not in urls]
+            self._backends = {url: self._backends.get(url) or Backend(url) for url in urls}
+        if added or removed:
+            logger.info(f"Ollama backends: {urls} (added {added}, removed {removed})")
+            self._notify()
+
+    def reload(self):
+        if self.config_source is None:
+            return
+        try:
+            self.configure(self.config_source() or self.default_hosts)
+        except Exception as e:
+            logger.error(f"Could not load Ollama backend configuration: {e}")
+
+    def backends(self):
+        with self._lock:
+            return list(self._backends.values())
+
+    def healthy_count(self):
+        return sum(1 for backend in self.backends() if backend.healthy)
+
+    def add_listener(self, callback):
+        # Called with the number of healthy backends whenever it may have changed
+        self._listeners.append(callback)
+        callback(max(1, self.healthy_count()))
+
+    def _notify(self):
+        healthy = max(1, self.healthy_count())
+        for callback in self._listeners:
+            try:
+                callback(healthy)
+            except Exception as e:
+                logger.error(f"Error in backend listener: {e}")
+
+    def pick(self, model, exclude=()):
+        model = _canonical(model)
+        with self._lock:
+            candidates = [b for b in self._backends.values() if b.url not in exclude]
+            if not candidates:
+                raise NoBackendAvailable(f"No Ollama backend left to serve {model}")
+            # Stale health data shouldn't block requests outright; try everything if none look healthy
+            candidates = [b for b in candidates if b.healthy] or candidates
+            candidates = [b for b in candidates if not b.installed or model in b.installed] or candidates
+            backend = min(candidates, key=lambda b: (b.outstanding, b.failures))
+            if self.strategy == 'affinity':
+                loaded = [b for b in candidates if model in b.loaded]
+                if loaded:
+                    warm = min(loaded, key=lambda b: (b.outstanding, b.failures))
+                    if warm.outstanding <= backend.outstanding + self.affinity_slack:
+                        backend = warm
+            backend.outstanding += 1
+            # Sticks the model to this backend until the next health check says otherwise
+            backend.loaded.add(model)
+            return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def mark_failed(self, backend, error):
+        logger.warning(f"Ollama backend {backend.url} failed, taking it out of rotation: {error}")
+        with self._lock:
+            backend.healthy = False
+            backend.failures += 1
+            backend.last_error = str(error)
+        self._notify()
+
+    def mark_missing(self, backend, model):
+        model = _canonical(model)
+        with self._lock:
+            backend.installed.discard(model)
+            backend.loaded.discard(model)
+
+    def check(self, backend):
+        try:
+            from ollama import Client
+            client = Client(host=backend.url, timeout=OLLAMA_HEALTH_TIMEOUT)
+            installed = _model_names(client.list())
+            loaded = _model_names(client.ps())
+            with self._lock:
+                backend.installed = installed
+                backend.loaded = loaded
+                backend.healthy = True
+                backend.last_error = None
+        except Exception as e:
+            with self._lock:
+                backend.healthy = False
+                backend.last_error = str(e)
+            logger.warning(f"Health check failed for Ollama backend {backend.url}: {e}")
+        backend.last_checked = time.time()
+
+    def check_all(self):
+        self.reload()
+        for backend in self.backends():
+            self.check(backend)
+        self._notify()
+
+    def _check_loop(self, interval):
+        while True:
+            try:
+                self.check_all()
+            except Exception as e:
+                logger.error(f"Error checking Ollama backends: {e}")
+            time.sleep(interval)
+
+    def start_health_checks(self, interval=OLLAMA_HEALTH_INTERVAL):
+        with self._lock:
+            if self._checker_started:
+                return
+            self._checker_started = True
+        threading.Thread(target=self._check_loop, args=(interval,), name='llm-health', daemon=True).start()
+
+    def status(self):
+        return {'strategy': self.strategy, 'backends': [backend.status() for backend in self.backends()]}
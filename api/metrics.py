@@ -0,0 +1,234 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import functools
+import inspect
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics, exposed in the Prometheus text format at /metrics. Metrics are
+# identified by name plus labels (e.g. histogram('mongo_query_seconds', operation='load_window')).
+# Histograms keep cumulative buckets for Prometheus and a bounded window of recent samples
+# so percentiles stay cheap. Hot paths are instrumented with `timed` (a decorator for sync
+# and async functions, or a context manager) and `StreamStats`; with METRICS_ENABLED=false
+# they are skipped entirely: decorators return the function unchanged.
+#
+# Every process (each gunicorn worker) has its own registry; Prometheus scrapes them
+# through the same port, so run one worker per target or aggregate with a `sum by`.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Keep a bounded window of recent samples per metric so percentiles stay cheap
+SAMPLE_WINDOW = 1024
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, window=SAMPLE_WINDOW, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.total = 0.0
+        self._bucket_counts = [0] * (len(self.buckets) + 1)
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self._bucket_counts[index] += 1
+            self._samples.append(value)
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+    def render(self):
+        with self._lock:
+            counts = list(self._bucket_counts)
+            count, total = self.count, self.total
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels)} {_format_value(self.value)}"]
+
+
+_histograms = {}
+_counters = {}
+_registry_lock = threading.Lock()
+
+
+def histogram(name, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, _label_key(labels))
+    metric = _histograms.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _histograms.get(key)
+            if metric is None:
+                metric = _histograms[key] = Histogram(name, buckets=buckets, labels=key[1])
+    return metric
+
+
+def counter(name, **labels):
+    key = (name, _label_key(labels))
+    metric = _counters.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _counters.get(key)
+            if metric is None:
+                metric = _counters[key] = Counter(name, labels=key[1])
+    return metric
+
+
+class timed:
+    # Observes elapsed seconds into histogram `name`, either around a block
+    # (`with timed('s3_request_seconds', operation='upload'):`) or as a decorator
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self._started = None
+
+    def __enter__(self):
+        if METRICS_ENABLED:
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._started is not None:
+            histogram(self.name, **self.labels).observe(time.perf_counter() - self._started)
+        return False
+
+    def __call__(self, fn):
+        if not METRICS_ENABLED:
+            return fn
+        metric = histogram(self.name, **self.labels)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started)
+        return wrapper
+
+
+def _eval_rate(raw):
+    # Ollama reports the generated token count and time in its final chunk
+    try:
+        count, duration = raw['eval_count'], raw['eval_duration']
+    except (KeyError, TypeError):
+        return None
+    return count / (duration / 1e9) if count and duration else None
+
+
+class StreamStats:
+    # Time to first token and tokens/sec of one streamed LLM response. Call token() per
+    # streamed chunk and finish() with the last chunk's raw payload once it completed.
+    def __init__(self, **labels):
+        self.labels = labels
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            if METRICS_ENABLED:
+                histogram('llm_time_to_first_token_seconds', **self.labels).observe(self.first_token_at - self.started)
+        self.tokens += 1
+
+    def finish(self, raw=None):
+        if not METRICS_ENABLED or self.first_token_at is None:
+            return
+        rate = _eval_rate(raw)
+        if rate is None:
+            # Streamed chunks are roughly one token each
+            elapsed = time.perf_counter() - self.first_token_at
+            rate = self.tokens / elapsed if elapsed > 0 else None
+        if rate is not None:
+            histogram('llm_tokens_per_second', buckets=RATE_BUCKETS, **self.labels).observe(rate)
+
+
+def render_prometheus():
+    with _registry_lock:
+        metrics = sorted(list(_counters.values()) + list(_histograms.values()), key=lambda m: (m.name, m.labels))
+    lines = []
+    last_name = None
+    for metric in metrics:
+        if metric.name != last_name:
+            kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+            lines.append(f"# TYPE {metric.name} {kind}")
+            last_name = metric.name
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def record_ttft(endpoint, started):
+    if METRICS_ENABLED:
+        histogram('time_to_first_token_seconds', endpoint=endpoint).observe(time.perf_counter() - started)
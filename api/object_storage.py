@@ -0,0 +1,245 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Object storage service. Requests share one boto3 client (thread-safe, with a
+# connection pool sized for the upload and delete workers plus request threads). When
+# the storage settings change, a new client is built and swapped in as a single
+# reference assignment; every operation reads the current client once, so in-flight
+# calls finish on the client they started with. Large uploads go through the transfer
+# manager (multipart above S3_MULTIPART_THRESHOLD_MB). Prefix deletes page through the
+# listing and remove up to 1000 keys per DeleteObjects call, optionally on a
+# background worker.
+#
+# Stored images are served to browsers through presigned GET URLs, so image bytes never
+# pass through the API. A URL is reused until less than S3_PRESIGN_REFRESH_SECONDS of
+# its lifetime is left, which also keeps it stable for the browser's HTTP cache. If the
+# endpoint the API uses isn't reachable from browsers (e.g. a Docker service name), set
+# `public_endpoint_url` in the storage settings or S3_PUBLIC_ENDPOINT_URL; URLs are then
+# signed for that host.
+#
+# Health probes use a separate small client with short timeouts and no retries, so a
+# hung endpoint fails the readiness check instead of tying up a check thread.
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '50'))
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT_SECONDS', '5'))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT_SECONDS', '60'))
+S3_PROBE_TIMEOUT = float(os.getenv('S3_PROBE_TIMEOUT_SECONDS', '2'))
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8')) * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '8')) * 1024 * 1024
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', '4'))
+DELETE_BATCH_SIZE = 1000
+S3_PRESIGN_EXPIRES_SECONDS = int(os.getenv('S3_PRESIGN_EXPIRES_SECONDS', '3600'))
+S3_PRESIGN_REFRESH_SECONDS = int(os.getenv('S3_PRESIGN_REFRESH_SECONDS', '600'))
+S3_PRESIGN_CACHE_ENTRIES = int(os.getenv('S3_PRESIGN_CACHE_ENTRIES', '10000'))
+S3_PUBLIC_ENDPOINT_URL = os.getenv('S3_PUBLIC_ENDPOINT_URL', '')
+
+
+# boto3 is imported when the first client is built, not when the API starts
+@lru_cache(maxsize=None)
+def client_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={'max_attempts': 3, 'mode': 'standard'},
+        signature_version='s3v4'
+    )
+
+
+@lru_cache(maxsize=None)
+def probe_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=1,
+        connect_timeout=S3_PROBE_TIMEOUT,
+        read_timeout=S3_PROBE_TIMEOUT,
+        retries={'max_attempts': 0},
+        signature_version='s3v4'
+    )
+
+
+@lru_cache(maxsize=None)
+def transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=S3_TRANSFER_CONCURRENCY
+    )
+
+
+deletion_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('STORAGE_DELETE_WORKERS', '2')),
+    thread_name_prefix='storage-delete'
+)
+
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+class ObjectStorage:
+    def __init__(self, config_source):
+        # `config_source()` returns the current settings: endpoint_url, access_key, secret_key
+        self.config_source = config_source
+        self._client = None
+        self._presign_client = None
+        self._probe_client = None
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+        self._urls_lock = threading.Lock()
+
+    def _build_client(self, config, endpoint_url=None, settings=None):
+        import boto3
+        return boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url or config["endpoint_url"],
+            aws_access_key_id=config["access_key"],
+            aws_secret_access_key=config["secret_key"],
+            config=settings or client_config()
+        )
+
+    @property
+    def client(self):
+        client = self._client
+        if client is None:
+            client = self.reload()
+        return client
+
+    def reload(self):
+        # Serializes rebuilds; readers never see a half-configured client
+        with self._lock:
+            try:
+                config = self.config_source()
+                client = self._build_client(config)
+                public_endpoint = config.get("public_endpoint_url") or S3_PUBLIC_ENDPOINT_URL
+                # Signing is local; a second client only changes the host the URLs point at
+                presign_client = self._build_client(config, public_endpoint) if public_endpoint else client
+                probe_client = self._build_client(config, settings=probe_config())
+            except Exception as e:
+                logger.error(f"Error creating S3 client: {e}")
+                raise
+            self._client, self._presign_client, self._probe_client = client, presign_client, probe_client
+            with self._urls_lock:
+                self._urls.clear()
+            logger.debug("Swapped in a new S3 client")
+            return client
+
+    def presigned_url(self, bucket_name, key):
+        now = time.monotonic()
+        cache_key = (bucket_name, key)
+        with self._urls_lock:
+            entry = self._urls.get(cache_key)
+            if entry is not None and entry[1] - now > S3_PRESIGN_REFRESH_SECONDS:
+                self._urls.move_to_end(cache_key)
+                return entry[0]
+        if self._presign_client is None:
+            self.reload()
+        url = self._presign_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': key},
+            ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS
+        )
+        with self._urls_lock:
+            self._urls[cache_key] = (url, now + S3_PRESIGN_EXPIRES_SECONDS)
+            self._urls.move_to_end(cache_key)
+            while len(self._urls) > S3_PRESIGN_CACHE_ENTRIES:
+                self._urls.popitem(last=False)
+        return url
+
+    def ensure_bucket(self, bucket_name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.create_bucket(Bucket=bucket_name)
+            logger.debug(f"Ensured bucket {bucket_name} exists")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('BucketAlreadyOwnedByYou', 'BucketAlreadyExists'):
+                raise
+            logger.debug(f"Bucket {bucket_name} already exists")
+
+    def check_bucket(self, bucket_name):
+        # Readiness probe; raises if the bucket can't be reached within S3_PROBE_TIMEOUT
+        if self._probe_client is None:
+            self.reload()
+        self._probe_client.head_bucket(Bucket=bucket_name)
+
+    @timed('s3_request_seconds', operation='head_object')
+    def exists(self, bucket_name, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=bucket_name, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in NOT_FOUND_CODES:
+                return False
+            raise
+
+    @timed('s3_request_seconds', operation='upload')
+    def upload_fileobj(self, fileobj, bucket_name, key, content_type=None):
+        extra_args = {'ContentType': content_type} if content_type else None
+        self.client.upload_fileobj(fileobj, bucket_name, key, ExtraArgs=extra_args, Config=transfer_config())
+
+    @timed('s3_request_seconds', operation='put_object')
+    def put_object(self, bucket_name, key, body, content_type=None):
+        extra_args = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=bucket_name, Key=key, Body=body, **extra_args)
+
+    def list_objects(self, bucket_name, prefix):
+        # Yields (key, size) for every object under `prefix`, one page at a time
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj['Size']
+
+    @timed('s3_request_seconds', operation='get_object')
+    def open_object(self, bucket_name, key):
+        # Returns a streaming body; the caller reads and closes it
+        return self.client.get_object(Bucket=bucket_name, Key=key)['Body']
+
+    @timed('s3_request_seconds', operation='delete_object')
+    def delete_object(self, bucket_name, key):
+        self.client.delete_object(Bucket=bucket_name, Key=key)
+
+    @timed('s3_request_seconds', operation='delete_prefix')
+    def delete_prefix(self, bucket_name, prefix):
+        # Returns the number of deleted objects; raises if any key could not be deleted
+        client = self.client
+        deleted = 0
+        failed = []
+        batch = []
+
+        def flush():
+            nonlocal deleted
+            with timed('s3_request_seconds', operation='delete_objects'):
+                response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': batch, 'Quiet': True})
+            errors = response.get('Errors', [])
+            failed.extend(errors)
+            deleted += len(batch) - len(errors)
+            batch.clear()
+
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                batch.append({'Key': obj['Key']})
+                if len(batch) == DELETE_BATCH_SIZE:
+                    flush()
+        if batch:
+            flush()
+
+        if failed:
+            raise RuntimeError(f"Could not delete {len(failed)} objects under {prefix}: {failed[0].get('Message')}")
+        logger.info(f"Deleted {deleted} objects under {prefix} from bucket {bucket_name}")
+        return deleted
+
+    def delete_prefix_in_background(self, bucket_name, prefix):
+        def log_failure(future):
+            if future.exception():
+                logger.error(f"Error deleting {prefix} from bucket {bucket_name}: {future.exception()}")
+
+        future = deletion_executor.submit(self.delete_prefix, bucket_name, prefix)
+        future.add_done_callback(log_failure)
+        return future
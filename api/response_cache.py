@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from pymongo.errors import PyMongoError
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Opt-in cache of complete model responses for identical prompts. Keys cover the model,
+# the system prompt, the whitespace/case-normalized conversation sent to the model and,
+# for /image, the image content hash. Entries live in an in-process LRU in front of a
+# Mongo collection whose TTL index expires them; hits are replayed through the normal
+# SSE framing.
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE', 'false').lower() == 'true'
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv('RESPONSE_CACHE_MEMORY_ENTRIES', '256'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(24 * 3600)))
+
+_TOKEN_PATTERN = re.compile(r'\S+\s*|\s+')
+
+def normalize_content(text):
+    return ' '.join((text or '').split()).casefold()
+
+def cache_key(model, system_prompt, user_content, image_hash=None):
+    payload = json.dumps([model, system_prompt or '', normalize_content(user_content), image_hash], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def replay_response(text):
+    # Feed a cached answer back in word-sized deltas, shaped like stream_chat output
+    for piece in _TOKEN_PATTERN.findall(text):
+        yield SimpleNamespace(delta=piece)
+
+async def areplay_response(text):
+    for piece in _TOKEN_PATTERN.findall(text):
+        yield SimpleNamespace(delta=piece)
+
+
+class ResponseCache:
+    def __init__(self, collection, max_entries=RESPONSE_CACHE_MEMORY_ENTRIES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = counter('response_cache_memory_hits_total')
+        self.store_hits = counter('response_cache_store_hits_total')
+        self.misses = counter('response_cache_misses_total')
+        # Model time that would have been spent regenerating the cached answers
+        self.saved_seconds = counter('response_cache_saved_generation_seconds_total')
+
+    def ensure_indexes(self):
+        self.collection.create_index('expires_at', expireAfterSeconds=0, name='expires_at_ttl')
+
+    def _remember(self, key, response, expires_at, seconds):
+        with self._lock:
+            self._entries[key] = (response, expires_at, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.memory_hits.inc()
+                self.saved_seconds.inc(entry[2])
+                return entry[0]
+            if entry:
+                del self._entries[key]
+        try:
+            doc = self.collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.utcnow()}}, {'response': 1, 'expires_at': 1, 'generation_seconds': 1})
+        except PyMongoError as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+            doc = None
+        if doc is None:
+            self.misses.inc()
+            return None
+        self.store_hits.inc()
+        seconds = doc.get('generation_seconds') or 0.0
+        self.saved_seconds.inc(seconds)
+        remaining = (doc['expires_at'] - datetime.utcnow()).total_seconds()
+        self._remember(key, doc['response'], now + remaining, seconds)
+        return doc['response']
+
+    def put(self, key, response, model=None, generation_seconds=0.0):
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        self._remember(key, response, time.time() + self.ttl_seconds, generation_seconds)
+        try:
+            self.collection.update_one(
+                {'_id': key},
+                {'$set': {'response': response, 'model': model, 'generation_seconds': generation_seconds, 'expires_at': expires_at}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.warning(f"Response cache store failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return self.collection.delete_many({}).deleted_count
+
+    def stats(self):
+        hits = self.memory_hits.value + self.store_hits.value
+        lookups = hits + self.misses.value
+        return {
+            'enabled': RESPONSE_CACHE_ENABLED,
+            'memory_entries': len(self._entries),
+            'memory_hits': self.memory_hits.value,
+            'store_hits': self.store_hits.value,
+            'misses': self.misses.value,
+            'saved_generation_seconds': self.saved_seconds.value,
+            'hit_ratio': hits / lookups if lookups else None
+        }
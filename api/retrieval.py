@@ -0,0 +1,262 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Retrieval over local documents. The vector index is persisted under RAG_INDEX_DIR
+# next to a manifest of every ingested source (path -> sha256, document ids), so
+# re-running ingestion only re-embeds files whose content changed and drops files that
+# were removed. Embeddings come from a local Ollama embedding model (see
+# llm_registry.embedding_model) and are computed outside the index lock, so queries keep
+# being served while a large ingest runs. /chat can inject the top-k chunks into the
+# system prompt (form field `rag=true`, or RAG_CHAT=true for every request).
+#
+# Files in RAG_DATA_DIR are indexed with scope 'global' and are visible to every chat;
+# documents uploaded to a chat (see documents.py) carry its chat_id and are only
+# retrieved for that chat.
+#
+# llama_index takes seconds to import, so it is only imported once the index is used.
+#
+# Several processes may write the same index (API workers, the ingest command). Writers
+# hold an exclusive lock on RAG_INDEX_DIR/.lock and reload the index before changing
+# it, so one process never persists over another's changes.
+RAG_DATA_DIR = os.getenv('RAG_DATA_DIR', 'data')
+RAG_INDEX_DIR = os.getenv('RAG_INDEX_DIR', 'storage/rag_index')
+RAG_CHUNK_SIZE = int(os.getenv('RAG_CHUNK_SIZE', '512'))
+RAG_CHUNK_OVERLAP = int(os.getenv('RAG_CHUNK_OVERLAP', '64'))
+RAG_TOP_K = int(os.getenv('RAG_TOP_K', '4'))
+RAG_CHAT_ENABLED = os.getenv('RAG_CHAT', 'false').lower() == 'true'
+RAG_EMBED_BATCH = 32
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = '.lock'
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_splitter(chunk_size=RAG_CHUNK_SIZE, chunk_overlap=RAG_CHUNK_OVERLAP):
+    from llama_index.core.node_parser import SentenceSplitter
+    return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def prepare_documents(source, documents, metadata=None):
+    # Stable per-source ids, so re-ingesting a source replaces its documents
+    for i, document in enumerate(documents):
+        document.id_ = f"{source}#{i}"
+        document.metadata.update(metadata or {})
+        document.metadata['source'] = source
+    return [document.id_ for document in documents]
+
+
+def embed_nodes(nodes, embed_model, on_progress=None):
+    # Nodes that already carry an embedding are inserted into the index as they are
+    from llama_index.core.schema import MetadataMode
+    for start in range(0, len(nodes), RAG_EMBED_BATCH):
+        batch = nodes[start:start + RAG_EMBED_BATCH]
+        embeddings = embed_model.get_text_embedding_batch([n.get_content(metadata_mode=MetadataMode.EMBED) for n in batch])
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+        if on_progress:
+            on_progress(start + len(batch), len(nodes))
+    return nodes
+
+
+class DocumentIndex:
+    def __init__(self, embed_model_factory, index_dir=RAG_INDEX_DIR, chunk_size=RAG_CHUNK_SIZE, chunk_overlap=RAG_CHUNK_OVERLAP):
+        self.embed_model_factory = embed_model_factory
+        self.index_dir = index_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._index = None
+        self._manifest = None
+        self._loaded_mtime = None
+        # Guards the index and manifest; embedding happens outside it
+        self._lock = threading.RLock()
+        # One writer at a time across threads and processes (see _writing)
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+
+    def _manifest_path(self):
+        return os.path.join(self.index_dir, MANIFEST_FILE)
+
+    def _manifest_mtime(self):
+        try:
+            return os.stat(self._manifest_path()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        # Also picks up an index persisted by another process (e.g. the ingest command)
+        from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+        with self._lock:
+            mtime = self._manifest_mtime()
+            if self._index is not None and mtime == self._loaded_mtime:
+                return self._index
+            self._loaded_mtime = mtime
+            embed_model = self.embed_model_factory()
+            if os.path.exists(self._manifest_path()):
+                storage_context = StorageContext.from_defaults(persist_dir=self.index_dir)
+                self._index = load_index_from_storage(storage_context, embed_model=embed_model)
+                with open(self._manifest_path()) as f:
+                    self._manifest = json.load(f)
+                logger.info(f"Loaded RAG index from {self.index_dir} with {len(self._manifest)} sources")
+            else:
+                self._index = VectorStoreIndex(nodes=[], embed_model=embed_model)
+                self._manifest = {}
+            return self._index
+
+    @contextmanager
+    def _writing(self):
+        # Reentrant within a thread; queries aren't blocked, only other writers
+        with self._write_lock:
+            self._write_depth += 1
+            lock_file = None
+            try:
+                if self._write_depth == 1:
+                    os.makedirs(self.index_dir, exist_ok=True)
+                    lock_file = open(os.path.join(self.index_dir, LOCK_FILE), 'a')
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self._load()
+                yield
+            finally:
+                self._write_depth -= 1
+                if lock_file:
+                    # Closing the file releases the lock
+                    lock_file.close()
+
+    def _persist(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._index.storage_context.persist(persist_dir=self.index_dir)
+        # Manifest last and atomically: it only ever lists what the persisted index holds
+        tmp_path = self._manifest_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path())
+        self._loaded_mtime = self._manifest_mtime()
+
+    def _remove_locked(self, source):
+        entry = self._manifest.pop(source, None)
+        if entry:
+            for doc_id in entry['doc_ids']:
+                self._index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+    def add_documents(self, source, content_hash, documents, metadata=None, persist=True):
+        # Replaces whatever was indexed for `source`; returns the number of chunks
+        self._load()
+        doc_ids = prepare_documents(source, documents, metadata)
+        splitter = make_splitter(self.chunk_size, self.chunk_overlap)
+        nodes = embed_nodes(splitter.get_nodes_from_documents(documents), self.embed_model_factory())
+        return self.add_nodes(source, content_hash, nodes, doc_ids, persist)
+
+    def add_nodes(self, source, content_hash, nodes, doc_ids, persist=True):
+        # For nodes chunked and embedded elsewhere (e.g. in a worker process)
+        with self._writing(), self._lock:
+            self._remove_locked(source)
+            self._index.insert_nodes(nodes)
+            self._manifest[source] = {
+                'sha256': content_hash,
+                'doc_ids': doc_ids,
+                'chunks': len(nodes),
+                'ingested_at': datetime.utcnow().isoformat()
+            }
+            if persist:
+                self._persist()
+        return len(nodes)
+
+    def remove(self, source, persist=True):
+        with self._writing(), self._lock:
+            self._remove_locked(source)
+            if persist:
+                self._persist()
+
+    def remove_prefix(self, prefix):
+        with self._writing(), self._lock:
+            sources = [source for source in self._manifest if source.startswith(prefix)]
+            for source in sources:
+                self._remove_locked(source)
+            if sources:
+                self._persist()
+        return len(sources)
+
+    def ingest_directory(self, data_dir=RAG_DATA_DIR, rebuild=False):
+        # Every file under data_dir becomes source "data/<relative path>"
+        from llama_index.core import SimpleDirectoryReader
+        stats = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'failed': 0, 'chunks': 0}
+        # One ingest at a time, so two runs don't embed the same changed file twice
+        with self._writing():
+            seen = set()
+            for root, _, files in os.walk(data_dir):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    source = 'data/' + os.path.relpath(path, data_dir).replace(os.sep, '/')
+                    seen.add(source)
+                    content_hash = file_sha256(path)
+                    entry = self._manifest.get(source)
+                    if entry and entry['sha256'] == content_hash and not rebuild:
+                        stats['unchanged'] += 1
+                        continue
+                    try:
+                        documents = SimpleDirectoryReader(input_files=[path]).load_data()
+                        stats['chunks'] += self.add_documents(source, content_hash, documents, {'scope': 'global', 'file_name': name}, persist=False)
+                    except Exception as e:
+                        logger.error(f"Could not ingest {path}: {e}")
+                        stats['failed'] += 1
+                        continue
+                    stats['updated' if entry else 'added'] += 1
+                    logger.info(f"Ingested {source}")
+            with self._lock:
+                for source in [s for s in self._manifest if s.startswith('data/') and s not in seen]:
+                    self._remove_locked(source)
+                    stats['removed'] += 1
+                self._persist()
+        return stats
+
+    def retrieve(self, query, top_k=RAG_TOP_K, chat_id=None):
+        # Returns [(text, source, score)], best first, from the global documents and
+        # those uploaded to `chat_id`
+        from llama_index.core.schema import QueryBundle
+        from llama_index.core.vector_stores import MetadataFilters, MetadataFilter, FilterCondition
+        index = self._load()
+        if not self._manifest:
+            return []
+        embedding = self.embed_model_factory().get_query_embedding(query)
+        scopes = [MetadataFilter(key='scope', value='global')]
+        if chat_id:
+            scopes.append(MetadataFilter(key='chat_id', value=chat_id))
+        filters = MetadataFilters(filters=scopes, condition=FilterCondition.OR)
+        with self._lock:
+            retriever = index.as_retriever(similarity_top_k=top_k, filters=filters)
+            results = retriever.retrieve(QueryBundle(query_str=query, embedding=embedding))
+        return [(r.node.get_content(), r.node.metadata.get('source'), r.score) for r in results]
+
+    def stats(self):
+        self._load()
+        with self._lock:
+            return {
+                'index_dir': self.index_dir,
+                'sources': len(self._manifest),
+                'chunks': sum(entry['chunks'] for entry in self._manifest.values())
+            }
+
+
+def with_retrieved_context(system_prompt, chunks):
+    if not chunks:
+        return system_prompt
+    context = "\n\n".join(f"[{i}] ({source})\n{text}" for i, (text, source, _) in enumerate(chunks, 1))
+    return f"{system_prompt}\n\nUse the following excerpts when they are relevant to the question, and cite them by number:\n\n{context}"
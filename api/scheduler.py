@@ -0,0 +1,288 @@
+import os
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Admission control in front of Ollama. Each model has a cap on concurrent generations
+# (OLLAMA_MAX_CONCURRENT, overridable per model with OLLAMA_MODEL_CONCURRENCY, e.g.
+# "llama3.2-vision=1,qwen2.5:7b=4") and a priority queue for everything waiting on it.
+# Short background calls (titles, summaries) outrank interactive streams, so they never
+# wait behind a long vision generation's backlog. When more than OLLAMA_MAX_QUEUE
+# requests are already waiting for a model, new interactive requests are rejected
+# (HTTP 429) instead of piling up until they hit the request timeout. Caps are per
+# Ollama backend: with several healthy backends a model may run that many times over.
+#
+# admit() checks the queue depth and reserves a place in one step, so a burst of
+# requests can't all pass the check before any of them is counted. Reservations don't
+# hold a model slot: the request's pre-processing (history, retrieval, uploads) runs
+# without one. The stream that serves the request claims the ticket when it starts
+# pulling from the model, which is when it joins the queue for a slot. A ticket that is
+# never claimed (an error before the response, or a response that is never consumed)
+# must be abandoned to free its place.
+#
+# Background calls wait at most OLLAMA_SLOT_TIMEOUT_SECONDS for a slot and are skipped
+# (SlotTimeout) rather than piling up behind a long backlog.
+OLLAMA_MAX_CONCURRENT = int(os.getenv('OLLAMA_MAX_CONCURRENT', '2'))
+OLLAMA_MODEL_CONCURRENCY = os.getenv('OLLAMA_MODEL_CONCURRENCY', '')
+OLLAMA_MAX_QUEUE = int(os.getenv('OLLAMA_MAX_QUEUE', '32'))
+OLLAMA_SLOT_TIMEOUT = float(os.getenv('OLLAMA_SLOT_TIMEOUT_SECONDS', '60'))
+
+PRIORITY_TITLE = 0
+PRIORITY_SUMMARY = 1
+PRIORITY_INTERACTIVE = 5
+
+
+class QueueFull(Exception):
+    def __init__(self, model, depth):
+        super().__init__(f"Too many requests queued for {model} ({depth} waiting)")
+        self.model = model
+        self.depth = depth
+
+
+class SlotTimeout(Exception):
+    def __init__(self, model, timeout):
+        super().__init__(f"No slot for {model} within {timeout:g}s")
+        self.model = model
+
+
+class Ticket:
+    RESERVED, WAITING, GRANTED, RELEASED, CANCELLED = 'reserved', 'waiting', 'granted', 'released', 'cancelled'
+
+    def __init__(self, queue, priority, seq, state=WAITING):
+        self.queue = queue
+        self.priority = priority
+        self.seq = seq
+        self.state = state
+        self.claimed = False
+        self._ready = threading.Event()
+        self._listeners = []
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def granted(self):
+        return self.state == Ticket.GRANTED
+
+    @property
+    def cancelled(self):
+        return self.state == Ticket.CANCELLED
+
+    def on_ready(self, callback):
+        # Called once, from whichever thread grants or cancels the ticket
+        with self.queue.lock:
+            if self.state in (Ticket.RESERVED, Ticket.WAITING):
+                self._listeners.append(callback)
+                return
+        callback()
+
+    def _notify(self):
+        self._ready.set()
+        listeners, self._listeners = self._listeners, []
+        for callback in listeners:
+            callback()
+
+    def wait(self, timeout=None):
+        # True once granted; False on timeout or if the ticket was cancelled
+        self._ready.wait(timeout)
+        return self.granted
+
+    def position(self):
+        return self.queue.position(self)
+
+    def release(self):
+        self.queue.release(self)
+
+    def cancel(self):
+        # Withdraws a reserved or waiting ticket; a granted one keeps its slot until released
+        self.queue.cancel(self)
+
+    def close(self):
+        self.cancel()
+        self.release()
+
+    def claim(self):
+        # The caller now owns the ticket and closes it when done; a reserved ticket
+        # joins the queue for a slot
+        self.claimed = True
+        self.queue.claim(self)
+        return self
+
+    def abandon(self):
+        if not self.claimed:
+            self.close()
+
+
+class ModelQueue:
+    def __init__(self, model, max_concurrent, max_queue, scale=1):
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.scale = scale
+        self.active = 0
+        self.reserved = 0
+        self.waiting = []
+        self.lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _depth_locked(self):
+        # Waiting tickets, plus reservations that won't find a free slot when claimed
+        free = max(0, self.max_concurrent * self.scale - self.active)
+        return len(self.waiting) + max(0, self.reserved - free)
+
+    def reserve(self, priority):
+        with self.lock:
+            depth = self._depth_locked()
+            if depth >= self.max_queue:
+                raise QueueFull(self.model, depth)
+            self.reserved += 1
+            return Ticket(self, priority, next(self._seq), Ticket.RESERVED)
+
+    def enqueue(self, priority):
+        with self.lock:
+            ticket = Ticket(self, priority, next(self._seq))
+            heapq.heappush(self.waiting, ticket)
+            granted = self._grant_locked()
+        for t in granted:
+            t._notify()
+        return ticket
+
+    def claim(self, ticket):
+        with self.lock:
+            if ticket.state != Ticket.RESERVED:
+                return
+            self.reserved -= 1
+            ticket.state = Ticket.WAITING
+            heapq.heappush(self.waiting, ticket)
+            granted = self._grant_locked()
+        for t in granted:
+            t._notify()
+
+    def _grant_locked(self):
+        granted = []
+        while self.waiting and self.active < self.max_concurrent * self.scale:
+            ticket = heapq.heappop(self.waiting)
+            ticket.state = Ticket.GRANTED
+            self.active += 1
+            granted.append(ticket)
+        return granted
+
+    def position(self, ticket):
+        with self.lock:
+            if ticket.state == Ticket.RESERVED:
+                return len(self.waiting)
+            if ticket.state != Ticket.WAITING:
+                return 0
+            return sum(1 for other in self.waiting if other < ticket)
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.state != Ticket.GRANTED:
+                return
+            ticket.state = Ticket.RELEASED
+            self.active -= 1
+            granted = self._grant_locked()
+        for t in granted:
+            t._notify()
+
+    def cancel(self, ticket):
+        with self.lock:
+            if ticket.state == Ticket.RESERVED:
+                self.reserved -= 1
+            elif ticket.state == Ticket.WAITING:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+            else:
+                return
+            ticket.state = Ticket.CANCELLED
+        ticket._notify()
+
+    def set_scale(self, scale):
+        with self.lock:
+            self.scale = scale
+            granted = self._grant_locked()
+        for t in granted:
+            t._notify()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_concurrent': self.max_concurrent * self.scale,
+                'active': self.active,
+                'reserved': self.reserved,
+                'waiting': len(self.waiting)
+            }
+
+
+@contextmanager
+def reserved(ticket):
+    # Gives the ticket's place back if the request fails before a stream claims it
+    try:
+        yield ticket
+    except BaseException:
+        ticket.abandon()
+        raise
+
+
+def _parse_model_limits(spec):
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        model, _, limit = item.rpartition('=')
+        limits[model] = int(limit)
+    return limits
+
+
+class Scheduler:
+    def __init__(self, default_concurrency=OLLAMA_MAX_CONCURRENT, model_concurrency=OLLAMA_MODEL_CONCURRENCY, max_queue=OLLAMA_MAX_QUEUE):
+        self.default_concurrency = default_concurrency
+        self.model_limits = _parse_model_limits(model_concurrency)
+        self.max_queue = max_queue
+        self.scale = 1
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def queue_for(self, model):
+        with self._lock:
+            if model not in self._queues:
+                limit = self.model_limits.get(model, self.default_concurrency)
+                self._queues[model] = ModelQueue(model, limit, self.max_queue, self.scale)
+            return self._queues[model]
+
+    def set_scale(self, scale):
+        with self._lock:
+            self.scale = max(1, scale)
+            queues = list(self._queues.values())
+        for queue in queues:
+            queue.set_scale(self.scale)
+
+    def admit(self, model, priority=PRIORITY_INTERACTIVE):
+        # Returns the request's reserved ticket, or raises QueueFull
+        return self.queue_for(model).reserve(priority)
+
+    def enqueue(self, model, priority=PRIORITY_INTERACTIVE):
+        return self.queue_for(model).enqueue(priority)
+
+    @contextmanager
+    def slot(self, model, priority, timeout=OLLAMA_SLOT_TIMEOUT):
+        # Blocking acquire for short background calls; raises SlotTimeout if no slot
+        # frees up within `timeout` seconds
+        ticket = self.enqueue(model, priority)
+        try:
+            if not ticket.wait(timeout):
+                logger.warning(f"Skipping background call: no slot for {model} within {timeout:g}s")
+                raise SlotTimeout(model, timeout)
+            yield ticket
+        finally:
+            ticket.close()
+
+    def stats(self):
+        with self._lock:
+            queues = dict(self._queues)
+        return {model: queue.stats() for model, queue in queues.items()}
+
+
+scheduler = Scheduler()
@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+# Deferred initialization of the API's external dependencies (Mongo, object storage,
+# LLM backends). Importing the app only registers them; each one is initialized on first
+# use (`ensure`), or by a parallel startup phase (`start`) that keeps retrying in the
+# background, so a dependency that is down at boot no longer kills the process. Requests
+# that need a dependency that isn't available get a 503 (DependencyUnavailable).
+#
+# /health/live only says the process is up. /health/ready runs each dependency's check
+# in parallel and reports them separately; it fails while a required dependency is down.
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'background')  # background | lazy
+STARTUP_RETRY_SECONDS = float(os.getenv('STARTUP_RETRY_SECONDS', '5'))
+STARTUP_MAX_RETRY_SECONDS = 60.0
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT_SECONDS', '2'))
+IMPORT_BUDGET_SECONDS = float(os.getenv('IMPORT_BUDGET_MS', '1000')) / 1000
+
+PENDING = 'pending'
+STARTING = 'starting'
+READY = 'ready'
+FAILED = 'failed'
+
+check_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='readiness')
+
+
+class DependencyUnavailable(Exception):
+    def __init__(self, name, error):
+        super().__init__(f"{name} is unavailable: {error}")
+        self.name = name
+
+
+class Dependency:
+    def __init__(self, name, init, check=None, required=True):
+        self.name = name
+        self.init = init
+        self.check = check
+        self.required = required
+        self.state = PENDING
+        self.error = None
+        self.init_seconds = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        if self.state == READY:
+            return
+        # Concurrent callers wait for the attempt in flight instead of starting their own
+        with self._lock:
+            if self.state == READY:
+                return
+            if self.state == FAILED and time.monotonic() - self._last_attempt < STARTUP_RETRY_SECONDS:
+                raise DependencyUnavailable(self.name, self.error)
+            self.state = STARTING
+            self._last_attempt = time.monotonic()
+            started = time.perf_counter()
+            try:
+                self.init()
+            except Exception as e:
+                self.state, self.error = FAILED, str(e)
+                logger.error(f"Could not initialize {self.name}: {e}")
+                raise DependencyUnavailable(self.name, e) from e
+            self.init_seconds = time.perf_counter() - started
+            self.state, self.error = READY, None
+            logger.info(f"Initialized {self.name} in {self.init_seconds:.2f}s")
+
+    def status(self):
+        return {
+            'state': self.state,
+            'required': self.required,
+            'init_seconds': round(self.init_seconds, 3) if self.init_seconds is not None else None,
+            'error': self.error
+        }
+
+
+class Startup:
+    def __init__(self):
+        self.dependencies = {}
+        self.started_at = time.time()
+        self.import_seconds = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    def register(self, name, init, check=None, required=True):
+        # `init` sets the dependency up (idempotent; retried after failures), `check`
+        # raises if it currently isn't usable. Optional dependencies don't affect readiness.
+        self.dependencies[name] = Dependency(name, init, check, required)
+
+    def ensure(self, *names):
+        for name in names:
+            self.dependencies[name].ensure()
+
+    def is_ready(self, *names):
+        return all(self.dependencies[name].state == READY for name in names)
+
+    def _initialize(self, dependency):
+        delay = STARTUP_RETRY_SECONDS
+        while True:
+            try:
+                dependency.ensure()
+                return
+            except DependencyUnavailable:
+                time.sleep(delay)
+                delay = min(delay * 2, STARTUP_MAX_RETRY_SECONDS)
+
+    def start(self):
+        # Initializes every dependency in parallel, in the background
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for dependency in self.dependencies.values():
+            threading.Thread(target=self._initialize, args=(dependency,), name=f"startup-{dependency.name}", daemon=True).start()
+
+    def imported(self, started):
+        # Call at the end of the app module with the perf_counter value from its top
+        self.import_seconds = time.perf_counter() - started
+        if self.import_seconds > IMPORT_BUDGET_SECONDS:
+            logger.warning(f"App import took {self.import_seconds:.2f}s, over the {IMPORT_BUDGET_SECONDS:.2f}s budget")
+        else:
+            logger.info(f"App imported in {self.import_seconds:.2f}s")
+
+    def liveness(self):
+        return {
+            'status': 'alive',
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'import_seconds': round(self.import_seconds, 3) if self.import_seconds is not None else None
+        }
+
+    def _check(self, dependency):
+        # A probe counts as a first use, so with STARTUP_MODE=lazy it initializes too
+        dependency.ensure()
+        if dependency.check is not None:
+            dependency.check()
+        return True
+
+    def readiness(self):
+        # Returns (ready, per-dependency status)
+        futures = {name: check_executor.submit(self._check, dep) for name, dep in self.dependencies.items()}
+        deadline = time.monotonic() + READINESS_TIMEOUT
+        report = {}
+        for name, future in futures.items():
+            try:
+                ok, error = future.result(timeout=max(0.0, deadline - time.monotonic())), None
+            except FutureTimeout:
+                ok, error = False, f"check timed out after {READINESS_TIMEOUT:.1f}s"
+            except Exception as e:
+                ok, error = False, str(e)
+            status = self.dependencies[name].status()
+            status['ok'] = ok
+            status['error'] = error or status['error']
+            report[name] = status
+        ready = all(status['ok'] for name, status in report.items() if self.dependencies[name].required)
+        return ready, report
+
+
+startup = Startup()
@@ -0,0 +1,404 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import weakref
+from metrics import record_ttft, counter, METRICS_ENABLED
+from generations import finish_generation
+
+logger = logging.getLogger(__name__)
+
+# Shared SSE engine for /chat and /image.
+#
+# Upstream deltas are kept verbatim in list buffers and coalesced into frames on a
+# time/size window instead of per token, so long answers don't pay for repeated string
+# concatenation and the client receives a handful of frames per second. Multi-line text
+# is framed as multiple `data:` lines, which the client joins back with newlines, so
+# whitespace survives intact. While the model is silent (e.g. loading or prefilling) a
+# comment line is sent every SSE_HEARTBEAT_SECONDS so proxies keep the connection open
+# and a closed client is noticed. When the client goes away or the generation is
+# cancelled, the upstream stream is closed rather than run to completion and the partial
+# answer is handed to on_complete as truncated. Streams that have to wait for a model
+# slot (see scheduler.py) report their queue position as `event: queue` frames and only
+# start the upstream request once admitted. Frames and bytes sent are counted per
+# endpoint (sse_frames_total, sse_bytes_total).
+SSE_FLUSH_INTERVAL = float(os.getenv('SSE_FLUSH_INTERVAL_MS', '50')) / 1000.0
+SSE_FLUSH_BYTES = int(os.getenv('SSE_FLUSH_BYTES', '512'))
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+QUEUE_POLL_SECONDS = 1.0
+
+HEARTBEAT = ": keep-alive\n\n"
+# Keep caches and reverse proxies (nginx, APISIX) from buffering the stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+DONE = "[DONE]"
+
+_END = object()
+_CANCELLED = object()
+# The event loop only keeps weak references to tasks; hold on to the drain tasks that
+# save disconnected answers until they finish
+_background_tasks = set()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def format_event(data, event=None):
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+class _Coalescer:
+    def __init__(self, flush_interval, flush_bytes):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.parts = []
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, delta):
+        self.parts.append(delta)
+        self.pending.append(delta)
+        self.pending_bytes += len(delta)
+
+    def due(self):
+        return self.pending and (
+            self.pending_bytes >= self.flush_bytes
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        )
+
+    def timeout(self, heartbeat):
+        # How long to wait for the next delta before flushing or sending a heartbeat
+        if self.pending:
+            return max(0.0, self.last_flush + self.flush_interval - time.monotonic())
+        return heartbeat
+
+    def flush(self):
+        frame = format_event("".join(self.pending))
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        return frame
+
+    def text(self):
+        return "".join(self.parts)
+
+
+def _pump(deltas, items, stop, ticket=None):
+    try:
+        for r in deltas:
+            if stop.is_set():
+                break
+            items.put(r.delta)
+        items.put(_END)
+    except Exception as e:
+        items.put(_Failure(e))
+    finally:
+        # Closing the generator closes the underlying HTTP response
+        close = getattr(deltas, 'close', None)
+        if close:
+            close()
+        if ticket is not None:
+            ticket.release()
+
+
+def _generation_event(generation):
+    return format_event(generation.id, event='generation')
+
+
+class _QueueReporter:
+    # Turns a waiting ticket into `event: queue` frames (1-based position, 0 once
+    # admitted), with heartbeats in between while the position doesn't move
+    def __init__(self, ticket, heartbeat):
+        self.ticket = ticket
+        self.heartbeat = heartbeat
+        self.reported = None
+        self.last_frame = time.monotonic()
+
+    def frame(self):
+        position = self.ticket.position() + 1
+        if position != self.reported:
+            self.reported = position
+            self.last_frame = time.monotonic()
+            return format_event(str(position), event='queue')
+        if time.monotonic() - self.last_frame >= self.heartbeat:
+            self.last_frame = time.monotonic()
+            return HEARTBEAT
+        return None
+
+    def admitted(self):
+        return format_event("0", event='queue') if self.reported is not None and self.ticket.granted else None
+
+
+def _wait_for_slot(ticket, heartbeat):
+    reporter = _QueueReporter(ticket, heartbeat)
+    while not ticket.wait(QUEUE_POLL_SECONDS):
+        if ticket.cancelled:
+            return
+        frame = reporter.frame()
+        if frame:
+            yield frame
+    frame = reporter.admitted()
+    if frame:
+        yield frame
+
+
+async def _await_slot(ticket, heartbeat):
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    ticket.on_ready(lambda: loop.call_soon_threadsafe(ready.set))
+    reporter = _QueueReporter(ticket, heartbeat)
+    while True:
+        try:
+            await asyncio.wait_for(ready.wait(), timeout=QUEUE_POLL_SECONDS)
+            break
+        except asyncio.TimeoutError:
+            frame = reporter.frame()
+            if frame:
+                yield frame
+    frame = reporter.admitted()
+    if frame:
+        yield frame
+
+
+def _counted(endpoint, frames):
+    frame_count = counter('sse_frames_total', endpoint=endpoint)
+    byte_count = counter('sse_bytes_total', endpoint=endpoint)
+    try:
+        for frame in frames:
+            frame_count.inc()
+            byte_count.inc(len(frame.encode()))
+            yield frame
+    finally:
+        # Passes a client disconnect on to the stream's own cleanup
+        frames.close()
+
+
+async def _acounted(endpoint, frames):
+    frame_count = counter('sse_frames_total', endpoint=endpoint)
+    byte_count = counter('sse_bytes_total', endpoint=endpoint)
+    try:
+        async for frame in frames:
+            frame_count.inc()
+            byte_count.inc(len(frame.encode()))
+            yield frame
+    finally:
+        await frames.aclose()
+
+
+def _guarded(stream, ticket):
+    # A response that is dropped before it's consumed never runs the stream's cleanup;
+    # give the scheduler its place back when the stream is collected unclaimed
+    if ticket is not None:
+        weakref.finalize(stream, ticket.abandon)
+    return stream
+
+
+def sse_stream(deltas, on_complete, endpoint=None, started=None, generation=None, ticket=None, **kwargs):
+    frames = _sse_frames(deltas, on_complete, endpoint, started, generation, ticket, **kwargs)
+    return _guarded(_counted(endpoint, frames) if METRICS_ENABLED else frames, ticket)
+
+
+def asse_stream(deltas, on_complete, endpoint=None, started=None, generation=None, ticket=None, **kwargs):
+    frames = _asse_frames(deltas, on_complete, endpoint, started, generation, ticket, **kwargs)
+    return _guarded(_acounted(endpoint, frames) if METRICS_ENABLED else frames, ticket)
+
+
+def _sse_frames(deltas, on_complete, endpoint=None, started=None, generation=None, ticket=None,
+                flush_interval=SSE_FLUSH_INTERVAL, flush_bytes=SSE_FLUSH_BYTES, heartbeat=SSE_HEARTBEAT_SECONDS):
+    # `deltas` is a stream_chat-style iterator of objects with `.delta`. It is consumed on
+    # a helper thread so heartbeats and timed flushes can go out while it blocks, and so
+    # a cancel can end the response without waiting for the next token.
+    # `on_complete(text, truncated)` runs once, also for cancelled or disconnected
+    # streams, and may yield extra frames. `ticket` is the request's reserved scheduler
+    # ticket (see scheduler.admit); it queues for a model slot once the stream starts, the
+    # upstream request waits until it is granted and the slot is released when the
+    # request ends.
+    if ticket is not None:
+        ticket.claim()
+    items = queue.Queue()
+    stop = threading.Event()
+    pump = threading.Thread(target=_pump, args=(deltas, items, stop, ticket), name='sse-pump', daemon=True)
+    buffer = _Coalescer(flush_interval, flush_bytes)
+    first_token = True
+    completed = False
+    drained = False
+
+    try:
+        if generation is not None:
+            generation.on_cancel(lambda: items.put(_CANCELLED))
+            yield _generation_event(generation)
+        if ticket is not None:
+            if generation is not None:
+                generation.on_cancel(ticket.cancel)
+            yield from _wait_for_slot(ticket, heartbeat)
+        if ticket is None or ticket.granted:
+            pump.start()
+        while True:
+            try:
+                item = items.get(timeout=buffer.timeout(heartbeat))
+            except queue.Empty:
+                yield buffer.flush() if buffer.pending else HEARTBEAT
+                continue
+            if item is _END:
+                drained = True
+                break
+            if item is _CANCELLED:
+                stop.set()
+                if buffer.pending:
+                    yield buffer.flush()
+                completed = True
+                yield from on_complete(buffer.text(), True) or ()
+                yield format_event("Generation cancelled", event='cancelled')
+                yield format_event(DONE)
+                return
+            if isinstance(item, _Failure):
+                drained = True
+                logger.error(f"Upstream stream failed: {item.error}")
+                if buffer.pending:
+                    yield buffer.flush()
+                yield format_event(f"Error generating response: {item.error}", event='error')
+                break
+            if not item:
+                continue
+            if first_token and started is not None:
+                record_ttft(endpoint, started)
+                first_token = False
+            buffer.add(item)
+            if buffer.due():
+                yield buffer.flush()
+
+        if buffer.pending:
+            yield buffer.flush()
+        completed = True
+        yield from on_complete(buffer.text(), False) or ()
+        yield format_event(DONE)
+    finally:
+        # Reached on normal completion and when the server closes the generator because
+        # the client disconnected; either way stop pulling from upstream
+        stop.set()
+        if pump.is_alive() and not drained:
+            # The pump may be blocked on a stalled upstream and only sees `stop` after
+            # the next token; abort the request so it exits and releases the slot now
+            abort = getattr(deltas, 'abort', None)
+            if abort:
+                abort()
+        elif ticket is not None:
+            # Never admitted (or already done); the pump releases the slot otherwise
+            ticket.close()
+        if generation is not None:
+            finish_generation(generation)
+        if not completed:
+            logger.info(f"Client disconnected from /{endpoint}, keeping the partial response")
+            for _ in on_complete(buffer.text(), True) or ():
+                pass
+
+
+async def wait_for_saves(timeout):
+    # For the ASGI lifespan shutdown: lets answers saved for disconnected or cancelled
+    # streams reach the database before the event loop closes
+    if _background_tasks:
+        logger.info(f"Waiting for {len(_background_tasks)} partial answers to be saved")
+        await asyncio.wait(set(_background_tasks), timeout=timeout)
+
+async def _asse_frames(deltas, on_complete, endpoint=None, started=None, generation=None, ticket=None,
+                       flush_interval=SSE_FLUSH_INTERVAL, flush_bytes=SSE_FLUSH_BYTES, heartbeat=SSE_HEARTBEAT_SECONDS):
+    # Async counterpart for the ASGI entry point. `deltas` is an astream_chat-style async
+    # iterator and `on_complete(text, truncated)` an async generator. Cancelling the pump
+    # task aborts the upstream request immediately, both on DELETE /generation/<id> and
+    # when the response task is cancelled because the client went away.
+    if ticket is not None:
+        ticket.claim()
+    items = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    async def pump():
+        try:
+            async for r in deltas:
+                await items.put(r.delta)
+            await items.put(_END)
+        except Exception as e:
+            await items.put(_Failure(e))
+
+    task = None
+    buffer = _Coalescer(flush_interval, flush_bytes)
+    first_token = True
+    completed = False
+
+    async def drain(frames):
+        async for _ in frames:
+            pass
+
+    try:
+        if generation is not None:
+            # DELETE /generation/<id> is served on another thread
+            generation.on_cancel(lambda: loop.call_soon_threadsafe(items.put_nowait, _CANCELLED))
+            yield _generation_event(generation)
+        if ticket is not None:
+            if generation is not None:
+                generation.on_cancel(ticket.cancel)
+            async for frame in _await_slot(ticket, heartbeat):
+                yield frame
+        if ticket is None or ticket.granted:
+            task = asyncio.create_task(pump())
+            if ticket is not None:
+                # Runs even if the task is cancelled before it starts
+                task.add_done_callback(lambda _: ticket.release())
+        while True:
+            try:
+                item = await asyncio.wait_for(items.get(), timeout=buffer.timeout(heartbeat))
+            except asyncio.TimeoutError:
+                yield buffer.flush() if buffer.pending else HEARTBEAT
+                continue
+            if item is _END:
+                break
+            if item is _CANCELLED:
+                if task is not None:
+                    task.cancel()
+                if buffer.pending:
+                    yield buffer.flush()
+                completed = True
+                async for frame in on_complete(buffer.text(), True):
+                    yield frame
+                yield format_event("Generation cancelled", event='cancelled')
+                yield format_event(DONE)
+                return
+            if isinstance(item, _Failure):
+                logger.error(f"Upstream stream failed: {item.error}")
+                if buffer.pending:
+                    yield buffer.flush()
+                yield format_event(f"Error generating response: {item.error}", event='error')
+                break
+            if not item:
+                continue
+            if first_token and started is not None:
+                record_ttft(endpoint, started)
+                first_token = False
+            buffer.add(item)
+            if buffer.due():
+                yield buffer.flush()
+
+        if buffer.pending:
+            yield buffer.flush()
+        completed = True
+        async for frame in on_complete(buffer.text(), False):
+            yield frame
+        yield format_event(DONE)
+    finally:
+        if task is not None:
+            task.cancel()
+        elif ticket is not None:
+            ticket.close()
+        if generation is not None:
+            finish_generation(generation)
+        if not completed:
+            # The response task is being cancelled; save the partial answer on its own task
+            logger.info(f"Client disconnected from /{endpoint}, keeping the partial response")
+            saving = loop.create_task(drain(on_complete(buffer.text(), True)))
+            _background_tasks.add(saving)
+            saving.add_done_callback(_background_tasks.discard)
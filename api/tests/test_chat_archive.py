@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+from moto import mock_aws
+from chat_archive import ChatArchiver, ChatExists, ARCHIVE_JOB, archive_key, to_ndjson, from_ndjson
+from chat_store import ChatStore
+from object_storage import ObjectStorage
+
+BUCKET = 'test-bucket'
+OLD = datetime.utcnow() - timedelta(days=60)
+
+
+@pytest.fixture
+def archiver():
+    with mock_aws():
+        db = mongomock.MongoClient()['test']
+        store = ChatStore(db)
+        store.ensure_indexes()
+        storage = ObjectStorage(lambda: {'endpoint_url': 'https://s3.amazonaws.com', 'access_key': 'test', 'secret_key': 'test'})
+        storage.ensure_bucket(BUCKET)
+        yield ChatArchiver(store, storage, lambda: BUCKET, db['jobs'])
+
+
+def add_chat(archiver, chat_id, when=OLD, images=0):
+    archiver.store.append_message(chat_id, {'role': 'user', 'content': f"hello from {chat_id}", 'timestamp': when})
+    for index in range(images):
+        archiver.storage.put_object(BUCKET, f"images/{chat_id}/{index}.png", b'png', 'image/png')
+
+
+def test_ndjson_round_trip_keeps_timestamps():
+    chat = {'chat_id': 'c', 'messages': [{'role': 'user', 'content': 'hi', 'timestamp': datetime(2026, 1, 1, 12)}]}
+    assert list(from_ndjson(to_ndjson([chat]))) == [chat]
+    with pytest.raises(ValueError):
+        list(from_ndjson(['{"title": "no id"}']))
+
+
+def test_archive_and_restore(archiver):
+    add_chat(archiver, 'cold', images=2)
+    add_chat(archiver, 'hot', when=datetime.utcnow())
+    stats = archiver.archive(30)
+    assert stats == {'archived': 1, 'images': 2, 'kept': 0, 'failed': 0}
+    assert archiver.store.chats.count_documents({}) == 1
+    assert archiver.storage.exists(BUCKET, archive_key('cold'))
+    assert list(archiver.storage.list_objects(BUCKET, 'images/cold/')) == []
+
+    restored = archiver.restore('cold')
+    assert restored == {'imported': 1, 'skipped': 0, 'images': 2}
+    _, messages, _ = archiver.store.load_window('cold', 10)
+    assert messages[0]['content'] == 'hello from cold'
+    assert len(list(archiver.storage.list_objects(BUCKET, 'images/cold/'))) == 2
+    assert archiver.restore('cold') is None
+    # Restored chats aren't archived again right away
+    assert archiver.archive(30)['archived'] == 0
+
+
+def test_restore_keeps_the_archive_of_a_chat_that_exists_again(archiver):
+    add_chat(archiver, 'cold')
+    archiver.archive(30)
+    add_chat(archiver, 'cold', when=datetime.utcnow())
+    with pytest.raises(ChatExists):
+        archiver.restore('cold')
+    assert archiver.storage.exists(BUCKET, archive_key('cold'))
+
+
+def test_restore_raced_by_another_restore_keeps_the_archive(archiver, monkeypatch):
+    add_chat(archiver, 'cold')
+    archiver.archive(30)
+    monkeypatch.setattr(archiver.store, 'import_chats', lambda chats: {'imported': 0, 'skipped': len(chats)})
+    with pytest.raises(ChatExists):
+        archiver.restore('cold')
+    assert archiver.storage.exists(BUCKET, archive_key('cold'))
+
+
+def test_archive_pages_and_renews_the_lease(archiver):
+    for index in range(5):
+        add_chat(archiver, f"c{index}")
+    renewals = []
+    stats = archiver.archive(30, batch_size=2, renew=lambda: renewals.append(1) or True)
+    assert stats['archived'] == 5
+    assert len(renewals) == 2
+
+
+def test_archive_stops_when_the_lease_is_lost(archiver):
+    for index in range(5):
+        add_chat(archiver, f"c{index}")
+    stats = archiver.archive(30, batch_size=2, renew=lambda: False)
+    assert stats['archived'] == 2 and stats['stopped']
+    assert archiver.store.chats.count_documents({}) == 3
+
+
+def test_lease_is_exclusive_until_released(archiver):
+    lease = archiver._acquire(False)
+    assert lease is not None
+    assert archiver._acquire(False) is None
+    assert archiver._renew(lease)
+    assert not archiver._renew('someone else')
+    archiver.jobs.update_one({'_id': ARCHIVE_JOB}, {'$set': {'lease_until': datetime.utcnow() - timedelta(seconds=1)}})
+    assert not archiver._renew(lease)
+    assert archiver._acquire(False) is not None
+
+
+def test_scheduled_runs_wait_for_their_interval(archiver):
+    stats = archiver.run(30, scheduled=True)
+    assert stats['archived'] == 0
+    assert archiver.status()['last_run']['stats'] == stats
+    assert archiver.run(30, scheduled=True) is None
+
+
+def test_lost_lease_is_left_to_the_new_holder(archiver):
+    lease = archiver._acquire(False)
+    archiver.jobs.update_one({'_id': ARCHIVE_JOB}, {'$set': {'lease': 'new holder', 'lease_until': datetime.utcnow() + timedelta(hours=1)}})
+    archiver._run_leased(30, lease)
+    assert archiver.status()['lease'] == 'new holder'
+    assert 'last_run' not in archiver.status()
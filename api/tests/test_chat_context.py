@@ -0,0 +1,117 @@
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import mongomock
+import pytest
+import chat_context
+from chat_store import ChatStore
+from chat_context import build_context, fold_summary, schedule_summary
+
+
+@pytest.fixture
+def store(monkeypatch):
+    # One token per word keeps the budget arithmetic readable
+    monkeypatch.setattr(chat_context, 'count_tokens', lambda text: len(text.split()) if text else 0)
+    monkeypatch.setattr(chat_context, 'CONTEXT_TOKEN_BUDGET', 40)
+    return ChatStore(mongomock.MongoClient()['test'])
+
+
+@pytest.fixture
+def folds(monkeypatch):
+    calls = []
+    monkeypatch.setattr(chat_context, 'schedule_summary', lambda store, llm, chat_id, summary, upto, fold_to: calls.append((upto, fold_to)))
+    return calls
+
+
+class FakeLLM:
+    model = 'm'
+
+    def __init__(self):
+        self.prompts = []
+
+    def chat(self, prompt):
+        self.prompts.append(prompt)
+        return SimpleNamespace(message=SimpleNamespace(content=' new summary '))
+
+
+LLM = FakeLLM()
+
+
+def fill(store, count, words=5):
+    start = datetime(2026, 1, 1)
+    for index in range(count):
+        role = 'user' if index % 2 == 0 else 'ai'
+        store.append_message('c', {'role': role, 'content': ' '.join([f"w{index}"] * words), 'timestamp': start + timedelta(seconds=index)})
+
+
+def test_short_chats_fit_the_budget(store, folds):
+    fill(store, 3)
+    messages = build_context(store, LLM, 'c', 'sys', 'w2 w2 w2 w2 w2')
+    assert [m.role.value for m in messages] == ['system', 'user', 'assistant', 'user']
+    assert folds == []
+
+
+def test_turns_past_the_budget_stay_until_folded(store, folds, monkeypatch):
+    monkeypatch.setattr(chat_context, 'SUMMARY_MIN_FOLD_MESSAGES', 2)
+    fill(store, 11)
+    # sys (1) + input (5) leave 34 tokens: three 9-token turns
+    messages = build_context(store, LLM, 'c', 'sys', 'w10 w10 w10 w10 w10')
+    assert folds == [(0, 7)]
+    # Until the fold is stored, the older turns stay in the prompt
+    assert [m.content.split()[0] for m in messages[1:-1]] == [f"w{index}" for index in range(10)]
+    store.update_summary('c', 'earlier talk', 7, 0)
+    messages = build_context(store, LLM, 'c', 'sys', 'w10 w10 w10 w10 w10')
+    assert [m.content.split()[0] for m in messages[2:-1]] == ['w7', 'w8', 'w9']
+
+
+def test_fold_waits_for_enough_messages(store, folds, monkeypatch):
+    monkeypatch.setattr(chat_context, 'SUMMARY_MIN_FOLD_MESSAGES', 8)
+    fill(store, 11)
+    messages = build_context(store, LLM, 'c', 'sys', 'w10 w10 w10 w10 w10')
+    assert folds == []
+    assert len(messages) == 12
+
+
+def test_summary_replaces_folded_turns(store, folds, monkeypatch):
+    monkeypatch.setattr(chat_context, 'SUMMARY_MIN_FOLD_MESSAGES', 2)
+    fill(store, 11)
+    store.update_summary('c', 'earlier talk', 8, 0)
+    messages = build_context(store, LLM, 'c', 'sys', 'w10 w10 w10 w10 w10')
+    assert messages[1].content == 'Summary of the earlier conversation: earlier talk'
+    assert [m.content.split()[0] for m in messages[2:-1]] == ['w8', 'w9']
+    assert folds == []
+
+
+def test_fold_summarizes_only_the_new_turns(store):
+    fill(store, 6)
+    store.update_summary('c', 'old', 2, 0)
+    llm = FakeLLM()
+    assert fold_summary(store, llm, 'c', 'old', 2, 5) == 'new summary'
+    transcript = llm.prompts[0][1].content
+    assert 'old' in transcript and 'w2' in transcript and 'w4' in transcript
+    assert 'w1' not in transcript and 'w5' not in transcript
+    chat = store.chats.find_one({'chat_id': 'c'})
+    assert (chat['summary'], chat['summary_upto']) == ('new summary', 5)
+    # A fold built on an outdated summary doesn't overwrite a newer one
+    fold_summary(store, llm, 'c', 'old', 2, 4)
+    assert store.chats.find_one({'chat_id': 'c'})['summary_upto'] == 5
+
+
+def test_folds_are_deduplicated_per_chat(monkeypatch):
+    started, finish = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_fold(*args):
+        calls.append(args)
+        started.set()
+        finish.wait(5)
+
+    monkeypatch.setattr(chat_context, 'fold_summary', slow_fold)
+    first = schedule_summary(None, LLM, 'c', '', 0, 10)
+    started.wait(5)
+    assert schedule_summary(None, LLM, 'c', '', 0, 12) is first
+    finish.set()
+    first.result(5)
+    schedule_summary(None, LLM, 'c', '', 0, 12).result(5)
+    assert len(calls) == 2
+    assert chat_context._folding == {}
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+from chat_store import ChatStore
+
+START = datetime(2026, 1, 1)
+
+
+def message(index):
+    return {'role': 'user' if index % 2 == 0 else 'ai', 'content': f"message {index}", 'timestamp': START + timedelta(seconds=index)}
+
+
+@pytest.fixture(params=['embedded', 'bucketed'])
+def store(request):
+    store = ChatStore(mongomock.MongoClient()['test'], layout=request.param, bucket_size=4)
+    store.ensure_indexes()
+    return store
+
+
+def fill(store, chat_id, count):
+    for index in range(count):
+        store.append_message(chat_id, message(index))
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def test_append_creates_the_chat_once(store):
+    assert store.append_message('c', message(0)) is True
+    assert store.append_message('c', message(1)) is False
+    chat = store.chats.find_one({'chat_id': 'c'})
+    assert chat['message_count'] == 2 and chat['last_message_at'] == message(1)['timestamp']
+
+
+def test_last_message_at_never_moves_back(store):
+    store.append_message('c', message(2))
+    store.append_message('c', message(1))
+    assert store.chats.find_one({'chat_id': 'c'})['last_message_at'] == message(2)['timestamp']
+    assert store.chats.count_documents({}) == 1
+
+
+def test_messages_keep_their_order(store):
+    fill(store, 'c', 10)
+    chat = store.chats.find_one({'chat_id': 'c'})
+    assert contents(store.load_messages(chat)) == [f"message {index}" for index in range(10)]
+    assert chat['message_count'] == 10 and chat['last_message_at'] == message(9)['timestamp']
+
+
+def test_bucketed_layout_splits_messages(store):
+    fill(store, 'c', 10)
+    buckets = sorted((b['bucket'], b['count']) for b in store.buckets.find({'chat_id': 'c'}))
+    assert buckets == ([(0, 4), (1, 4), (2, 2)] if store.layout == 'bucketed' else [])
+
+
+def test_load_window_returns_the_latest_slice(store):
+    fill(store, 'c', 10)
+    chat, messages, offset = store.load_window('c', 3)
+    assert chat['chat_id'] == 'c'
+    assert contents(messages) == ['message 7', 'message 8', 'message 9']
+    assert offset == 7
+
+
+def test_load_window_before_a_position(store):
+    fill(store, 'c', 10)
+    _, messages, offset = store.load_window('c', 3, before=5)
+    assert contents(messages) == ['message 2', 'message 3', 'message 4']
+    assert offset == 2
+    _, messages, offset = store.load_window('c', 3, before=2)
+    assert contents(messages) == ['message 0', 'message 1'] and offset == 0
+    _, messages, _ = store.load_window('c', 3, before=0)
+    assert messages == []
+
+
+def test_load_window_for_a_missing_chat(store):
+    assert store.load_window('missing', 5) == (None, [], 0)
+
+
+def test_load_since_returns_newer_messages(store):
+    fill(store, 'c', 6)
+    _, messages, offset = store.load_since('c', message(3)['timestamp'])
+    assert contents(messages) == ['message 4', 'message 5']
+    assert offset == 4
+
+
+def test_migrate_merges_duplicates_and_moves_messages():
+    # mongomock can't run the bulk bucket writes, so only the embedded layout is covered
+    store = ChatStore(mongomock.MongoClient()['test'], layout='embedded')
+    store.chats.insert_many([
+        {'chat_id': 'c', 'title': 'Untitled', 'messages': [message(0), message(2)]},
+        {'chat_id': 'c', 'title': 'Named', 'messages': [message(1)]}
+    ])
+    stats = store.migrate(batch_size=2)
+    assert stats == {'duplicates_merged': 1, 'chats_migrated': 1}
+    chat = store.chats.find_one({'chat_id': 'c'})
+    assert chat['title'] == 'Named' and chat['message_count'] == 3
+    assert contents(store.load_messages(chat)) == ['message 0', 'message 1', 'message 2']
+
+
+def test_list_chats_pages_newest_first(store):
+    for index in range(5):
+        store.append_message(f"c{index}", message(index))
+    first, cursor = store.list_chats(2)
+    assert [c['chat_id'] for c in first] == ['c4', 'c3']
+    assert set(first[0]) == {'_id', 'chat_id', 'title', 'last_message_at'}
+    second, cursor = store.list_chats(2, cursor)
+    third, cursor = store.list_chats(2, cursor)
+    assert [c['chat_id'] for c in second + third] == ['c2', 'c1', 'c0']
+    assert cursor is None
+
+
+def test_list_chats_keeps_chats_without_last_message_at(store):
+    for index in range(3):
+        store.append_message(f"c{index}", message(index))
+    store.chats.insert_many([{'chat_id': 'null', 'last_message_at': None}, {'chat_id': 'missing'}])
+    seen, cursor = [], None
+    while True:
+        chats, cursor = store.list_chats(2, cursor)
+        seen += [c['chat_id'] for c in chats]
+        if cursor is None:
+            break
+    assert seen == ['c2', 'c1', 'c0', 'missing', 'null']
+
+
+def test_iter_chats_pages_by_id_with_messages(store):
+    for index in range(5):
+        fill(store, f"c{index}", 3)
+    chats = list(store.iter_chats(batch_size=2))
+    assert [c['chat_id'] for c in chats] == [f"c{index}" for index in range(5)]
+    assert all('_id' not in c and len(c['messages']) == 3 for c in chats)
+
+
+def test_import_skips_existing_chats(store):
+    fill(store, 'c', 2)
+    chats = [{'chat_id': 'c', 'messages': [message(0)]}, {'chat_id': 'd', 'messages': [message(0), message(1)]}, {'chat_id': 'e'}]
+    assert store.import_chats(chats, batch_size=2) == {'imported': 2, 'skipped': 1}
+    _, messages, _ = store.load_window('d', 10)
+    assert contents(messages) == ['message 0', 'message 1']
+    assert store.chats.find_one({'chat_id': 'e'})['last_message_at'] is not None
+
+
+def test_delete_chat_only_if_unchanged(store):
+    fill(store, 'c', 5)
+    assert store.delete_chat('c', START).deleted_count == 0
+    assert store.delete_chat('c', message(4)['timestamp']).deleted_count == 1
+    assert store.buckets.count_documents({'chat_id': 'c'}) == 0
@@ -0,0 +1,67 @@
+import mongomock
+from config_cache import ConfigCache
+
+
+def settings():
+    collection = mongomock.MongoClient()['test']['settings']
+    collection.insert_one({'_id': 'user', 'theme': 'dark'})
+    return collection
+
+
+def test_reads_are_cached_until_invalidated():
+    collection = settings()
+    cache = ConfigCache(ttl=300)
+    assert cache.get(collection, {'_id': 'user'})['theme'] == 'dark'
+    collection.update_one({'_id': 'user'}, {'$set': {'theme': 'light'}})
+    assert cache.get(collection, {'_id': 'user'})['theme'] == 'dark'
+    cache.invalidate('settings')
+    assert cache.get(collection, {'_id': 'user'})['theme'] == 'light'
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 2}
+
+
+def test_missing_documents_are_cached_too():
+    collection = settings()
+    cache = ConfigCache(ttl=300)
+    assert cache.get(collection, {'_id': 'other'}) is None
+    collection.insert_one({'_id': 'other'})
+    assert cache.get(collection, {'_id': 'other'}) is None
+
+
+def test_entries_expire_after_the_ttl():
+    collection = settings()
+    cache = ConfigCache(ttl=0)
+    cache.get(collection, {'_id': 'user'})
+    cache.get(collection, {'_id': 'user'})
+    assert cache.misses == 2
+
+
+def test_returned_documents_are_copies():
+    collection = settings()
+    cache = ConfigCache(ttl=300)
+    cache.get(collection, {'_id': 'user'})['theme'] = 'changed'
+    assert cache.get(collection, {'_id': 'user'})['theme'] == 'dark'
+
+
+def test_listeners_run_for_their_collection():
+    cache = ConfigCache()
+    calls = []
+    cache.on_change('settings', lambda: calls.append('settings'))
+    cache.on_change('app_config', lambda: calls.append('app_config'))
+    cache.invalidate('settings')
+    cache.invalidate()
+    assert calls == ['settings', 'settings', 'app_config']
+
+
+def test_read_racing_an_invalidation_is_not_stored():
+    collection = settings()
+    cache = ConfigCache(ttl=300)
+    find_one = collection.find_one
+
+    def racing_find_one(query):
+        doc = find_one(query)
+        cache.invalidate('settings')
+        return doc
+
+    collection.find_one = racing_find_one
+    cache.get(collection, {'_id': 'user'})
+    assert cache.stats()['entries'] == 0
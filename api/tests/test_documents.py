@@ -0,0 +1,81 @@
+from concurrent.futures import Future
+import mongomock
+import pytest
+from documents import DocumentJobs, DocumentPipeline, JOB_QUEUED, JOB_INDEXED, document_key, allowed_document
+
+
+class FakeIndex:
+    def __init__(self):
+        self.added = []
+        self.removed = []
+
+    def add_nodes(self, source, content_hash, nodes, doc_ids):
+        self.added.append(source)
+        return len(nodes)
+
+    def remove_prefix(self, prefix):
+        self.removed.append(prefix)
+        return 1
+
+
+@pytest.fixture
+def pipeline():
+    jobs = DocumentJobs(mongomock.MongoClient()['test']['document_jobs'])
+    jobs.ensure_indexes()
+    return DocumentPipeline(jobs, FakeIndex(), embed_model_factory=None, mongo_uri='mongodb://unused')
+
+
+def test_document_names():
+    assert allowed_document('Report.PDF') and not allowed_document('image.png')
+    assert document_key('c', 'abc', 'notes.md') == 'documents/c/abc.md'
+
+
+def test_job_lifecycle(pipeline):
+    jobs = pipeline.jobs
+    job = jobs.create('c', 'a.pdf', 'documents/c/h.pdf', 'h', 10)
+    assert jobs.get(job['job_id'])['status'] == JOB_QUEUED
+    jobs.update(job['job_id'], status=JOB_INDEXED, chunks=3)
+    assert jobs.get(job['job_id'])['chunks'] == 3
+    assert [j['job_id'] for j in jobs.list_for_chat('c')] == [job['job_id']]
+    assert jobs.list_for_chat('other') == []
+
+
+def test_has_documents_only_counts_indexed_jobs(pipeline):
+    job = pipeline.jobs.create('c', 'a.pdf', 'documents/c/h.pdf', 'h', 10)
+    assert not pipeline.has_documents('c')
+    pipeline.jobs.update(job['job_id'], status=JOB_INDEXED)
+    assert pipeline.has_documents('c')
+    assert not pipeline.has_documents('other')
+
+
+def test_remove_chat_skips_chats_without_documents(pipeline):
+    assert pipeline.remove_chat('c') is None
+    assert pipeline.document_index.removed == []
+
+
+def test_remove_chat_runs_in_the_background(pipeline):
+    pipeline.jobs.create('c', 'a.pdf', 'documents/c/h.pdf', 'h', 10)
+    assert pipeline.remove_chat('c').result(5) == 1
+    assert pipeline.document_index.removed == ['chat/c/']
+    assert pipeline.jobs.list_for_chat('c') == []
+
+
+def finished(nodes):
+    future = Future()
+    future.set_result((['doc'], nodes))
+    return future
+
+
+def test_finished_jobs_are_indexed(pipeline):
+    job = pipeline.jobs.create('c', 'a.pdf', 'documents/c/h.pdf', 'h', 10)
+    pipeline._finish(job, 'chat/c/h', finished(['n1', 'n2']))
+    assert pipeline.document_index.added == ['chat/c/h']
+    assert pipeline.jobs.get(job['job_id'])['chunks'] == 2
+
+
+def test_jobs_of_deleted_chats_are_dropped(pipeline):
+    job = pipeline.jobs.create('c', 'a.pdf', 'documents/c/h.pdf', 'h', 10)
+    pipeline.remove_chat('c').result(5)
+    pipeline._finish(job, 'chat/c/h', finished(['n1']))
+    assert pipeline.document_index.added == []
+    assert pipeline.jobs.get(job['job_id']) is None
@@ -0,0 +1,59 @@
+import io
+from PIL import Image
+from images import preprocess_image
+
+
+def png(size, mode='RGBA'):
+    out = io.BytesIO()
+    Image.new(mode, size, (200, 10, 10, 128) if mode == 'RGBA' else (200, 10, 10)).save(out, 'PNG')
+    return out.getvalue()
+
+
+def jpeg(size, orientation=None):
+    img = Image.new('RGB', size, (10, 200, 10))
+    exif = img.getexif()
+    if orientation:
+        exif[0x0112] = orientation
+    out = io.BytesIO()
+    img.save(out, 'JPEG', exif=exif.tobytes())
+    return out.getvalue()
+
+
+def opened(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_large_images_are_downscaled_and_reencoded():
+    processed = preprocess_image(png((3000, 1500)), max_side=1000, image_format='JPEG')
+    assert processed.content_type == 'image/jpeg'
+    assert opened(processed.data).size == (1000, 500)
+    assert max(opened(processed.thumbnail).size) == 256
+
+
+def test_small_images_in_the_target_format_pass_through():
+    source = png((400, 300), mode='RGB')
+    processed = preprocess_image(source, max_side=1000, image_format='PNG', thumbnails=False)
+    assert processed.data is source and processed.thumbnail is None
+
+
+def test_small_jpegs_pass_through():
+    source = jpeg((400, 300))
+    processed = preprocess_image(source, max_side=1000, image_format='JPEG', thumbnails=False)
+    assert processed.data is source
+
+
+def test_large_jpegs_are_drafted_down():
+    processed = preprocess_image(jpeg((4000, 2000)), max_side=1000, image_format='JPEG', thumbnails=False)
+    assert opened(processed.data).size == (1000, 500)
+
+
+def test_exif_orientation_is_applied():
+    processed = preprocess_image(jpeg((400, 200), orientation=6), max_side=1000, image_format='JPEG', thumbnails=False)
+    assert opened(processed.data).size == (200, 400)
+
+
+def test_spooled_uploads_are_read_from_disk(tmp_path):
+    path = tmp_path / 'upload.png'
+    path.write_bytes(png((50, 40), mode='RGB'))
+    processed = preprocess_image(str(path), max_side=1000, image_format='PNG', thumbnails=False)
+    assert opened(processed.data).size == (50, 40)
@@ -0,0 +1,51 @@
+import socket
+import threading
+import httpx
+from llm_registry import UpstreamStream, UPSTREAM_HOOKS, _current
+
+
+def silent_server():
+    # Accepts a request, sends the response headers and then nothing
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+
+    def serve():
+        conn, _ = server.accept()
+        conn.recv(65536)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        conn.recv(1)
+        conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def test_abort_interrupts_a_blocked_read():
+    port = silent_server()
+    client = httpx.Client(event_hooks=UPSTREAM_HOOKS)
+
+    def responses(upstream):
+        _current.stream = upstream
+        try:
+            with client.stream('POST', f'http://127.0.0.1:{port}/api/chat') as response:
+                yield from response.iter_lines()
+        finally:
+            _current.stream = None
+
+    upstream = UpstreamStream(responses)
+    failed = threading.Event()
+
+    def consume():
+        try:
+            list(upstream)
+        except httpx.TransportError:
+            failed.set()
+
+    reader = threading.Thread(target=consume, daemon=True)
+    reader.start()
+    reader.join(0.2)
+    assert reader.is_alive()
+    upstream.abort()
+    reader.join(5)
+    assert failed.is_set() and upstream.aborted
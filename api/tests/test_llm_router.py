@@ -0,0 +1,64 @@
+import pytest
+from llm_router import Router, NoBackendAvailable
+
+
+def router(strategy='affinity', slack=2):
+    return Router(['http://a:11434', 'http://b:11434/'], strategy=strategy, affinity_slack=slack)
+
+
+def backend(r, url):
+    return next(b for b in r.backends() if b.url == url)
+
+
+def test_least_outstanding_spreads_requests():
+    r = router('least_outstanding')
+    picked = [r.pick('qwen').url for _ in range(4)]
+    assert sorted(picked) == ['http://a:11434', 'http://a:11434', 'http://b:11434', 'http://b:11434']
+
+
+def test_affinity_prefers_the_backend_with_the_model_loaded():
+    r = router(slack=2)
+    backend(r, 'http://b:11434').loaded.add('qwen:latest')
+    assert [r.pick('qwen').url for _ in range(3)] == ['http://b:11434'] * 3
+    # Three busier than the idle backend is past the slack
+    assert r.pick('qwen').url == 'http://a:11434'
+
+
+def test_backends_without_the_model_are_skipped():
+    r = router()
+    backend(r, 'http://a:11434').installed = {'llama3.2-vision:latest'}
+    backend(r, 'http://b:11434').installed = {'qwen:7b'}
+    assert r.pick('qwen:7b').url == 'http://b:11434'
+
+
+def test_unhealthy_backends_leave_rotation():
+    r = router()
+    a = backend(r, 'http://a:11434')
+    r.mark_failed(a, ConnectionError('refused'))
+    assert {r.pick('qwen').url for _ in range(3)} == {'http://b:11434'}
+    assert r.pick('qwen', exclude=('http://b:11434',)).url == 'http://a:11434'
+
+
+def test_no_backend_left():
+    r = router()
+    with pytest.raises(NoBackendAvailable):
+        r.pick('qwen', exclude=('http://a:11434', 'http://b:11434'))
+
+
+def test_release_and_listeners():
+    r = router()
+    counts = []
+    r.add_listener(counts.append)
+    chosen = r.pick('qwen')
+    r.release(chosen)
+    assert chosen.outstanding == 0
+    r.mark_failed(chosen, ConnectionError('refused'))
+    assert counts == [2, 1]
+
+
+def test_reconfigure_keeps_existing_backends():
+    r = router()
+    a = backend(r, 'http://a:11434')
+    r.configure(['http://a:11434', 'http://c:11434'])
+    assert [b.url for b in r.backends()] == ['http://a:11434', 'http://c:11434']
+    assert backend(r, 'http://a:11434') is a
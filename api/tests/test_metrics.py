@@ -0,0 +1,37 @@
+import time
+import metrics
+from metrics import histogram, counter, timed, render_prometheus, record_ttft
+
+
+def test_histogram_buckets_and_percentiles():
+    h = histogram('test_latency_seconds', buckets=(0.1, 1.0), route='a')
+    for value in (0.05, 0.5, 0.5, 2.0):
+        h.observe(value)
+    assert h.summary()['count'] == 4 and h.percentile(50) == 0.5
+    text = render_prometheus()
+    assert '# TYPE test_latency_seconds histogram' in text
+    assert 'test_latency_seconds_bucket{route="a",le="1.0"} 3' in text
+    assert 'test_latency_seconds_bucket{route="a",le="+Inf"} 4' in text
+
+
+def test_timed_counts_calls():
+    @timed('test_call_seconds', operation='x')
+    def call():
+        return 1
+
+    call()
+    with timed('test_call_seconds', operation='x'):
+        pass
+    assert histogram('test_call_seconds', operation='x').count == 2
+    counter('test_events_total').inc(2)
+    assert 'test_events_total 2' in render_prometheus()
+
+
+def test_record_ttft_is_a_histogram_observation(monkeypatch):
+    h = histogram('time_to_first_token_seconds', endpoint='test')
+    before = h.count
+    record_ttft('test', time.perf_counter())
+    assert h.count == before + 1
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', False)
+    record_ttft('test', time.perf_counter())
+    assert h.count == before + 1
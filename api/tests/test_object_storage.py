@@ -0,0 +1,79 @@
+import time
+import socket
+import pytest
+from moto import mock_aws
+import object_storage
+from object_storage import ObjectStorage
+
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        storage = ObjectStorage(lambda: {'endpoint_url': None, 'access_key': 'key', 'secret_key': 'secret'})
+        storage.ensure_bucket(BUCKET)
+        storage.ensure_bucket(BUCKET)
+        yield storage
+
+
+def test_exists(storage):
+    assert not storage.exists(BUCKET, 'a')
+    storage.put_object(BUCKET, 'a', b'x', 'text/plain')
+    assert storage.exists(BUCKET, 'a')
+
+
+def test_delete_prefix_in_batches(storage, monkeypatch):
+    monkeypatch.setattr(object_storage, 'DELETE_BATCH_SIZE', 2)
+    for i in range(5):
+        storage.put_object(BUCKET, f'images/c/{i}', b'x')
+    storage.put_object(BUCKET, 'images/other/0', b'x')
+    assert storage.delete_prefix_in_background(BUCKET, 'images/c/').result(5) == 5
+    assert not storage.exists(BUCKET, 'images/c/0')
+    assert storage.exists(BUCKET, 'images/other/0')
+
+
+def test_bucket_check(storage):
+    storage.check_bucket(BUCKET)
+    with pytest.raises(Exception):
+        storage.check_bucket('missing')
+
+
+def test_bucket_check_gives_up_on_a_hung_endpoint(monkeypatch):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(object_storage, 'S3_PROBE_TIMEOUT', 0.2)
+    object_storage.probe_config.cache_clear()
+    storage = ObjectStorage(lambda: {'endpoint_url': f'http://127.0.0.1:{server.getsockname()[1]}', 'access_key': 'key', 'secret_key': 'secret'})
+    started = time.monotonic()
+    with pytest.raises(Exception):
+        storage.check_bucket(BUCKET)
+    assert time.monotonic() - started < 2
+    object_storage.probe_config.cache_clear()
+    server.close()
+
+
+def test_reload_swaps_the_client(storage):
+    client = storage.client
+    assert storage.reload() is not client
+    assert storage.client is not client
+
+
+def test_presigned_urls_are_reused_until_refresh(storage, monkeypatch):
+    url = storage.presigned_url(BUCKET, 'images/c/a.png')
+    assert storage.presigned_url(BUCKET, 'images/c/a.png') == url
+    signed_until = storage._urls[(BUCKET, 'images/c/a.png')][1]
+    monkeypatch.setattr(object_storage, 'S3_PRESIGN_REFRESH_SECONDS', object_storage.S3_PRESIGN_EXPIRES_SECONDS)
+    storage.presigned_url(BUCKET, 'images/c/a.png')
+    assert storage._urls[(BUCKET, 'images/c/a.png')][1] > signed_until
+
+
+def test_presigned_urls_use_the_public_endpoint(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    storage = ObjectStorage(lambda: {'endpoint_url': 'http://minio:9000', 'public_endpoint_url': 'http://localhost:9000',
+                                     'access_key': 'key', 'secret_key': 'secret'})
+    assert storage.presigned_url(BUCKET, 'a').startswith('http://localhost:9000/test-bucket/a?')
+    assert storage.client.meta.endpoint_url == 'http://minio:9000'
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+import mongomock
+from response_cache import ResponseCache, cache_key, replay_response
+
+
+def make_cache(**kwargs):
+    return ResponseCache(mongomock.MongoClient()['test']['response_cache'], **kwargs)
+
+
+def test_cache_key_normalizes_whitespace_and_case():
+    assert cache_key('m', 'sys', 'Hello   World') == cache_key('m', 'sys', ' hello world ')
+    assert cache_key('m', 'sys', 'hello') != cache_key('other', 'sys', 'hello')
+    assert cache_key('m', 'sys', '', 'a') != cache_key('m', 'sys', '', 'b')
+
+
+def test_memory_lru_evicts_the_oldest_entry():
+    cache = make_cache(max_entries=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    cache.get('a')
+    cache.put('c', 'C')
+    assert list(cache._entries) == ['a', 'c']
+
+
+def test_store_hit_refills_memory():
+    cache = make_cache()
+    # Counters are process-wide, so compare against where they started
+    before = (cache.store_hits.value, cache.memory_hits.value, cache.saved_seconds.value)
+    cache.put('a', 'A', 'm', 1.5)
+    cache._entries.clear()
+    assert cache.get('a') == 'A'
+    assert cache.get('a') == 'A'
+    assert cache.store_hits.value - before[0] == 1
+    assert cache.memory_hits.value - before[1] == 1
+    assert cache.saved_seconds.value - before[2] == 3.0
+
+
+def test_expired_entries_miss():
+    cache = make_cache(ttl_seconds=60)
+    cache.put('a', 'A')
+    cache._entries['a'] = ('A', 0, 0.0)
+    cache.collection.update_one({'_id': 'a'}, {'$set': {'expires_at': datetime.utcnow() - timedelta(seconds=1)}})
+    assert cache.get('a') is None
+    assert 'a' not in cache._entries
+
+
+def test_replay_preserves_the_text():
+    text = "Line one\n\n  indented  words "
+    assert ''.join(r.delta for r in replay_response(text)) == text
@@ -0,0 +1,85 @@
+import pytest
+from scheduler import Scheduler, QueueFull, SlotTimeout, reserved, PRIORITY_TITLE, PRIORITY_INTERACTIVE
+
+
+def test_admit_counts_requests_before_they_stream():
+    scheduler = Scheduler(default_concurrency=2, max_queue=3)
+    tickets = [scheduler.admit('m') for _ in range(5)]
+    with pytest.raises(QueueFull) as e:
+        scheduler.admit('m')
+    assert e.value.depth == 3
+    # Admission only reserves; slots are granted once the streams claim their tickets
+    assert not any(t.granted for t in tickets)
+    assert scheduler.stats()['m'] == {'max_concurrent': 2, 'active': 0, 'reserved': 5, 'waiting': 0}
+    for ticket in tickets:
+        ticket.claim()
+    assert [t.granted for t in tickets] == [True, True, False, False, False]
+    assert scheduler.stats()['m'] == {'max_concurrent': 2, 'active': 2, 'reserved': 0, 'waiting': 3}
+
+
+def test_abandoned_tickets_give_their_place_back():
+    scheduler = Scheduler(default_concurrency=1, max_queue=1)
+    first = scheduler.admit('m').claim()
+    second = scheduler.admit('m')
+    second.abandon()
+    third = scheduler.admit('m').claim()
+    first.close()
+    assert third.granted
+    assert scheduler.stats()['m'] == {'max_concurrent': 1, 'active': 1, 'reserved': 0, 'waiting': 0}
+
+
+def test_claimed_ticket_is_not_abandoned():
+    scheduler = Scheduler(default_concurrency=1)
+    ticket = scheduler.admit('m').claim()
+    ticket.abandon()
+    assert ticket.granted
+    ticket.close()
+    assert scheduler.stats()['m']['active'] == 0
+
+
+def test_reserved_abandons_on_error():
+    scheduler = Scheduler(default_concurrency=1)
+    ticket = scheduler.admit('m')
+    with pytest.raises(RuntimeError):
+        with reserved(ticket):
+            raise RuntimeError('storage down')
+    assert scheduler.stats()['m']['reserved'] == 0
+
+
+def test_background_calls_outrank_interactive_requests():
+    scheduler = Scheduler(default_concurrency=1)
+    running = scheduler.admit('m').claim()
+    interactive = scheduler.enqueue('m', PRIORITY_INTERACTIVE)
+    title = scheduler.enqueue('m', PRIORITY_TITLE)
+    assert title.position() == 0 and interactive.position() == 1
+    running.close()
+    assert title.granted and not interactive.granted
+
+
+def test_per_model_limits_and_scale():
+    scheduler = Scheduler(default_concurrency=1, model_concurrency='vision=2')
+    assert scheduler.queue_for('vision').max_concurrent == 2
+    assert scheduler.queue_for('text').max_concurrent == 1
+    scheduler.set_scale(3)
+    assert scheduler.stats()['text']['max_concurrent'] == 3
+
+
+def test_cancelled_ticket_leaves_the_queue():
+    scheduler = Scheduler(default_concurrency=1)
+    scheduler.admit('m').claim()
+    waiting = scheduler.admit('m').claim()
+    waiting.cancel()
+    assert waiting.cancelled and not waiting.wait(0)
+    assert scheduler.stats()['m']['waiting'] == 0
+
+
+def test_background_slot_gives_up_after_its_timeout():
+    scheduler = Scheduler(default_concurrency=1)
+    running = scheduler.admit('m').claim()
+    with pytest.raises(SlotTimeout):
+        with scheduler.slot('m', PRIORITY_TITLE, timeout=0.01):
+            pass
+    assert scheduler.stats()['m']['waiting'] == 0
+    running.close()
+    with scheduler.slot('m', PRIORITY_TITLE, timeout=0.01) as ticket:
+        assert ticket.granted
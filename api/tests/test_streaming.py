@@ -0,0 +1,227 @@
+import gc
+import time
+import threading
+import asyncio
+from types import SimpleNamespace
+import streaming
+from scheduler import Scheduler
+from generations import start_generation, active_generations
+from streaming import _Coalescer, format_event, sse_stream, asse_stream, DONE, HEARTBEAT
+
+
+def deltas(*pieces):
+    return iter([SimpleNamespace(delta=piece) for piece in pieces])
+
+
+def collect(completed):
+    def on_complete(text, truncated):
+        completed.append((text, truncated))
+        yield format_event('saved', event='info')
+    return on_complete
+
+
+def test_format_event_splits_lines():
+    assert format_event("a\nb") == "data: a\ndata: b\n\n"
+    assert format_event("x", event='error') == "event: error\ndata: x\n\n"
+
+
+def test_coalescer_flushes_on_size():
+    buffer = _Coalescer(flush_interval=60, flush_bytes=5)
+    buffer.add('abc')
+    assert not buffer.due()
+    buffer.add('de')
+    assert buffer.due()
+    assert buffer.flush() == "data: abcde\n\n"
+    assert not buffer.pending and buffer.text() == 'abcde'
+
+
+def test_coalescer_flushes_on_time():
+    buffer = _Coalescer(flush_interval=0, flush_bytes=1000)
+    assert buffer.timeout(15) == 15
+    buffer.add('a')
+    assert buffer.due() and buffer.timeout(15) == 0
+
+
+def test_sse_stream_frames_the_answer():
+    completed = []
+    frames = list(sse_stream(deltas('Hello', ' wor', 'ld\nbye'), collect(completed), flush_interval=60, flush_bytes=1 << 20))
+    assert frames == ["data: Hello world\ndata: bye\n\n", "event: info\ndata: saved\n\n", format_event(DONE)]
+    assert completed == [('Hello world\nbye', False)]
+
+
+def test_sse_stream_reports_upstream_errors():
+    def failing():
+        yield SimpleNamespace(delta='partial')
+        raise ConnectionError('backend gone')
+
+    frames = list(sse_stream(failing(), collect([]), flush_interval=60, flush_bytes=1 << 20))
+    assert frames[0] == "data: partial\n\n"
+    assert frames[1].startswith("event: error\n")
+    assert frames[-1] == format_event(DONE)
+
+
+def test_disconnect_keeps_the_partial_answer():
+    completed = []
+    stream = sse_stream(deltas('one ', 'two'), collect(completed), flush_interval=60, flush_bytes=1)
+    assert next(stream) == "data: one \n\n"
+    stream.close()
+    assert completed == [('one ', True)]
+
+
+def test_cancelled_generation_ends_the_stream():
+    def endless():
+        while True:
+            time.sleep(0.01)
+            yield SimpleNamespace(delta='x')
+
+    completed = []
+    generation = start_generation('c', 'chat')
+    stream = sse_stream(endless(), collect(completed), generation=generation, flush_interval=60, flush_bytes=1)
+    assert next(stream) == format_event(generation.id, event='generation')
+    assert next(stream) == "data: x\n\n"
+    generation.cancel()
+    rest = list(stream)
+    assert rest[-2:] == [format_event("Generation cancelled", event='cancelled'), format_event(DONE)]
+    assert completed[0][1] is True
+    assert generation not in active_generations()
+
+
+def test_silent_upstream_gets_heartbeats():
+    def slow():
+        time.sleep(0.1)
+        yield SimpleNamespace(delta='late')
+
+    frames = list(sse_stream(slow(), collect([]), flush_interval=60, flush_bytes=1 << 20, heartbeat=0.02))
+    assert frames[0] == HEARTBEAT
+    assert "data: late\n\n" in frames
+
+
+def test_stream_releases_its_ticket():
+    scheduler = Scheduler(default_concurrency=1)
+    ticket = scheduler.admit('m')
+    assert not ticket.granted
+    list(sse_stream(deltas('a'), collect([]), ticket=ticket))
+    assert scheduler.stats()['m'] == {'max_concurrent': 1, 'active': 0, 'reserved': 0, 'waiting': 0}
+
+
+def test_unconsumed_stream_abandons_its_ticket():
+    scheduler = Scheduler(default_concurrency=1)
+    stream = sse_stream(deltas('a'), collect([]), ticket=scheduler.admit('m'))
+    del stream
+    gc.collect()
+    assert scheduler.stats()['m']['reserved'] == 0
+
+
+def test_disconnect_aborts_a_stalled_upstream():
+    class Stalled:
+        def __init__(self):
+            self.pieces = iter([SimpleNamespace(delta='one')])
+            self.aborted = threading.Event()
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            piece = next(self.pieces, None)
+            if piece is not None:
+                return piece
+            self.aborted.wait(5)
+            raise ConnectionError('aborted')
+
+        def abort(self):
+            self.aborted.set()
+
+    scheduler = Scheduler(default_concurrency=1)
+    upstream = Stalled()
+    stream = sse_stream(upstream, collect([]), ticket=scheduler.admit('m'), flush_interval=60, flush_bytes=1)
+    assert next(stream) == "data: one\n\n"
+    stream.close()
+    assert upstream.aborted.is_set()
+    deadline = time.monotonic() + 5
+    while scheduler.stats()['m']['active'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert scheduler.stats()['m']['active'] == 0
+
+
+def test_waiting_stream_heartbeats_until_admitted():
+    scheduler = Scheduler(default_concurrency=1)
+    running = scheduler.admit('m').claim()
+    stream = sse_stream(deltas('a'), collect([]), ticket=scheduler.admit('m'), heartbeat=0.01)
+    first = next(stream)
+    assert first.startswith("event: queue\n")
+    running.close()
+    rest = list(stream)
+    assert rest[-1] == format_event(DONE)
+    assert all(frame == HEARTBEAT or frame.startswith(("event: queue", "data: ", "event: info")) for frame in rest)
+
+
+def test_async_stream_frames_the_answer():
+    async def adeltas():
+        for piece in ('Hel', 'lo'):
+            yield SimpleNamespace(delta=piece)
+
+    async def on_complete(text, truncated):
+        completed.append((text, truncated))
+        yield format_event('saved', event='info')
+
+    async def run():
+        return [frame async for frame in asse_stream(adeltas(), on_complete, flush_interval=60, flush_bytes=1 << 20)]
+
+    completed = []
+    frames = asyncio.run(run())
+    assert frames == ["data: Hello\n\n", "event: info\ndata: saved\n\n", format_event(DONE)]
+    assert completed == [('Hello', False)]
+
+
+def test_async_disconnect_saves_the_partial_answer():
+    async def adeltas():
+        yield SimpleNamespace(delta='one')
+        await asyncio.sleep(5)
+        yield SimpleNamespace(delta='two')
+
+    async def on_complete(text, truncated):
+        await asyncio.sleep(0)
+        completed.append((text, truncated))
+        yield format_event('saved', event='info')
+
+    async def run():
+        stream = asse_stream(adeltas(), on_complete, flush_interval=60, flush_bytes=1)
+        assert await stream.__anext__() == "data: one\n\n"
+        await stream.aclose()
+        assert len(streaming._background_tasks) == 1
+        await asyncio.gather(*streaming._background_tasks)
+
+    completed = []
+    asyncio.run(run())
+    assert completed == [('one', True)]
+    assert streaming._background_tasks == set()
+
+
+def test_cancelled_response_is_saved_before_shutdown():
+    async def adeltas():
+        yield SimpleNamespace(delta='one')
+        await asyncio.sleep(5)
+        yield SimpleNamespace(delta='two')
+
+    async def on_complete(text, truncated):
+        await asyncio.sleep(0.05)
+        completed.append((text, truncated))
+        yield format_event('saved', event='info')
+
+    async def respond(frames):
+        async for frame in asse_stream(adeltas(), on_complete, flush_interval=60, flush_bytes=1):
+            frames.append(frame)
+
+    async def run():
+        # What uvicorn does to responses still open when the graceful shutdown times out
+        frames = []
+        response = asyncio.create_task(respond(frames))
+        while not frames:
+            await asyncio.sleep(0.01)
+        response.cancel()
+        await asyncio.gather(response, return_exceptions=True)
+        await streaming.wait_for_saves(5)
+
+    completed = []
+    asyncio.run(run())
+    assert completed == [('one', True)]
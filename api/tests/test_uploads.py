@@ -0,0 +1,81 @@
+import io
+import os
+import hashlib
+from types import SimpleNamespace
+import pytest
+from moto import mock_aws
+from object_storage import ObjectStorage
+from uploads import BufferedUpload, upload_in_background
+
+BUCKET = 'test-bucket'
+
+
+def request_file(data):
+    return SimpleNamespace(stream=io.BytesIO(data))
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        storage = ObjectStorage(lambda: {'endpoint_url': None, 'access_key': 'key', 'secret_key': 'secret'})
+        storage.ensure_bucket(BUCKET)
+        yield storage
+
+
+def read(storage, key):
+    return storage.client.get_object(Bucket=BUCKET, Key=key)
+
+
+def test_small_uploads_stay_in_memory(tmp_path):
+    upload = BufferedUpload(request_file(b'abc'), str(tmp_path), in_memory_limit=10)
+    assert (upload.data, upload.path, upload.size) == (b'abc', None, 3)
+    assert upload.sha256 == hashlib.sha256(b'abc').hexdigest()
+    assert upload.open().read() == b'abc'
+    assert os.listdir(tmp_path) == []
+
+
+def test_large_uploads_spill_to_one_file(tmp_path):
+    upload = BufferedUpload(request_file(b'x' * 100), str(tmp_path), in_memory_limit=10)
+    assert upload.data is None and upload.size == 100
+    assert upload.sha256 == hashlib.sha256(b'x' * 100).hexdigest()
+    with upload.open() as f:
+        assert f.read() == b'x' * 100
+    upload.acquire()
+    upload.acquire()
+    upload.release()
+    assert os.path.exists(upload.path)
+    upload.release()
+    assert upload.path is None and os.listdir(tmp_path) == []
+
+
+def test_background_upload_outlives_the_response(storage, tmp_path):
+    upload = BufferedUpload(request_file(b'y' * 100), str(tmp_path), in_memory_limit=10)
+    upload.acquire()
+    future = upload_in_background(upload, storage, BUCKET, 'images/c/a.png')
+    upload.release()
+    future.result(5)
+    assert read(storage, 'images/c/a.png')['Body'].read() == b'y' * 100
+    assert os.listdir(tmp_path) == []
+
+
+def test_existing_objects_are_not_uploaded_again(storage, tmp_path):
+    storage.put_object(BUCKET, 'images/c/a.png', b'stored')
+    upload = BufferedUpload(request_file(b'new'), str(tmp_path))
+    upload_in_background(upload, storage, BUCKET, 'images/c/a.png').result(5)
+    assert read(storage, 'images/c/a.png')['Body'].read() == b'stored'
+
+
+def test_derived_objects_are_uploaded_with_the_original(storage, tmp_path):
+    upload = BufferedUpload(request_file(b'img'), str(tmp_path))
+    upload_in_background(upload, storage, BUCKET, 'images/c/b.png', [('images/c/b.thumb.jpg', b'thumb', 'image/jpeg')]).result(5)
+    thumb = read(storage, 'images/c/b.thumb.jpg')
+    assert thumb['Body'].read() == b'thumb' and thumb['ContentType'] == 'image/jpeg'
+
+
+def test_missing_derived_objects_are_added_to_a_stored_original(storage, tmp_path):
+    storage.put_object(BUCKET, 'images/c/b.png', b'stored')
+    upload = BufferedUpload(request_file(b'img'), str(tmp_path))
+    upload_in_background(upload, storage, BUCKET, 'images/c/b.png', [('images/c/b.thumb.jpg', b'thumb', 'image/jpeg')]).result(5)
+    assert read(storage, 'images/c/b.png')['Body'].read() == b'stored'
+    assert read(storage, 'images/c/b.thumb.jpg')['Body'].read() == b'thumb'
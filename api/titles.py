@@ -0,0 +1,97 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import scheduler, PRIORITY_TITLE
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Title shown for a new chat until the background worker writes the real one
+TITLE_PLACEHOLDER = "New Chat"
+
+title_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('TITLE_WORKERS', '2')),
+    thread_name_prefix='title-worker'
+)
+
+@timed('title_generation_seconds', kind='chat')
+def generate_chat_title(llm, user_input):
+    from llama_index.core.llms import ChatMessage
+    try:
+        logger.debug(f"Generating title for new chat with message: {user_input}")
+        messages = [
+            ChatMessage(role="system", content="You are a summarizer. Summarize the following message into 10–15 characters (approximately 2–3 words) that capture the essence of the message, without any punctuation or extra spaces."),
+            ChatMessage(role="user", content=user_input),
+        ]
+        with scheduler.slot(llm.model, PRIORITY_TITLE):
+            response = llm.chat(messages)
+        raw_response = response.message.content.strip()
+        logger.debug(f"Raw Ollama response for title: {raw_response}")
+        title = raw_response.strip()
+        if len(title) > 15:
+            title = title[:15].strip()
+        elif len(title) < 10:
+            title = title + "..."
+        logger.debug(f"Generated title: {title}")
+        if not title or title == "Untitled":
+            raise ValueError("Invalid title generated")
+        return title
+    except Exception as e:
+        logger.error(f"Error generating title: {e}")
+        return "Untitled"
+
+@timed('title_generation_seconds', kind='image')
+def generate_image_title(llm, filename):
+    from llama_index.core.llms import ChatMessage
+    try:
+        user_input = f"Uploaded image: {filename}"
+        logger.debug(f"Generating title for new image chat with message: {user_input}")
+        messages = [
+            ChatMessage(
+                role="system",
+                content="You are a creative summarizer. Based on the filename, generate a unique 10–15 character summary (2–3 words) capturing the essence of this image upload, avoiding generic terms like 'image' or 'uploaded'. No punctuation or extra spaces."
+            ),
+            ChatMessage(role="user", content=user_input),
+        ]
+        with scheduler.slot(llm.model, PRIORITY_TITLE):
+            response = llm.chat(messages)
+        raw_response = response.message.content.strip()
+        logger.debug(f"Raw Ollama response for title: '{raw_response}'")
+        title = raw_response.strip()
+
+        if len(title) > 15:
+            title = title[:15].strip()
+        elif len(title) < 10:
+            title = title + "..."[:15 - len(title)]
+        logger.debug(f"Processed title: '{title}', length: {len(title)}")
+
+        if not title or title == "Untitled" or "image" in title.lower() or "uploaded" in title.lower():
+            raise ValueError(f"Invalid or generic title generated: '{title}'")
+        return title
+    except Exception as e:
+        logger.error(f"Error generating title: {e}")
+        base_name = os.path.splitext(filename)[0][:12]
+        title = f"{base_name}pic"[:15]
+        logger.debug(f"Fallback title based on filename: '{title}'")
+        return title
+
+def schedule_title(collection, chat_id, generate_fn, *args):
+    # Runs the summarizer off the request path and only replaces the placeholder,
+    # so a title set by anything else in the meantime is left alone
+    def job():
+        title = generate_fn(*args)
+        with timed('mongo_query_seconds', collection='chat_history', operation='set_title'):
+            result = collection.update_one(
+                {'chat_id': chat_id, 'title': TITLE_PLACEHOLDER},
+                {'$set': {'title': title}}
+            )
+        logger.debug(f"Stored title '{title}' for chat_id {chat_id}: {result.modified_count} documents modified")
+        return title
+
+    def log_failure(future):
+        if future.exception():
+            logger.error(f"Title generation failed for chat_id {chat_id}: {future.exception()}")
+
+    future = title_executor.submit(job)
+    future.add_done_callback(log_failure)
+    return future
@@ -0,0 +1,99 @@
+import io
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Uploads are read from the request exactly once. Anything up to UPLOAD_IN_MEMORY_BYTES
+# stays in memory and the same bytes go to object storage and to the model; larger
+# files spill to a temp file that is removed once both the response and the storage
+# upload are done with it, whichever finishes last (including on client disconnect).
+UPLOAD_IN_MEMORY_BYTES = int(os.getenv('UPLOAD_IN_MEMORY_BYTES', str(8 * 1024 * 1024)))
+READ_CHUNK_BYTES = 1024 * 1024
+
+upload_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('UPLOAD_WORKERS', '4')),
+    thread_name_prefix='storage-upload'
+)
+
+
+class BufferedUpload:
+    def __init__(self, file, spool_dir, in_memory_limit=UPLOAD_IN_MEMORY_BYTES):
+        self.data = None
+        self.path = None
+        self._users = 0
+        self._lock = threading.Lock()
+
+        digest = hashlib.sha256()
+        head = file.stream.read(in_memory_limit + 1)
+        digest.update(head)
+        if len(head) <= in_memory_limit:
+            self.data = head
+            self.size = len(head)
+            self.sha256 = digest.hexdigest()
+            return
+
+        fd, self.path = tempfile.mkstemp(dir=spool_dir, suffix='.upload')
+        with os.fdopen(fd, 'wb') as spool:
+            spool.write(head)
+            self.size = len(head)
+            while True:
+                chunk = file.stream.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                digest.update(chunk)
+                self.size += len(chunk)
+        self.sha256 = digest.hexdigest()
+        logger.debug(f"Spooled {self.size} byte upload to {self.path}")
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, 'rb')
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+        self.cleanup()
+
+    def cleanup(self):
+        path, self.path = self.path, None
+        if path and os.path.exists(path):
+            os.remove(path)
+            logger.debug(f"Removed spooled upload {path}")
+
+
+def upload_in_background(upload, storage, bucket_name, key, extra_objects=(), content_type=None):
+    # Keys are derived from the content hash, so an existing object means this exact
+    # file is already stored and its upload is skipped. Derived objects are checked on
+    # their own: one stored before thumbnails existed (or whose thumbnail upload failed)
+    # still gets it. The upload holds its own reference so a spooled file outlives the
+    # response if needed.
+    upload.acquire()
+
+    def run():
+        try:
+            if storage.exists(bucket_name, key):
+                logger.info(f"{key} already stored in bucket {bucket_name}, skipping upload")
+            else:
+                with upload.open() as fileobj:
+                    storage.upload_fileobj(fileobj, bucket_name, key, content_type)
+                logger.info(f"Uploaded {key} to bucket {bucket_name}")
+            for extra_key, body, extra_type in extra_objects:
+                if not storage.exists(bucket_name, extra_key):
+                    storage.put_object(bucket_name, extra_key, body, extra_type)
+        finally:
+            upload.release()
+
+    return upload_executor.submit(run)